@@ -1,30 +1,27 @@
-from typing import List, Tuple, Dict, Any
+import json
+import os
+from typing import Callable, List, Tuple, Dict, Any
 
 from simulation_engine.gpt_structure import gpt_request_messages
 from cs222_assignment_1_bonus.environment import BakingEnvironment
+from cs222_assignment_1_bonus.passage_index import PassageIndex
+from cs222_assignment_1_bonus.context_window import ContextWindow
 
 class Agent:
   def __init__(self, name: str, description: str):
     self.name, self.description = name, description
     self.message_history = []
     self.env = BakingEnvironment(self)
+    self.memory_index = None
+    self.retrieved = {}
+    self.context_window = ContextWindow()
 
   def perceive(self) -> None:
-    env_description = f"""
-      Current baking environment:
-      Available ingredients:
-      {', '.join(self.env.ingredients.keys())}
-      Ingredients added: 
-      {', '.join(ing for ing, data in self.env.ingredients.items() if data['current'] > 0)}
-      Available tools: 
-      {', '.join(self.env.tools.keys())}
-      Tools in use: 
-      {', '.join(tool for tool, data in self.env.tools.items() if data['used'])}"""
-
-    self.message_history.append({
-      "role": "user",
-      "content": env_description
-    })
+    # The full environment description is sent once; after that only what
+    # changed since the last snapshot (and nothing if nothing changed).
+    env_message = self.context_window.snapshot_message(self.env, self.message_history)
+    if env_message:
+      self.message_history.append(env_message)
 
   def retrieve(self) -> str:
     """
@@ -39,9 +36,21 @@ class Agent:
     Return the retrieved recipe (ingredients and steps) as a string.
     """
     
-    memories = open(f"cs222_assignment_1_bonus/{self.name}/memory/cake.txt", 'r').read().split("\n\n")
+    # The memory file is read and indexed once per agent (and the index is 
+    # cached on disk by file hash); every later step is an in-memory lookup.
+    if self.memory_index is None:
+      self.memory_index = PassageIndex.from_file(
+        f"cs222_assignment_1_bonus/{self.name}/memory/cake.txt",
+        cache_dir=f"cs222_assignment_1_bonus/{self.name}/memory_index")
 
-    return ""
+    query = " ".join(["cake recipe ingredients steps"] 
+                     + list(self.env.ingredients.keys()) 
+                     + list(self.env.tools.keys())).replace("_", " ")
+    if query not in self.retrieved:
+      hits = self.memory_index.search(query)
+      self.retrieved[query] = "\n\n".join(
+        self.memory_index.passages[i] for i, _ in hits)
+    return self.retrieved[query]
 
   def act(self) -> str:
     persona = f"""
@@ -52,8 +61,11 @@ class Agent:
     Speak in character, no asterisks. Take only one action at a time.
     """
 
+    # Older messages are replaced by a summary of the current state so the
+    # prompt stays within the context window's token budget.
+    messages = self.context_window.build(self.message_history, self.env)
     response = gpt_request_messages(
-      messages=[{"role": "system", "content": persona}] + self.message_history)
+      messages=[{"role": "system", "content": persona}] + messages)
     return response
 
 
@@ -61,9 +73,29 @@ class Agent:
     self.message_history.append({"role": "assistant", "content": response})
 
 
-  def baking_step(self) -> Tuple[str, List[Dict[str, Any]], List[Dict[str, Any]], List[str]]:
+  def baking_step(self, on_progress: Callable[[str, Dict[str, Any]], None] = None) -> Tuple[str, List[Dict[str, Any]], List[Dict[str, Any]], List[str]]:
+    """
+    Runs one perceive/act/reflect/execute step. on_progress, if given, is 
+    called with a stage name and payload as the step advances. 
+    """
+    on_progress = on_progress or (lambda stage, payload: None)
     self.perceive()
+    on_progress("acting", {})
     action = self.act()
     self.reflect(action)
+    on_progress("acted", {"agent_message": action})
     attempted, executed, feedbacks = self.env.process_action(action)
-    return action, attempted, executed, feedbacks
\ No newline at end of file
+    on_progress("executed", {"executed_actions": executed, "feedback": feedbacks})
+    return action, attempted, executed, feedbacks
+
+
+def print_cyan(text: str) -> None:
+  print(f"\033[96m{text}\033[0m")
+
+
+def init_agent(agent_folder: str) -> Agent:
+  agent_path = os.path.join('cs222_assignment_1_bonus', agent_folder, 'agent.json')
+  with open(agent_path, 'r') as f:
+    agent_json = json.load(f)
+
+  return Agent(agent_json["name"], agent_json["description"])
@@ -1,62 +1,113 @@
-import json
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict
 from flask import Flask, render_template, jsonify, request, send_from_directory
+from flask import session as client_session
+from flask_socketio import SocketIO, join_room
 import os
 
-from bonus_agent import Agent
-
-def print_cyan(text: str) -> None:
-    print(f"\033[96m{text}\033[0m")
-
-def init_agent(agent_folder: str) -> Agent:
-    agent_path = os.path.join('cs222_assignment_1_bonus', 'isabella', 'agent.json')
-    with open(agent_path, 'r') as f:
-        agent_json = json.load(f)
-
-    return Agent(agent_json["name"], agent_json["description"])
+from bonus_agent import Agent, init_agent, print_cyan
 
 app = Flask(__name__, 
             static_folder='cs222_assignment_1_bonus/static',
             template_folder='cs222_assignment_1_bonus/templates')
+# Signs the cookie that carries each client's server-issued id.
+app.secret_key = os.environ.get("BONUS_APP_SECRET_KEY") or os.urandom(32)
+socketio = SocketIO(app, async_mode="threading")
 
-isabella = init_agent("isabella")
-current_step = 0
 max_steps = 25
+max_sessions = 500
+# /next_step_async runs baking steps on this pool rather than on the request
+# thread, so slow LLM calls do not pin down server workers.
+step_executor = ThreadPoolExecutor(max_workers=64)
 
-@app.route('/')
-def index():
-    return render_template('index.html')
 
-@app.route('/start_baking', methods=['POST'])
-def start_baking():
-    global current_step
-    current_step = 0
-    isabella.env.reset()
-    initial_message = "Hi there! I'm Isabella, and I absolutely love baking. I'm so excited to bake a cake today!"
-    isabella.message_history = [{"role": "assistant", "content": initial_message}]
-    
-    return jsonify({
-        "message": initial_message,
-        "progress": isabella.env.get_progress(),
-        "completed": False,
-        "feedback": "",
-        "executed_actions": []
-    })
+class BakingSession:
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.agent = init_agent("isabella")
+        self.current_step = 0
+        # Serializes the steps of one session; different sessions run in parallel.
+        self.lock = threading.Lock()
+
+
+class SessionStore:
+    """
+    Per-session agents and baking environments, keyed by the session id the
+    page sends with every request. The least recently used session is evicted
+    once max_size sessions exist.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.sessions: "OrderedDict[str, BakingSession]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, session_id: str) -> BakingSession:
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = BakingSession(session_id)
+                self.sessions[session_id] = session
+            self.sessions.move_to_end(session_id)
+            while len(self.sessions) > self.max_size:
+                self.sessions.popitem(last=False)
+            return session
+
+
+sessions = SessionStore(max_sessions)
+
+
+def get_client_id() -> str:
+    """
+    Returns the id the server issued to this client, stored in its signed
+    session cookie, so a client cannot pick another client's id.
+    """
+    if 'client_id' not in client_session:
+        client_session['client_id'] = uuid.uuid4().hex
+    return client_session['client_id']
+
+
+def get_session_id() -> str:
+    """
+    Each browser tab sends its own id (X-Session-Id header, or a session_id
+    form/JSON field); tabs that send none share a default session. Sessions
+    are scoped to the server-issued client id.
+    """
+    payload = request.get_json(silent=True) or {}
+    tab_id = (request.headers.get('X-Session-Id') or request.form.get('session_id')
+              or payload.get('session_id') or 'default')
+    return f"{get_client_id()}:{tab_id}"
+
+
+def emit_progress(session_id: str, stage: str, payload: Dict[str, Any]) -> None:
+    socketio.emit('step_progress', dict(payload, stage=stage), to=session_id)
+
+
+def run_baking_step(session: BakingSession) -> Dict[str, Any]:
+    with session.lock:
+        agent = session.agent
+        if session.current_step >= max_steps or agent.env._all_steps_completed():
+            return {
+                "agent_message": "Oh dear, it seems we've taken too long to bake the cake. Let's try again another time!",
+                "completed": True,
+                "feedback": "",
+                "attempted_actions": [],
+                "executed_actions": []
+            }
+
+        session.current_step += 1
+        agent_message, attempted_actions, executed_actions, feedbacks = agent.baking_step(
+            lambda stage, payload: emit_progress(session.session_id, stage, payload))
 
-@app.route('/next_step', methods=['POST'])
-def next_step():
-    global current_step
-    if current_step < max_steps and not isabella.env._all_steps_completed():
-        current_step += 1
-        
-        agent_message, attempted_actions, executed_actions, feedbacks = isabella.baking_step()
-        
         feedback = '\n'.join(feedbacks)
-        progress = isabella.env.get_progress()
-        
-        if isabella.env._all_steps_completed():
-            final_message = "Wonderful! We've successfully baked the cake. Let's enjoy it!" if isabella.env.check_final_ingredients() else "Hmm... it seems we made some mistakes with the ingredients and the cake tastes... not so good. Let's try again next time!"
-            isabella.message_history.append({"role": "assistant", "content": final_message})
-            return jsonify({
+        progress = agent.env.get_progress()
+
+        if agent.env._all_steps_completed():
+            final_message = "Wonderful! We've successfully baked the cake. Let's enjoy it!" if agent.env.check_final_ingredients() else "Hmm... it seems we made some mistakes with the ingredients and the cake tastes... not so good. Let's try again next time!"
+            agent.message_history.append({"role": "assistant", "content": final_message})
+            return {
                 "agent_message": agent_message,
                 "final_message": final_message,
                 "progress": progress,
@@ -64,28 +115,80 @@ def next_step():
                 "feedback": feedback,
                 "attempted_actions": attempted_actions,
                 "executed_actions": executed_actions
-            })
-        
-        return jsonify({
+            }
+
+        return {
             "agent_message": agent_message,
             "progress": progress,
             "completed": False,
             "feedback": feedback,
             "attempted_actions": attempted_actions,
             "executed_actions": executed_actions
-        })
-    else:
-        return jsonify({
-            "agent_message": "Oh dear, it seems we've taken too long to bake the cake. Let's try again another time!",
-            "completed": True,
-            "feedback": "",
-            "attempted_actions": [],
-            "executed_actions": []
-        })
+        }
+
+
+@app.route('/')
+def index():
+    # Issue the client id before the page opens its socket.
+    get_client_id()
+    return render_template('index.html')
+
+@app.route('/start_baking', methods=['POST'])
+def start_baking():
+    session = sessions.get(get_session_id())
+    with session.lock:
+        session.current_step = 0
+        session.agent.env.reset()
+        initial_message = "Hi there! I'm Isabella, and I absolutely love baking. I'm so excited to bake a cake today!"
+        session.agent.message_history = [{"role": "assistant", "content": initial_message}]
+        progress = session.agent.env.get_progress()
+    
+    return jsonify({
+        "message": initial_message,
+        "progress": progress,
+        "completed": False,
+        "feedback": "",
+        "executed_actions": []
+    })
+
+@app.route('/next_step', methods=['POST'])
+def next_step():
+    session = sessions.get(get_session_id())
+    return jsonify(run_baking_step(session))
+
+@app.route('/next_step_async', methods=['POST'])
+def next_step_async():
+    """
+    Starts the next step on the worker pool and returns immediately. Progress
+    and the final result are pushed to the session's socket room as
+    'step_progress' and 'step_result' events.
+    """
+    session = sessions.get(get_session_id())
+    job_id = uuid.uuid4().hex
+
+    def _run():
+        try:
+            result = run_baking_step(session)
+        except Exception as e:
+            # The client is waiting for this job_id, so failures are reported too.
+            print_cyan(f"Step {job_id} failed: {type(e).__name__}: {e}")
+            result = {"error": f"{type(e).__name__}: {e}", "completed": False}
+        socketio.emit('step_result', dict(result, job_id=job_id), to=session.session_id)
+
+    step_executor.submit(_run)
+    return jsonify({"job_id": job_id}), 202
+
+@socketio.on('join')
+def on_join(data):
+    # The room is derived from the client id in the signed cookie, so a
+    # client can only join the rooms of its own tabs.
+    if 'client_id' not in client_session:
+        return
+    join_room(f"{client_session['client_id']}:{(data or {}).get('session_id') or 'default'}")
 
 @app.route('/static/<path:path>')
 def send_static(path):
     return send_from_directory(app.static_folder, path)
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    socketio.run(app, debug=True)
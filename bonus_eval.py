@@ -0,0 +1,132 @@
+import argparse
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, List
+
+from bonus_agent import Agent, init_agent, print_cyan
+
+
+def run_episode(episode_id: int, agent_folder: str, max_steps: int) -> Dict[str, Any]:
+    """
+    Runs one headless baking episode, the same way bonus_app drives it one
+    /next_step at a time, and returns its per-step record. Every episode has
+    its own Agent and BakingEnvironment.
+    """
+    agent = init_agent(agent_folder)
+    agent.env.reset()
+    agent.message_history = [{"role": "assistant", "content": "Hi there! I'm Isabella, and I absolutely love baking. I'm so excited to bake a cake today!"}]
+
+    timings = {}
+    def on_progress(stage: str, payload: Dict[str, Any]) -> None:
+        timings[stage] = time.perf_counter()
+
+    steps = []
+    error = None
+    start = time.perf_counter()
+    for step in range(1, max_steps + 1):
+        step_start = time.perf_counter()
+        try:
+            agent_message, attempted, executed, feedbacks = agent.baking_step(on_progress)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            break
+        steps.append({
+            "step": step,
+            "agent_message": agent_message,
+            "attempted_actions": attempted,
+            "executed_actions": executed,
+            "feedback": list(feedbacks),
+            "progress": agent.env.get_progress(),
+            "llm_latency": timings["acted"] - timings["acting"],
+            "step_latency": time.perf_counter() - step_start,
+        })
+        if agent.env._all_steps_completed():
+            break
+
+    completed = agent.env._all_steps_completed()
+    return {
+        "episode_id": episode_id,
+        "completed": completed,
+        "success": completed and agent.env.check_final_ingredients(),
+        "steps_taken": len(steps),
+        "duration": time.perf_counter() - start,
+        "error": error,
+        "steps": steps,
+    }
+
+
+def _distribution(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+    return {"mean": statistics.mean(ordered), "p50": percentile(0.5),
+            "p90": percentile(0.9), "p99": percentile(0.99), "max": ordered[-1]}
+
+
+def summarize(episodes: List[Dict[str, Any]]) -> Dict[str, Any]:
+    successes = [e for e in episodes if e["success"]]
+    return {
+        "episodes": len(episodes),
+        "success_rate": len(successes) / len(episodes) if episodes else 0.0,
+        "completion_rate": sum(e["completed"] for e in episodes) / len(episodes) if episodes else 0.0,
+        "errors": sum(e["error"] is not None for e in episodes),
+        # Steps-to-completion only counts episodes that finished the recipe.
+        "steps_to_completion": _distribution([e["steps_taken"] for e in episodes if e["completed"]]),
+        "llm_latency": _distribution([s["llm_latency"] for e in episodes for s in e["steps"]]),
+        "step_latency": _distribution([s["step_latency"] for e in episodes for s in e["steps"]]),
+    }
+
+
+def evaluate(episodes: int, workers: int, agent_folder: str = "isabella",
+             max_steps: int = 25, output_dir: str = None) -> Dict[str, Any]:
+    """
+    Runs the episodes on a process pool and returns the summary. If
+    output_dir is given, every episode record is written to
+    <output_dir>/episodes.jsonl as it finishes, and the summary to
+    <output_dir>/summary.json.
+    """
+    records = []
+    out = None
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        out = open(os.path.join(output_dir, "episodes.jsonl"), "w", encoding="utf-8")
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(run_episode, i, agent_folder, max_steps) for i in range(episodes)]
+            for future in as_completed(futures):
+                record = future.result()
+                records.append(record)
+                print_cyan(f"Episode {record['episode_id']}: "
+                           f"{'success' if record['success'] else 'failure'} "
+                           f"after {record['steps_taken']} steps")
+                if out:
+                    out.write(json.dumps(record) + "\n")
+                    out.flush()
+    finally:
+        if out:
+            out.close()
+
+    summary = summarize(sorted(records, key=lambda r: r["episode_id"]))
+    if output_dir:
+        with open(os.path.join(output_dir, "summary.json"), "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Headless batch evaluation of the baking agent.")
+    parser.add_argument("--episodes", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--agent", default="isabella")
+    parser.add_argument("--max-steps", type=int, default=25)
+    parser.add_argument("--output-dir", default=None)
+    args = parser.parse_args()
+
+    summary = evaluate(args.episodes, args.workers, args.agent, args.max_steps, args.output_dir)
+    print(json.dumps(summary, indent=2))
@@ -0,0 +1,166 @@
+import re
+from typing import List, Optional, Tuple
+
+
+# Surface forms of each environment ingredient, longest first so that
+# "vanilla extract" wins over "vanilla".
+INGREDIENT_ALIASES = {
+    "flour": ["all-purpose flour", "all purpose flour", "flour"],
+    "baking_powder": ["baking powder", "baking_powder"],
+    "salt": ["salt"],
+    "butter": ["butter"],
+    "sugar": ["granulated sugar", "sugar"],
+    "eggs": ["eggs", "egg"],
+    "vanilla_extract": ["vanilla extract", "vanilla_extract", "vanilla"],
+    "milk": ["milk"],
+}
+
+TOOL_PATTERN = re.compile(r"\b(mixing[ _]bowl|large[ _]bowl|whisk|mixer|(?:cake )?pans?)\b")
+
+NUMBER_WORDS = {"a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+                "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10, "twelve": 12}
+
+_ALIAS_TO_INGREDIENT = {alias: name for name, aliases in INGREDIENT_ALIASES.items()
+                        for alias in aliases}
+_ALIAS_PATTERN = "|".join(re.escape(a) for a in sorted(_ALIAS_TO_INGREDIENT, key=len, reverse=True))
+
+# "<quantity> [unit] [of] [the] [up to two adjectives] <ingredient>",
+# e.g. "250g of all-purpose flour", "2 teaspoons baking powder", "4 large eggs".
+QUANTITY_PATTERN = re.compile(
+    r"\b(\d+(?:\.\d+)?|" + "|".join(NUMBER_WORDS) + r")\s*"
+    r"(?:g|grams?|ml|milliliters?|cups?|tsps?|teaspoons?|tbsps?|tablespoons?|sticks?|pinch(?:es)?)?\.?\s+"
+    r"(?:of\s+)?(?:the\s+)?(?:[a-z-]+\s+){0,2}?"
+    r"(" + _ALIAS_PATTERN + r")\b")
+INGREDIENT_PATTERN = re.compile(r"\b(" + _ALIAS_PATTERN + r")\b")
+
+# Quantities the parser cannot map to a whole number ("1/2 cup", "half a
+# cup", "a couple of eggs", "a pinch of salt"); sentences that add
+# ingredients with one of these are left to the LLM extractor. Decimals
+# that are not whole numbers ("0.5 teaspoon") are rejected by _quantity.
+UNMAPPED_QUANTITY_PATTERN = re.compile(
+    r"\d+\s*/\s*\d+|[½⅓⅔¼¾⅛]|\b(?:half|halves|quarters?|thirds?|eighths?|"
+    r"dozen|couple|few|several|some|splash|dash|handful|bit|pinch(?:es)?|"
+    r"little|touch|sprinkle|drizzle|knob)\b")
+
+ADD_VERBS = re.compile(r"\b(add|adding|put|pour in|measure|crack|sift|toss|drop|stir in|beat in|mix in|fold in)\b")
+MIX_VERBS = re.compile(r"\b(mix|mixing|whisk|whisking|stir|stirring|blend|blending|beat|beating|combine|combining|fold)\b")
+DRY_INGREDIENTS = {"flour", "baking_powder", "salt"}
+WET_INGREDIENTS = {"eggs", "vanilla_extract", "milk"}
+
+TOOL_NOUN_PATTERN = re.compile(r"\b(?:the|a|my|your|our)\s+(?:mixing[ _]bowl|whisk)\b|\bmixing[ _]bowl\b")
+
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?;\n])\s+")
+
+
+def _quantity(token: str) -> Optional[int]:
+    if token in NUMBER_WORDS:
+        return NUMBER_WORDS[token]
+    try:
+        value = float(token)
+    except ValueError:
+        return None
+    return int(value) if value.is_integer() else None
+
+
+def _parse_sentence(sentence: str) -> Tuple[List[Tuple[int, int, str]], bool]:
+    """
+    Parses one sentence into (order, position, simple action) tuples. Within a
+    sentence, tool uses come first and ingredient additions second, since
+    they are preconditions of the mixing steps mentioned alongside them.
+
+    Returns the actions and whether the sentence was understood; a sentence
+    is not understood when it clearly asks for an action whose arguments we
+    could not resolve (e.g. "add the flour" without a quantity).
+    """
+    actions = []
+    confident = True
+
+    if "preheat" in sentence:
+        temperature = re.search(r"(\d+)\s*(?:°\s*f|degrees|°|f\b)", sentence)
+        if temperature:
+            actions.append((2, sentence.index("preheat"), f"preheat oven to {temperature.group(1)} degrees"))
+        else:
+            confident = False
+
+    bake = re.search(r"\bbake\b|\b(?:in|into) the oven\b", sentence)
+    if bake and "preheat" not in sentence:
+        actions.append((2, bake.start(), "bake cake"))
+
+    pour = re.search(r"\bpour\b", sentence)
+    if pour and "batter" in sentence:
+        actions.append((2, pour.start(), "pour batter"))
+
+    cool = re.search(r"\bcool(?:ing)?\b.*\b(?:cake|rack)\b|\blet (?:it|the cake) cool\b", sentence)
+    if cool:
+        actions.append((2, cool.start(), "cool cake"))
+
+    cream = re.search(r"\bcream(?:ing)?\b", sentence)
+    if cream:
+        actions.append((2, cream.start(), "cream butter and sugar"))
+
+    # "the whisk" / "the mixing bowl" are tools, not mixing verbs.
+    mix = MIX_VERBS.search(TOOL_NOUN_PATTERN.sub(lambda m: " " * len(m.group()), sentence))
+    if mix and not cream:
+        mentioned = {_ALIAS_TO_INGREDIENT[m] for m in INGREDIENT_PATTERN.findall(sentence)}
+        dry = "dry" in sentence or (mentioned & DRY_INGREDIENTS and not mentioned & WET_INGREDIENTS)
+        wet = "wet" in sentence or (mentioned & WET_INGREDIENTS and not mentioned & DRY_INGREDIENTS)
+        if (dry and wet) or re.search(r"\ball (?:the |of the )?ingredients\b|\beverything\b", sentence):
+            actions.append((2, mix.start(), "combine all ingredients"))
+        elif dry:
+            actions.append((2, mix.start(), "mix dry ingredients"))
+        elif wet:
+            actions.append((2, mix.start(), "mix wet ingredients"))
+
+    if ADD_VERBS.search(sentence) and not (pour and "batter" in sentence):
+        if UNMAPPED_QUANTITY_PATTERN.search(sentence) and INGREDIENT_PATTERN.search(sentence):
+            confident = False
+        quantified = set()
+        for match in QUANTITY_PATTERN.finditer(sentence):
+            amount = _quantity(match.group(1))
+            ingredient = _ALIAS_TO_INGREDIENT[match.group(2)]
+            if amount is not None:
+                actions.append((1, match.start(), f"add {amount} {ingredient}"))
+                quantified.add(match.start(2))
+        if any(match.start() not in quantified
+               for match in INGREDIENT_PATTERN.finditer(sentence)):
+            # An ingredient is being added without a quantity we can read.
+            confident = False
+
+    for match in TOOL_PATTERN.finditer(sentence):
+        tool = match.group(1).replace(" ", "_")
+        if tool.endswith("pan") or tool.endswith("pans"):
+            if pour or bake:
+                continue
+            tool = "pans"
+        actions.append((0, match.start(), f"use {tool}"))
+
+    return actions, confident
+
+
+def parse_action(action: str) -> Optional[str]:
+    """
+    Deterministically translates an agent's prose into the comma-separated
+    simple actions understood by BakingEnvironment.process_action, e.g.
+    "I'll grab the whisk and mix the dry ingredients" ->
+    "use whisk, mix dry ingredients".
+
+    Returns None when the parse is low-confidence (some sentence asks for an
+    action we could not fully resolve, or nothing was recognized at all), in
+    which case the caller should fall back to the LLM extractor.
+    """
+    text = action.lower().replace("’", "'")
+    actions = []
+    for sentence in SENTENCE_SPLIT.split(text):
+        sentence_actions, confident = _parse_sentence(sentence)
+        if not confident:
+            return None
+        actions.extend(a for _, _, a in sorted(sentence_actions))
+    if not actions:
+        return None
+
+    # Drop repeats of the same tool use or step, but keep repeated additions.
+    deduplicated = []
+    for a in actions:
+        if a.startswith("add ") or a not in deduplicated:
+            deduplicated.append(a)
+    return ", ".join(deduplicated)
@@ -0,0 +1,88 @@
+from typing import Dict, List, Optional
+
+from simulation_engine.gpt_structure import estimate_token_count
+
+
+class ContextWindow:
+    """
+    Keeps the prompt of a baking agent flat over long episodes.
+
+    - Environment snapshots: the full description is sent once; later steps
+      only send what changed, and nothing at all if nothing changed.
+    - Rolling state summary: messages that fall out of the recent window are
+      replaced by a single summary of the current environment state
+      (including the available ingredients and tools), which is exact and
+      free to compute (no LLM call).
+    - Token budget: the recent window holds at most recent_messages messages
+      and token_budget estimated tokens.
+    """
+
+    def __init__(self, token_budget: int = 1500, recent_messages: int = 12):
+        self.token_budget = token_budget
+        self.recent_messages = recent_messages
+        self.last_snapshot = None
+        self.last_snapshot_message: Optional[Dict[str, str]] = None
+
+    def snapshot_message(self, env, messages: List[Dict[str, str]]) -> Optional[Dict[str, str]]:
+        """
+        Returns the environment message to append for this step, or None if
+        the environment has not changed since the last snapshot in messages.
+        """
+        snapshot = env.snapshot()
+        previous_visible = any(m is self.last_snapshot_message for m in messages)
+
+        if previous_visible:
+            last = self.last_snapshot
+            if snapshot is last or (snapshot.added, snapshot.in_use) == (last.added, last.in_use):
+                return None
+            new_added = [i for i in snapshot.added if i not in last.added]
+            new_tools = [t for t in snapshot.in_use if t not in last.in_use]
+            content = f"""
+      Baking environment update:
+      Newly added ingredients: {', '.join(new_added) or 'none'}
+      Newly used tools: {', '.join(new_tools) or 'none'}"""
+        else:
+            # First step, or the history was reset: send the full description.
+            content = snapshot.description
+
+        self.last_snapshot = snapshot
+        self.last_snapshot_message = {"role": "user", "content": content}
+        return self.last_snapshot_message
+
+    @staticmethod
+    def state_summary(env, folded_count: int) -> Dict[str, str]:
+        added = [f"{ing} {data['current']}" for ing, data in env.ingredients.items() if data['current'] > 0]
+        in_use = [tool for tool, data in env.tools.items() if data['used']]
+        steps = [step.replace('_', ' ') for step in sorted(env.steps_completed)]
+        oven = f"{env.oven_temperature}°F" if env.oven_temperature is not None else "not preheated"
+        # The full snapshot description may be among the folded messages, so
+        # the summary repeats the available ingredients and tools.
+        content = f"""
+      Summary of the {folded_count} earlier messages (current state):
+      Available ingredients: {', '.join(env.ingredients.keys())}
+      Available tools: {', '.join(env.tools.keys())}
+      Ingredients added so far: {', '.join(added) or 'none'}
+      Tools in use: {', '.join(in_use) or 'none'}
+      Oven: {oven}
+      Steps completed: {', '.join(steps) or 'none'}"""
+        return {"role": "user", "content": content}
+
+    def build(self, messages: List[Dict[str, str]], env) -> List[Dict[str, str]]:
+        """
+        Returns the messages to send: a state summary standing in for older
+        messages, followed by the most recent messages that fit the budget.
+        """
+        recent: List[Dict[str, str]] = []
+        tokens = 0
+        for message in reversed(messages):
+            message_tokens = estimate_token_count(message["content"])
+            if len(recent) >= self.recent_messages or (recent and tokens + message_tokens > self.token_budget):
+                break
+            recent.append(message)
+            tokens += message_tokens
+        recent.reverse()
+
+        folded_count = len(messages) - len(recent)
+        if folded_count == 0:
+            return recent
+        return [self.state_summary(env, folded_count)] + recent
@@ -1,12 +1,141 @@
+import copy
 import re
+import threading
 from typing import List, Tuple, Dict, Any
 
 from simulation_engine.gpt_structure import gpt_request
+from cs222_assignment_1_bonus.action_parser import parse_action
+
+EXTRACTION_CACHE_SIZE = 10000
+
+ALL_STEPS = ["preheat_oven", "prepare_pans", "mix_dry_ingredients", "cream", "mix_wet_ingredients", "combine_all_ingredients", "pour_batter", "bake_cake", "cool_cake"]
+
+# Within one utterance, an action of each kind runs after every action of the
+# kinds it depends on (tools and ingredients before mixing, mixing before
+# combining, and so on).
+ACTION_DEPENDENCIES = {
+    "add_ingredient": [],
+    "preheat_oven": [],
+    "use_tool": [],
+    "mix_dry": ["use_tool", "add_ingredient"],
+    "mix_wet": ["use_tool", "add_ingredient"],
+    "mix_cream": ["use_tool", "add_ingredient"],
+    "combine_all_ingredients": ["mix_dry", "mix_wet", "mix_cream"],
+    "pour_batter": ["combine_all_ingredients", "use_tool"],
+    "bake_cake": ["pour_batter", "preheat_oven"],
+    "cool_cake": ["bake_cake"],
+}
+
+# Steps that must be completed (or provided earlier in the same utterance)
+# before the action completing a step can succeed.
+STEP_PREREQUISITES = {
+    "combine_all_ingredients": ["mix_dry_ingredients", "mix_wet_ingredients"],
+    "pour_batter": ["combine_all_ingredients", "prepare_pans"],
+    "bake_cake": ["pour_batter", "preheat_oven"],
+    "cool_cake": ["bake_cake"],
+}
+
+
+def _topological_order(dependencies: Dict[str, List[str]]) -> List[str]:
+    """Kahn's algorithm over the action kinds, in declaration order on ties."""
+    indegree = {kind: len(deps) for kind, deps in dependencies.items()}
+    dependents = {kind: [] for kind in dependencies}
+    for kind, deps in dependencies.items():
+        for dep in deps:
+            dependents[dep].append(kind)
+
+    order = []
+    ready = [kind for kind in dependencies if indegree[kind] == 0]
+    while ready:
+        kind = ready.pop(0)
+        order.append(kind)
+        for dependent in dependents[kind]:
+            indegree[dependent] -= 1
+            if indegree[dependent] == 0:
+                ready.append(dependent)
+    if len(order) != len(dependencies):
+        raise ValueError(f"Cyclic action dependencies: {set(dependencies) - set(order)}")
+    return order
+
+
+ACTION_ORDER = _topological_order(ACTION_DEPENDENCIES)
+
+STEP_TOOL_MAP = {
+    "mix_dry_ingredients": [("mixing_bowl", "Mixing Bowl"), ("whisk", "Whisk")],
+    "cream": [("large_bowl", "Large Bowl"), ("mixer", "Mixer")],
+    "mix_wet_ingredients": [("large_bowl", "Large Bowl"), ("mixer", "Mixer")],
+}
+DRY_INGREDIENTS = ["flour", "baking_powder", "salt"]
+WET_INGREDIENTS = ["butter", "sugar", "eggs", "vanilla_extract", "milk"]
+
+
+class EnvironmentSnapshot:
+    """
+    The prompt-ready forms of a BakingEnvironment at one state version: the
+    ingredients added and tools in use, the perceive description and the
+    get_progress dict. BakingEnvironment keeps one snapshot and only renders
+    a new one after an action has changed its state.
+    """
+
+    def __init__(self, env: "BakingEnvironment", version: int):
+        self.version = version
+        self.added = tuple(ing for ing, data in env.ingredients.items() if data['current'] > 0)
+        self.in_use = tuple(tool for tool, data in env.tools.items() if data['used'])
+        self.description = f"""
+      Current baking environment:
+      Available ingredients:
+      {', '.join(env.ingredients.keys())}
+      Ingredients added:
+      {', '.join(self.added)}
+      Available tools:
+      {', '.join(env.tools.keys())}
+      Tools in use:
+      {', '.join(self.in_use)}"""
+        self.progress = self._render_progress(env)
+
+    @staticmethod
+    def _render_progress(env: "BakingEnvironment") -> Dict[str, Any]:
+        progress = {
+            "steps": [],
+            "dry_ingredients": [],
+            "wet_ingredients": []
+        }
+
+        for step in ALL_STEPS:
+            status = "completed" if step in env.steps_completed else "incomplete"
+            step_name = step.replace('_', ' ').capitalize()
+            if step in STEP_TOOL_MAP:
+                tool_statuses = [{"name": name, "used": env.tools[t]["used"]} for t, name in STEP_TOOL_MAP[step]]
+                progress["steps"].append({"name": step_name, "status": status, "tools": tool_statuses})
+            else:
+                progress["steps"].append({"name": step_name, "status": status})
+
+        for key, ingredients in [("dry_ingredients", DRY_INGREDIENTS), ("wet_ingredients", WET_INGREDIENTS)]:
+            for ingredient in ingredients:
+                data = env.ingredients[ingredient]
+                progress[key].append({
+                    "name": ingredient.capitalize(),
+                    "current": data["current"],
+                    "required": data["required"]
+                })
+
+        return progress
+
 
 class BakingEnvironment:
+    # Shared by every environment (and every bonus_app session), so it is
+    # guarded by a lock.
+    _extraction_cache: Dict[str, str] = {}
+    _extraction_cache_lock = threading.Lock()
+    # The extraction instructions only depend on the ingredient and tool
+    # names, which never change, so they are rendered once.
+    _extraction_prompt_prefix: str = None
+
     def __init__(self, agent):
         self.agent = agent
         self.feedbacks = []
+        self.version = 0
+        self._snapshot = None
         self.reset()
 
     def reset(self) -> None:
@@ -21,6 +150,17 @@ class BakingEnvironment:
         self.steps_completed = set()
         self.oven_temperature = None
         self.dry_mixed = self.wet_mixed = self.cream_done = False
+        self.version += 1
+
+    def snapshot(self) -> EnvironmentSnapshot:
+        """
+        Returns the snapshot of the current state, rendering it only if the
+        state changed since the last call. Every state change goes through
+        reset or process_action, which bump self.version.
+        """
+        if self._snapshot is None or self._snapshot.version != self.version:
+            self._snapshot = EnvironmentSnapshot(self, self.version)
+        return self._snapshot
 
     def _send_feedback(self, message: str) -> None:
         self.feedbacks.append(message)
@@ -68,11 +208,16 @@ class BakingEnvironment:
            any(func.__name__ == 'mix_ingredients' and args[0] == 'wet' for func, args in detected_actions):
             detected_actions.append((self.combine_all_ingredients, ()))
 
-        sorted_actions = self._sort_actions(detected_actions)
+        sorted_actions, unsatisfiable = self._sort_actions(detected_actions)
         attempted_actions = []
         executed_actions = []
         self.feedbacks = []
 
+        for (action_func, args), missing in unsatisfiable:
+            attempted_actions.append({"name": action_func.__name__, "args": args, "unsatisfiable": missing})
+            self._send_feedback(f"Could not {action_func.__name__.replace('_', ' ')} yet: "
+                                f"{', '.join(step.replace('_', ' ') for step in missing)} must be done first")
+
         for action_func, args in sorted_actions:
             attempted_action = {"name": action_func.__name__, "args": args}
             attempted_actions.append(attempted_action)
@@ -82,13 +227,39 @@ class BakingEnvironment:
             except Exception as e:
                 self._send_feedback(f"Failed to execute {action_func.__name__}: {str(e)}")
 
+        if executed_actions:
+            self.version += 1
+
         if self._all_steps_completed():
             self.check_final_ingredients()
 
         return attempted_actions, executed_actions, self.feedbacks
 
     def extract_action(self, action: str) -> str:
-        prompt = f"""
+        # Extractions only depend on the action text, so they are cached across
+        # environments. The deterministic parser handles the common phrasings;
+        # the LLM is only asked when the parse is low-confidence.
+        # Failed LLM calls are not cached, so the next attempt asks again.
+        cache = BakingEnvironment._extraction_cache
+        with BakingEnvironment._extraction_cache_lock:
+            if action in cache:
+                return cache[action]
+
+        response = parse_action(action)
+        if response is None:
+            response = self._extract_action_llm(action)
+            if response.startswith("GENERATION ERROR"):
+                return response
+
+        with BakingEnvironment._extraction_cache_lock:
+            if action not in cache and len(cache) >= EXTRACTION_CACHE_SIZE:
+                cache.pop(next(iter(cache)))
+            cache[action] = response
+        return response
+
+    def _extract_action_llm(self, action: str) -> str:
+        if BakingEnvironment._extraction_prompt_prefix is None:
+            BakingEnvironment._extraction_prompt_prefix = f"""
         Given a description of a baker's action, extract the action and arguments.
         Provide a comma-separated list of simple actions. ONLY the following actions are allowed:
         - For adding ingredients: "add [quantity in number only, no units] [ingredient name]"
@@ -106,86 +277,65 @@ class BakingEnvironment:
         Input: "Now I'll add 4 eggs, one at a time, then mix it all together with the mixer"
         Your response: "add 4 eggs, use mixer, mix wet ingredients"
 
-        Input: {action}
+        Input: """
+        prompt = f"""{BakingEnvironment._extraction_prompt_prefix}{action}
         """
         response = gpt_request(prompt, model="gpt-4o", max_tokens=100)
         return response
 
-    def _sort_actions(self, actions: List[Tuple[callable, Tuple]]) -> List[Tuple[callable, Tuple]]:
-        dependencies = {
-            self.mix_ingredients: [self.use_tool],
-            self.combine_all_ingredients: [lambda: self.mix_ingredients("dry"), lambda: self.mix_ingredients("wet")],
-            self.pour_batter: [self.combine_all_ingredients],
-            self.bake_cake: [self.pour_batter, self.preheat_oven]
-        }
+    @staticmethod
+    def _action_kind(action: Tuple[callable, Tuple]) -> str:
+        func, args = action
+        if func.__name__ == 'mix_ingredients':
+            return f"mix_{args[0]}"
+        return func.__name__
 
-        def dependencies_satisfied(action, completed_actions):
-            return action not in dependencies or all(any(isinstance(dep, type(ca)) for ca in completed_actions) for dep in dependencies[action])
+    @staticmethod
+    def _provided_step(kind: str, args: Tuple) -> str:
+        if kind == 'use_tool':
+            return "prepare_pans" if args[0] == "pans" else None
+        if kind == 'mix_cream':
+            return "cream"
+        if kind in ('mix_dry', 'mix_wet'):
+            return f"{kind}_ingredients"
+        return kind if kind in ALL_STEPS else None
 
-        sorted_actions = []
-        completed_actions = set()
+    def _sort_actions(self, actions: List[Tuple[callable, Tuple]]) -> Tuple[List[Tuple[callable, Tuple]], List[Tuple[Tuple[callable, Tuple], List[str]]]]:
+        """
+        Orders the actions of one utterance so that every action runs after
+        the actions it depends on (ACTION_DEPENDENCIES), keeping the original
+        order otherwise. The dependency graph is over the ten action kinds,
+        so ordering is a stable bucket pass in linear time.
 
-        while actions:
-            for action in actions:
-                if dependencies_satisfied(action[0], completed_actions):
-                    sorted_actions.append(action)
-                    completed_actions.add(action[0])
-                    actions.remove(action)
-                    break
-            else:
-                sorted_actions.extend(actions)
-                break
+        Returns the ordered actions and the unsatisfiable ones, each with the
+        steps it is missing: an action whose prerequisite steps are neither
+        completed nor provided by an earlier action in this utterance.
+        """
+        buckets: Dict[str, List[Tuple[callable, Tuple]]] = {kind: [] for kind in ACTION_ORDER}
+        for action in actions:
+            buckets[self._action_kind(action)].append(action)
 
-        return sorted_actions
+        provided = set(self.steps_completed)
+        sorted_actions, unsatisfiable = [], []
+        for kind in ACTION_ORDER:
+            for action in buckets[kind]:
+                step = self._provided_step(kind, action[1])
+                missing = [s for s in STEP_PREREQUISITES.get(step, []) if s not in provided]
+                if missing:
+                    unsatisfiable.append((action, missing))
+                    continue
+                sorted_actions.append(action)
+                if step:
+                    provided.add(step)
+
+        return sorted_actions, unsatisfiable
 
     def get_progress(self) -> Dict[str, Any]:
-        progress = {
-            "steps": [],
-            "dry_ingredients": [],
-            "wet_ingredients": []
-        }
-        
-        step_tool_map = {
-            "mix_dry_ingredients": [("mixing_bowl", "Mixing Bowl"), ("whisk", "Whisk")],
-            "cream": [("large_bowl", "Large Bowl"), ("mixer", "Mixer")],
-            "mix_wet_ingredients": [("large_bowl", "Large Bowl"), ("mixer", "Mixer")],
-        }
-        
-        all_steps = ["preheat_oven", "prepare_pans", "mix_dry_ingredients", "cream", "mix_wet_ingredients", "combine_all_ingredients", "pour_batter", "bake_cake", "cool_cake"]
-        
-        for step in all_steps:
-            status = "completed" if step in self.steps_completed else "incomplete"
-            step_name = step.replace('_', ' ').capitalize()
-            if step in step_tool_map:
-                tool_statuses = [{"name": name, "used": self.tools[t]["used"]} for t, name in step_tool_map[step]]
-                progress["steps"].append({"name": step_name, "status": status, "tools": tool_statuses})
-            else:
-                progress["steps"].append({"name": step_name, "status": status})
-        
-        dry_ingredients = ["flour", "baking_powder", "salt"]
-        wet_ingredients = ["butter", "sugar", "eggs", "vanilla_extract", "milk"]
-        
-        for ingredient in dry_ingredients:
-            data = self.ingredients[ingredient]
-            progress["dry_ingredients"].append({
-                "name": ingredient.capitalize(),
-                "current": data["current"],
-                "required": data["required"]
-            })
-        
-        for ingredient in wet_ingredients:
-            data = self.ingredients[ingredient]
-            progress["wet_ingredients"].append({
-                "name": ingredient.capitalize(),
-                "current": data["current"],
-                "required": data["required"]
-            })
-        
-        return progress
+        # A copy, so callers cannot modify the cached snapshot.
+        return copy.deepcopy(self.snapshot().progress)
 
     def _all_steps_completed(self) -> bool:
-        all_steps = {"preheat_oven", "prepare_pans", "mix_dry_ingredients", "cream", "mix_wet_ingredients", "combine_all_ingredients", "pour_batter", "bake_cake", "cool_cake"}
-        return self.steps_completed == all_steps
+        return self.steps_completed == set(ALL_STEPS)
 
     def check_final_ingredients(self) -> bool:
         errors = [f"{i}: expected {d['required']}, got {d['current']}" for i, d in self.ingredients.items() if d["current"] != d["required"]]
@@ -295,4 +445,45 @@ class BakingEnvironment:
             self.steps_completed.add("cool_cake")
             self._send_feedback("You let the pans sit for 10 minutes, then cooled the cake on a wire rack")
         else:
-            self._send_feedback("Please bake the cake first")
\ No newline at end of file
+            self._send_feedback("Please bake the cake first")
+
+def benchmark_sort_actions(action_count: int = 10000, repeat: int = 20) -> Dict[int, float]:
+    """
+    Measures _sort_actions on large multi-action utterances (the same
+    nine-action recipe repeated, shuffled) to check that ordering time grows
+    linearly with the number of actions.
+
+    Returns a dictionary mapping each utterance size to microseconds per action.
+
+    The module imports its package, so run it as a module from the repository
+    root: python -m cs222_assignment_1_bonus.environment
+    """
+    import random
+    import time
+
+    env = BakingEnvironment(agent=None)
+    recipe = [(env.cool_cake, ()), (env.bake_cake, ()), (env.pour_batter, ()),
+              (env.combine_all_ingredients, ()), (env.mix_ingredients, ("wet",)),
+              (env.mix_ingredients, ("dry",)), (env.add_ingredient, ("flour", 250)),
+              (env.use_tool, ("pans",)), (env.preheat_oven, (350,))]
+
+    results = {}
+    rng = random.Random(0)
+    for size in [action_count // 100, action_count // 10, action_count]:
+        actions = [recipe[i % len(recipe)] for i in range(size)]
+        rng.shuffle(actions)
+        sorted_actions, unsatisfiable = env._sort_actions(list(actions))
+        assert len(sorted_actions) == size and not unsatisfiable
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            env._sort_actions(list(actions))
+        elapsed = time.perf_counter() - start
+        results[size] = elapsed / repeat / size * 1e6
+        print(f"{size} actions: {elapsed / repeat * 1e3:.2f} ms/sort, {results[size]:.3f} us/action")
+    return results
+
+
+if __name__ == '__main__':
+    # python -m cs222_assignment_1_bonus.environment (from the repository root)
+    benchmark_sort_actions()
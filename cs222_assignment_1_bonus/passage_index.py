@@ -0,0 +1,94 @@
+import hashlib
+import json
+import math
+import os
+import re
+from collections import Counter
+from typing import Dict, List, Tuple
+
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class PassageIndex:
+    """
+    BM25 index over the blank-line separated paragraphs of a memory file.
+
+    The index is built once per file and cached on disk under
+    <cache_dir>/<sha256 of the file>.json, so editing the file invalidates the
+    cache and loading an unchanged file never re-tokenizes it. Queries only
+    touch the in-memory postings.
+    """
+
+    def __init__(self, passages: List[str], term_freqs: List[Dict[str, int]] = None,
+                 k1: float = 1.5, b: float = 0.75):
+        self.passages = passages
+        self.k1, self.b = k1, b
+        self.term_freqs = term_freqs if term_freqs is not None else \
+            [dict(Counter(tokenize(p))) for p in passages]
+        self.lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_length = sum(self.lengths) / max(len(self.lengths), 1)
+
+        self.postings: Dict[str, List[int]] = {}
+        for i, tf in enumerate(self.term_freqs):
+            for term in tf:
+                self.postings.setdefault(term, []).append(i)
+        n = len(passages)
+        self.idf = {term: math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+                    for term, docs in self.postings.items()}
+
+    @classmethod
+    def from_file(cls, path: str, cache_dir: str = None) -> "PassageIndex":
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        passages = [p.strip() for p in text.split("\n\n") if p.strip()]
+        if not cache_dir:
+            return cls(passages)
+
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        cache_path = os.path.join(cache_dir, f"{digest}.json")
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                return cls.from_dict(json.load(f))
+
+        index = cls(passages)
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump(index.to_dict(), f)
+        return index
+
+    def to_dict(self) -> Dict:
+        return {"passages": self.passages, "k1": self.k1, "b": self.b,
+                "term_freqs": self.term_freqs}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "PassageIndex":
+        return cls(data["passages"], data["term_freqs"], data["k1"], data["b"])
+
+    def score(self, query: str) -> List[float]:
+        scores = [0.0] * len(self.passages)
+        for term in set(tokenize(query)):
+            for i in self.postings.get(term, []):
+                tf = self.term_freqs[i][term]
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / self.avg_length)
+                scores[i] += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query: str, top_k: int = 3,
+               min_relative_score: float = 0.5) -> List[Tuple[int, float]]:
+        """
+        Returns up to top_k (passage index, score) pairs in document order,
+        dropping passages that score below min_relative_score times the best
+        passage so that loosely related paragraphs are not retrieved.
+        """
+        scores = self.score(query)
+        ranked = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+        if not ranked or scores[ranked[0]] <= 0:
+            return []
+        cutoff = scores[ranked[0]] * min_relative_score
+        hits = [i for i in ranked[:top_k] if scores[i] >= cutoff]
+        return [(i, scores[i]) for i in sorted(hits)]
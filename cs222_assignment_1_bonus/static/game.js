@@ -162,12 +162,12 @@ function autoProgress() {
     currentStep++;
     displayGameState(gameStates[currentStep]);
   } else {
-    $.post('/next_step', function(data) {
+    requestNextStep(function(data) {
       updateGameState(data);
       if (data.completed) {
         stopAutoProgress();
       }
-    });
+    }, stopAutoProgress);
   }
   updateNavigationButtons();
   updateCurrentStepDisplay();
@@ -567,7 +567,61 @@ function displayEndImage(imageName) {
 function updateCurrentStepDisplay() {
   $('#current-step').text(`Current Step: ${currentStep}`);
 }
+// Every tab bakes in its own server-side session.
+const sessionId = (window.crypto && crypto.randomUUID) ? crypto.randomUUID() : Math.random().toString(36).slice(2);
+$.ajaxSetup({ headers: { 'X-Session-Id': sessionId } });
+
+let socket = null;
+// Callbacks of the steps started on /next_step_async, and results that
+// arrived before the POST that started them returned, by job id.
+const pendingSteps = {};
+const earlyResults = {};
+
+function deliverStep(result, onSuccess, onError) {
+  if (result.error) {
+    $('#current-step').text(`Current Step: ${currentStep} (step failed: ${result.error})`);
+    if (onError) onError(result);
+    return;
+  }
+  onSuccess(result);
+}
+
+// Runs the next baking step. With a connected socket the step runs in the
+// background and its result arrives as a 'step_result' event; otherwise the
+// synchronous endpoint is used.
+function requestNextStep(onSuccess, onError) {
+  if (!socket || !socket.connected) {
+    $.post('/next_step', onSuccess).fail(() => onError && onError({}));
+    return;
+  }
+  $.post('/next_step_async', function(data) {
+    if (earlyResults[data.job_id]) {
+      const result = earlyResults[data.job_id];
+      delete earlyResults[data.job_id];
+      deliverStep(result, onSuccess, onError);
+    } else {
+      pendingSteps[data.job_id] = { onSuccess, onError };
+    }
+  }).fail(() => onError && onError({}));
+}
+
 $(document).ready(function() {
+  if (typeof io !== 'undefined') {
+    socket = io();
+    socket.on('connect', () => socket.emit('join', { session_id: sessionId }));
+    socket.on('step_progress', (event) => {
+      $('#current-step').text(`Current Step: ${currentStep} (${event.stage})`);
+    });
+    socket.on('step_result', (result) => {
+      const pending = pendingSteps[result.job_id];
+      if (pending) {
+        delete pendingSteps[result.job_id];
+        deliverStep(result, pending.onSuccess, pending.onError);
+      } else {
+        earlyResults[result.job_id] = result;
+      }
+    });
+  }
 
   $.post('/start_baking', function(data) {
     updateGameState(data);
@@ -579,9 +633,7 @@ $(document).ready(function() {
       currentStep++;
       displayGameState(gameStates[currentStep]);
     } else {
-      $.post('/next_step', function(data) {
-        updateGameState(data);
-      });
+      requestNextStep(updateGameState);
     }
     updateNavigationButtons();
   });
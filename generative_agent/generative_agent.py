@@ -1,13 +1,122 @@
+import hashlib
 import json
 
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 
-from generative_agent.modules.memory_stream import MemoryStream
+from generative_agent.modules.memory_stream import ConceptNode, MemoryStream
 from generative_agent.modules.scratch import Scratch
 from generative_agent.modules.interaction import utterance
+from generative_agent.modules.dialogue_buffer import DialogueBuffer
+from generative_agent.modules.reflection_scheduler import ReflectionScheduler
+from generative_agent.modules.consolidation import (
+  MemoryConsolidator, append_archive)
 from simulation_engine.settings import *
 from simulation_engine.global_methods import *
 
+# ############################################################################
+# ###                        GENERATIVE AGENT CLASS                        ###
+# ############################################################################
+
+def load_population_config(population: str) -> Dict: 
+  """
+  Reads the optional <population>/population.json, which holds settings 
+  shared by every agent of the population: 
+    "embedding_dimensions": size of the embeddings requested for new 
+      memories (text-embedding-3 models can return shortened embeddings), 
+      or null for the model's full size. 
+    "coarse_dim": if set, retrieval scores on the first coarse_dim 
+      dimensions of each embedding and rescores the best candidates on the 
+      full embeddings (see MemoryStream.coarse_dim). 
+    "dedup": how duplicate observations are ingested: "merge", "skip", or 
+      null to always add them (see MemoryStream.ingest). 
+    "dedup_similarity": the cosine similarity above which an observation 
+      is a near-duplicate. 
+
+  Parameters:
+    population: The population. 
+  Returns: 
+    The configuration dictionary (empty if there is no population.json)
+  """
+  config_file = f"{POPULATIONS_DIR}/{population}/population.json"
+  if not os.path.exists(config_file): 
+    return dict()
+  with open(config_file) as json_file:
+    return json.load(json_file)
+
+
+def hash_node_segment(nodes: List[Dict]) -> str: 
+  """
+  Fingerprint of a run of packaged nodes. A copy-on-write fork records the 
+  fingerprint of the nodes it inherits, so that loading it fails loudly if 
+  the agent it was forked from has rewritten them since (e.g., consolidated
+  or merged into them). 
+  """
+  return hashlib.sha256(
+    json.dumps(nodes, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def load_memory_segments(population: str, 
+                         agent_id: str, 
+                         node_count: Optional[int] = None
+                         ) -> Tuple[List[Dict], Dict[str, List[float]]]: 
+  """
+  Resolves the memory stream stored at <population>/<agent_id>. A 
+  copy-on-write fork only stores the nodes it added itself; its first 
+  base_node_count nodes (and their embeddings) are read from the agent it 
+  was forked from, recursively. Parent folders are only opened when the meta
+  file says the agent has a base segment. 
+
+  Parameters:
+    population: The population of the agent.
+    agent_id: The id of the agent.
+    node_count: If given, only the first node_count nodes are returned. 
+  Returns: 
+    (list of node dictionaries, embeddings dictionary)
+  """
+  agent_folder = f"{POPULATIONS_DIR}/{population}/{agent_id}"
+  with open(f"{agent_folder}/meta.json") as json_file:
+    meta = json.load(json_file)
+  if os.path.exists(f"{agent_folder}/memory_stream/embeddings.npz"): 
+    # Quantized embeddings (see GenerativeAgent.embedding_dtype); int8 ones 
+    # come back only approximately. 
+    from generative_agent.modules.embedding_index import load_embeddings
+    own_embeddings = load_embeddings(
+      f"{agent_folder}/memory_stream/embeddings.npz")
+  else: 
+    with open(f"{agent_folder}/memory_stream/embeddings.json") as json_file:
+      own_embeddings = json.load(json_file)
+  with open(f"{agent_folder}/memory_stream/nodes.json") as json_file:
+    own_nodes = json.load(json_file)
+
+  base_node_count = meta.get("base_node_count", 0)
+  if base_node_count: 
+    nodes, embeddings = load_memory_segments(meta["forked_population"], 
+                                             meta["forked_id"], 
+                                             base_node_count)
+    if len(nodes) < base_node_count: 
+      raise ValueError(f"{population}/{agent_id} was forked from "
+                       f"{meta['forked_population']}/{meta['forked_id']} "
+                       f"with {base_node_count} nodes, but only "
+                       f"{len(nodes)} nodes are stored there.")
+    if (meta.get("base_hash") and meta["base_hash"] != hash_node_segment(
+        [ConceptNode(node).package() for node in nodes])): 
+      raise ValueError(f"{population}/{agent_id} was forked from "
+                       f"{meta['forked_population']}/{meta['forked_id']}, "
+                       f"whose first {base_node_count} nodes have changed "
+                       f"since; flatten() forks before modifying the agent "
+                       f"they were forked from.")
+  else: 
+    nodes, embeddings = [], dict()
+
+  nodes += own_nodes
+  embeddings.update(own_embeddings)
+  if node_count is not None and node_count < len(nodes): 
+    nodes = nodes[:node_count]
+    embeddings = {n["content"]: embeddings[n["content"]] 
+                  for n in nodes if n["content"] in embeddings}
+  return nodes, embeddings
+
+
 # ############################################################################
 # ###                        GENERATIVE AGENT CLASS                        ###
 # ############################################################################
@@ -20,7 +129,40 @@ class GenerativeAgent:
     self.forked_id: str
     self.scratch: Scratch
     self.memory_stream: MemoryStream
+    self.reflection_scheduler: Optional[ReflectionScheduler] = None
+    self.consolidator: Optional[MemoryConsolidator] = None
+
+    # Copy-on-write bookkeeping. The first base_node_count nodes of the 
+    # memory stream are stored by the agent we were forked from; 
+    # persisted_node_count is the number of nodes stored at our own location.
+    # base_hash is the fingerprint of the inherited nodes (see 
+    # hash_node_segment). 
+    self.base_node_count: int = 0
+    self.base_hash: Optional[str] = None
+    self.persisted_node_count: int = 0
+
+    # Storage type of the embeddings, on disk and in the retrieval index: 
+    # "float32" (embeddings.json), or "float16" / "int8" (embeddings.npz). 
+    # The saving is on disk: in memory, the full embeddings are kept for 
+    # rescoring next to the quantized index. Saving as int8 is lossy; after 
+    # a reload, rescoring uses the dequantized int8 vectors (float16 is 
+    # close to lossless). 
+    self.embedding_dtype: str = "float32"
+
+    self.load(population, agent_id)
+
+
+  def load(self, population: str, agent_id: str) -> None: 
+    """
+    Loads the agent stored at <population>/<agent_id>, resolving the memory 
+    segments it shares with the agent it was forked from. 
 
+    Parameters:
+      population: The current population.
+      agent_id: The id of the agent.
+    Returns: 
+      None
+    """
     # The location of the population folder for the agent. 
     agent_folder = f"{POPULATIONS_DIR}/{population}/{agent_id}"
 
@@ -34,21 +176,61 @@ class GenerativeAgent:
       meta = json.load(json_file)
     with open(f"{agent_folder}/scratch.json") as json_file:
       scratch = json.load(json_file)
-    with open(f"{agent_folder}/memory_stream/embeddings.json") as json_file:
-      embeddings = json.load(json_file)
-    with open(f"{agent_folder}/memory_stream/nodes.json") as json_file:
-      nodes = json.load(json_file)
+    nodes, embeddings = load_memory_segments(population, agent_id)
 
     self.population = meta["population"] 
     self.id = meta["id"] 
-    self.forked_population = meta["population"] 
-    self.forked_id = meta["id"]
+    self.forked_population = meta.get("forked_population", meta["population"])
+    self.forked_id = meta.get("forked_id", meta["id"])
+    self.base_node_count = meta.get("base_node_count", 0)
+    self.base_hash = meta.get("base_hash")
+    self.persisted_node_count = len(nodes)
+    self.embedding_dtype = meta.get("embedding_dtype", "float32")
     self.scratch = Scratch(scratch)
     self.memory_stream = MemoryStream(nodes, embeddings)
+    self.memory_stream.embedding_dtype = self.embedding_dtype
+    config = load_population_config(self.population)
+    self.memory_stream.embedding_dimensions = config.get("embedding_dimensions")
+    self.memory_stream.coarse_dim = config.get("coarse_dim")
+    self.memory_stream.dedup = config.get("dedup", self.memory_stream.dedup)
+    self.memory_stream.dedup_similarity = config.get(
+      "dedup_similarity", self.memory_stream.dedup_similarity)
+    self.check_embedding_sizes()
     
     print (f"Loaded {agent_id}:{population}")
 
 
+  def check_embedding_sizes(self) -> None: 
+    """
+    Makes sure the stored embeddings all have the size that new memories 
+    are embedded at (population.json's "embedding_dimensions"), and that 
+    "coarse_dim" fits in them. Relevance is a dot product, so mixing sizes 
+    would only fail later, on the first retrieval or write. A population 
+    whose size changed needs its memories re-embedded first. 
+
+    Raises: 
+      ValueError: if the sizes do not match. 
+    """
+    name = f"{self.population}/{self.id}"
+    sizes = self.memory_stream.embedding_sizes()
+    if len(sizes) > 1: 
+      raise ValueError(f"{name} has embeddings of mixed sizes "
+                       f"{sorted(sizes)}.")
+    stored = sizes.pop() if sizes else None
+    dimensions = self.memory_stream.embedding_dimensions
+    if stored is not None and dimensions is not None and stored != dimensions: 
+      raise ValueError(f"{name} has {stored}-d embeddings, but "
+                       f"population.json sets embedding_dimensions to "
+                       f"{dimensions}; re-embed its memories or remove the "
+                       f"setting.")
+    coarse_dim = self.memory_stream.coarse_dim
+    size = dimensions if dimensions is not None else stored
+    if coarse_dim is not None and size is not None and coarse_dim > size: 
+      raise ValueError(f"population.json sets coarse_dim to {coarse_dim}, "
+                       f"more than the {size} dimensions of {name}'s "
+                       f"embeddings.")
+
+
   def initialize(self, population: str, agent_id: str) -> None: 
     """
     Initializes the agent storage folder and its components files init. The 
@@ -112,10 +294,13 @@ class GenerativeAgent:
     return {"population": self.population,
             "id": self.id,
             "forked_population": self.forked_population,
-            "forked_id": self.forked_id}
+            "forked_id": self.forked_id,
+            "base_node_count": self.base_node_count,
+            "base_hash": self.base_hash,
+            "embedding_dtype": self.embedding_dtype}
 
 
-  def save(self, save_population=None, save_id=None): 
+  def save(self, save_population=None, save_id=None, copy_on_write=False): 
     """
     Given a save_code, save the agents' state in the storage. Right now, the 
     save directory works as follows: 
@@ -125,34 +310,108 @@ class GenerativeAgent:
     a different save code location. Remember that 'init' is the originally
     initialized agent directory.
 
+    With copy_on_write, saving to a new location forks the agent without 
+    copying its memory stream: the new folder references the nodes already 
+    stored at the current location and only stores the nodes added since. 
+    The parent's stored nodes must then be left in place (see flatten()); 
+    loading a fork whose parent has rewritten them raises a ValueError. 
+
     Parameters:
-      save_code: str
+      save_population: str population to save to (defaults to the current)
+      save_id: str agent id to save to (defaults to the current)
+      copy_on_write: bool, fork by reference rather than by full copy
     Returns: 
       None
     """
+    # Pending background reflections and consolidation are committed before 
+    # we serialize. 
+    if self.reflection_scheduler: 
+      self.reflection_scheduler.wait()
+    if self.consolidator: 
+      self.consolidator.wait()
+
     if not save_population: 
       save_population = self.population
     if not save_id: 
       save_id = self.id
-
-    self.forked_population = self.population
-    self.forked_id = self.id
+    forking = (save_population, save_id) != (self.population, self.id)
+
+    # Everything that can fail (working out which nodes to write and 
+    # encoding their embeddings) happens before the agent's state or its 
+    # storage is changed, so a failed save leaves both as they were. 
+    archived = self.memory_stream.take_archived()
+    mutated = self.memory_stream.take_mutated()
+    try: 
+      # Consolidated nodes are appended to the archive of the save location.
+      # Consolidation rewrites the start of the memory stream, so the stream
+      # can no longer share stored nodes with another location. 
+      base_node_count = self.base_node_count
+      if archived: 
+        copy_on_write = False
+        base_node_count = 0
+      if forking: 
+        base_node_count = self.persisted_node_count if copy_on_write else 0
+
+      with self.memory_stream.lock: 
+        # Stored nodes are never patched in place: if a node that would be 
+        # read from the agent we were forked from has changed (e.g., its 
+        # last_retrieved), the full memory stream is written instead. 
+        base_nodes = self.memory_stream.seq_nodes[:base_node_count]
+        if any(node.node_id in mutated for node in base_nodes): 
+          base_node_count = 0
+        base_hash = None
+        if base_node_count: 
+          base_hash = hash_node_segment(
+            [node.package() for node in base_nodes])
+
+        # Only the nodes that are not stored by the agent we were forked 
+        # from are written. 
+        own_nodes = self.memory_stream.seq_nodes[base_node_count:]
+        own_embeddings = {node.content: self.memory_stream.embeddings[node.content]
+                          for node in own_nodes 
+                          if node.content in self.memory_stream.embeddings}
+        node_count = len(self.memory_stream.seq_nodes)
+        sizes = self.memory_stream.embedding_sizes()
+      embeddings_file, embeddings_data = self._encode_embeddings(
+        own_embeddings, max(sizes) if sizes else None)
+    except Exception: 
+      with self.memory_stream.lock: 
+        self.memory_stream.pending_archive[:0] = archived
+        self.memory_stream.mutated_node_ids |= mutated
+      raise
+
+    prev_storage = f"{POPULATIONS_DIR}/{self.population}/{self.id}"
+    if forking: 
+      self.forked_population = self.population
+      self.forked_id = self.id
     self.population = save_population
     self.id = save_id
+    self.base_node_count = base_node_count
+    self.base_hash = base_hash
 
     # Name of the agent and the current save location. 
     storage = f"{POPULATIONS_DIR}/{save_population}/{save_id}"
     create_folder_if_not_there(storage)
     create_folder_if_not_there(f"{storage}/memory_stream")
+    if (storage != prev_storage 
+        and os.path.exists(f"{prev_storage}/memory_stream/archive.jsonl")): 
+      shutil.copyfile(f"{prev_storage}/memory_stream/archive.jsonl", 
+                      f"{storage}/memory_stream/archive.jsonl")
+    append_archive(f"{storage}/memory_stream/archive.jsonl", archived)
     
     # Saving the agent's memory stream. This includes saving the embeddings 
-    # as well as the nodes. 
-    with open(f"{storage}/memory_stream/embeddings.json", "w") as json_file:
-      json.dump(self.memory_stream.embeddings, 
-                json_file)
+    # as well as the nodes. The embeddings file of the other format is 
+    # removed, so that a reload never picks up stale embeddings. 
+    with open(f"{storage}/memory_stream/{embeddings_file}", "wb") as f: 
+      f.write(embeddings_data)
+    for stale in ["embeddings.json", "embeddings.npz"]: 
+      if stale != embeddings_file and os.path.exists(
+          f"{storage}/memory_stream/{stale}"): 
+        os.remove(f"{storage}/memory_stream/{stale}")
     with open(f"{storage}/memory_stream/nodes.json", "w") as json_file:
-      json.dump([node.package() for node in self.memory_stream.seq_nodes], 
+      json.dump([node.package() for node in own_nodes], 
                 json_file, indent=2)
+    self.persisted_node_count = node_count
 
     # Saving the agent's scratch memories. 
     with open(f"{storage}/scratch.json", "w") as json_file:
@@ -165,9 +424,62 @@ class GenerativeAgent:
       json.dump(agent_meta_summary, json_file, indent=2)
 
 
+  def _encode_embeddings(self, 
+                         embeddings: Dict[str, List[float]], 
+                         dimensions: Optional[int] = None
+                         ) -> Tuple[str, bytes]: 
+    """
+    Encodes embeddings in the agent's embedding_dtype: embeddings.json for 
+    float32, or a quantized embeddings.npz. 
+
+    Returns: 
+      (the file name, the encoded file)
+    """
+    if self.embedding_dtype == "float32": 
+      return "embeddings.json", json.dumps(embeddings).encode("utf-8")
+    from generative_agent.modules.embedding_index import encode_embeddings
+    return "embeddings.npz", encode_embeddings(embeddings, 
+                                               self.embedding_dtype, 
+                                               dimensions)
+
+
+  def set_embedding_dtype(self, embedding_dtype: str) -> None: 
+    """
+    Switches the storage type of the embeddings ("float32", "float16" or 
+    "int8"). The retrieval index is rebuilt on the next retrieval, and the 
+    new format is used from the next save on. Saving as "int8" is lossy 
+    (see embedding_dtype). 
+    """
+    from generative_agent.modules.embedding_index import EMBEDDING_DTYPES
+    if embedding_dtype not in EMBEDDING_DTYPES: 
+      raise ValueError(f"Unknown embedding dtype {embedding_dtype!r}; "
+                       f"expected one of {EMBEDDING_DTYPES}.")
+    self.embedding_dtype = embedding_dtype
+    self.memory_stream.embedding_dtype = embedding_dtype
+    self.memory_stream._bump_version()
+
+
+  def flatten(self) -> None: 
+    """
+    Rewrites a copy-on-write fork as a standalone agent that stores its full
+    memory stream, so that the agents it was forked from can be modified or 
+    deleted. The forked_population/forked_id lineage is kept. 
+
+    Parameters:
+      None
+    Returns: 
+      None
+    """
+    self.base_node_count = 0
+    self.save()
+
+
   def remember(self, content: str, time_step: int = 0) -> None: 
     """
-    Add a new observation to the memory stream. 
+    Add a new observation to the memory stream. With dedup set in 
+    population.json, duplicates of existing observations are merged or 
+    skipped (see MemoryStream.ingest) and do not count towards background 
+    reflection. 
 
     Parameters:
       content: The content of the current memory record that we are adding to
@@ -175,25 +487,83 @@ class GenerativeAgent:
     Returns: 
       None
     """
-    self.memory_stream.remember(content, time_step)
+    node, is_new = self.memory_stream.ingest(content, time_step)
+    if self.reflection_scheduler and is_new: 
+      self.reflection_scheduler.observe(node, time_step)
+    if self.consolidator: 
+      self.consolidator.schedule(time_step)
 
 
-  def reflect(self, anchor: str, time_step: int = 0) -> None: 
+  def reflect(self, 
+              anchor: str, 
+              time_step: int = 0, 
+              background: bool = False) -> None: 
     """
     Add a new reflection to the memory stream. 
 
     Parameters:
       anchor: str reflection anchor
       time_step: int entering timestep
+      background: if True and background reflection is enabled, schedule the
+        reflection on the worker pool instead of blocking on it
     Returns: 
       None
     """
-    self.memory_stream.reflect(anchor, time_step)
+    if background and self.reflection_scheduler: 
+      self.reflection_scheduler.schedule(anchor, time_step)
+    else: 
+      self.memory_stream.reflect(anchor, time_step=time_step)
+
+
+  def enable_background_reflection(self, 
+                                   importance_threshold: float = 150, 
+                                   **kwargs) -> ReflectionScheduler: 
+    """
+    Makes the agent reflect automatically in the background whenever the 
+    cumulative importance of its new observations reaches 
+    importance_threshold. 
+
+    Parameters:
+      importance_threshold: the cumulative importance that triggers a 
+        reflection
+      kwargs: other ReflectionScheduler arguments
+    Returns: 
+      The ReflectionScheduler
+    """
+    if self.reflection_scheduler: 
+      self.reflection_scheduler.shutdown()
+    self.reflection_scheduler = ReflectionScheduler(
+      self.memory_stream, importance_threshold, **kwargs)
+    return self.reflection_scheduler
+
+
+  def enable_consolidation(self, 
+                           max_hot_nodes: int = 5000, 
+                           **kwargs) -> MemoryConsolidator: 
+    """
+    Keeps the agent's hot memory stream under max_hot_nodes nodes: whenever
+    a new observation takes it over the cap, old, unimportant and 
+    long-unretrieved observations are summarized in the background, and the
+    originals are moved to <agent folder>/memory_stream/archive.jsonl on the
+    next save. 
+
+    Parameters:
+      max_hot_nodes: the max number of nodes that retrieval scores
+      kwargs: other MemoryConsolidator arguments
+    Returns: 
+      The MemoryConsolidator
+    """
+    if self.consolidator: 
+      self.consolidator.shutdown()
+    self.consolidator = MemoryConsolidator(
+      self.memory_stream, max_hot_nodes, **kwargs)
+    return self.consolidator
 
 
   def utterance(self, 
-                curr_dialogue: List[List[str]], 
-                context: str = "") -> str:
+                curr_dialogue: Union[List[List[str]], DialogueBuffer], 
+                context: str = "", 
+                agent_desc: Optional[str] = None) -> str:
     """
     Given a dialogue of the form, 
       [["Agent 1": "Content..."],
@@ -201,12 +571,15 @@ class GenerativeAgent:
     generate the next agent utterance. 
 
     Parameters:
-      anchor: str reflection anchor
-      time_step: int entering timestep
+      curr_dialogue: the dialogue so far, as a list of rows or a 
+        DialogueBuffer
+      context: str context of the conversation
+      agent_desc: prefetched agent description (see 
+        interaction.utterance_agent_desc); retrieved here if None
     Returns: 
-      None
+      The str utterance
     """
-    ret = utterance(self, curr_dialogue, context)
+    ret = utterance(self, curr_dialogue, context, agent_desc)
     return ret 
 
 
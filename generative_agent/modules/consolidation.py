@@ -0,0 +1,373 @@
+import json
+import threading
+import traceback
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from simulation_engine.settings import *
+from simulation_engine.global_methods import *
+from simulation_engine.gpt_structure import *
+from simulation_engine.llm_json_parser import *
+from generative_agent.modules.memory_stream import ConceptNode, MemoryStream
+
+
+# Default consolidation policy. Once the hot set exceeds
+# CONSOLIDATION_MAX_HOT_NODES nodes, it is brought down to
+# CONSOLIDATION_TARGET_RATIO of that, so consolidation does not rerun on
+# every new memory. Only observations that are at least CONSOLIDATION_MIN_AGE
+# time steps old, were not retrieved for CONSOLIDATION_MIN_IDLE time steps and
+# have an importance of at most CONSOLIDATION_MAX_IMPORTANCE are summarized.
+CONSOLIDATION_MAX_HOT_NODES = 5000
+CONSOLIDATION_TARGET_RATIO = 0.8
+CONSOLIDATION_MIN_AGE = 500
+CONSOLIDATION_MIN_IDLE = 200
+CONSOLIDATION_MAX_IMPORTANCE = 30
+
+# Clusters hold between CONSOLIDATION_MIN_CLUSTER_SIZE and
+# CONSOLIDATION_CLUSTER_SIZE nodes whose embeddings have a cosine similarity
+# of at least CONSOLIDATION_SIMILARITY with the oldest node of the cluster.
+CONSOLIDATION_CLUSTER_SIZE = 8
+CONSOLIDATION_MIN_CLUSTER_SIZE = 3
+CONSOLIDATION_SIMILARITY = 0.5
+CONSOLIDATION_MAX_WORKERS = 4
+
+
+# ##############################################################################
+# ###                          MEMORY CONSOLIDATOR                           ###
+# ##############################################################################
+
+def cluster_candidates(nodes: List[ConceptNode],
+                       embeddings: Dict[str, List[float]],
+                       needed: int,
+                       cluster_size: int = CONSOLIDATION_CLUSTER_SIZE,
+                       min_cluster_size: int = CONSOLIDATION_MIN_CLUSTER_SIZE,
+                       similarity: float = CONSOLIDATION_SIMILARITY
+                       ) -> List[List[ConceptNode]]:
+  """
+  Groups candidate nodes for consolidation. The oldest unassigned node seeds
+  a cluster with the unassigned nodes most similar to it; clusters that stay
+  smaller than min_cluster_size are dropped. If that does not free enough
+  nodes, the leftover candidates are grouped in runs of consecutive nodes,
+  which usually belong to the same episode.
+
+  Parameters:
+    nodes: the candidate nodes, oldest first
+    embeddings: the embeddings of the memory stream, keyed by content
+    needed: the number of nodes to free; a cluster of k nodes frees k - 1
+    cluster_size: the max number of nodes per cluster
+    min_cluster_size: the min number of nodes per cluster
+    similarity: the min cosine similarity of a node to its cluster's seed
+  Returns:
+    List of clusters, each a list of nodes, oldest first
+  """
+  import numpy as np
+  from generative_agent.modules.embedding_index import (
+    normalize_rows, top_k_rows)
+
+  if needed <= 0 or len(nodes) < min_cluster_size:
+    return []
+  rows = normalize_rows([embeddings[node.content] for node in nodes])
+  unassigned = np.ones(len(nodes), dtype=bool)
+
+  clusters = []
+  freed = 0
+  for seed in range(len(nodes)):
+    if freed >= needed:
+      break
+    if not unassigned[seed]:
+      continue
+    sims = rows @ rows[seed]
+    sims[~unassigned] = -np.inf
+    sims[seed] = -np.inf
+    members = [i for i in top_k_rows(sims, cluster_size - 1)
+               if sims[i] >= similarity]
+    if len(members) + 1 < min_cluster_size:
+      continue
+    members = sorted([seed] + members)
+    unassigned[members] = False
+    clusters += [[nodes[i] for i in members]]
+    freed += len(members) - 1
+
+  # Not enough similar memories: fall back to runs of consecutive ones.
+  leftover = [i for i in range(len(nodes)) if unassigned[i]]
+  for start in range(0, len(leftover), cluster_size):
+    if freed >= needed:
+      break
+    run = leftover[start:start + cluster_size]
+    if len(run) < min_cluster_size:
+      break
+    clusters += [[nodes[i] for i in run]]
+    freed += len(run) - 1
+  return clusters
+
+
+class MemoryConsolidator:
+  """
+  Keeps the hot set of a memory stream (the nodes that every retrieval
+  scores) under max_hot_nodes, so retrieval cost stays bounded over long
+  simulations.
+
+  When the hot set is over the cap, old, unimportant, long-unretrieved
+  observations are clustered by similarity and each cluster is replaced by
+  one summary observation whose pointer_id lists the nodes it summarizes.
+  The replaced nodes go to the agent's archive (see
+  GenerativeAgent.save and read_archive), so no memory is lost. Summaries
+  can themselves be consolidated later.
+
+  Reflections and important or recently retrieved observations are never
+  consolidated, so the hot set can stay over the cap if the policy leaves
+  too few candidates. In that case, the next run waits until cluster_size
+  more nodes have been added, rather than replanning on every new memory.
+
+  schedule() runs consolidation on a single background worker, so the
+  clustering, LLM and embedding calls never block the caller; the result
+  is committed in one step (MemoryStream.consolidate_nodes).
+  """
+  def __init__(self,
+               memory_stream: MemoryStream,
+               max_hot_nodes: int = CONSOLIDATION_MAX_HOT_NODES,
+               target_ratio: float = CONSOLIDATION_TARGET_RATIO,
+               min_age: int = CONSOLIDATION_MIN_AGE,
+               min_idle: int = CONSOLIDATION_MIN_IDLE,
+               max_importance: float = CONSOLIDATION_MAX_IMPORTANCE,
+               cluster_size: int = CONSOLIDATION_CLUSTER_SIZE,
+               min_cluster_size: int = CONSOLIDATION_MIN_CLUSTER_SIZE,
+               similarity: float = CONSOLIDATION_SIMILARITY,
+               max_workers: int = CONSOLIDATION_MAX_WORKERS):
+    self.memory_stream = memory_stream
+    self.max_hot_nodes = max_hot_nodes
+    self.target_ratio = target_ratio
+    self.min_age = min_age
+    self.min_idle = min_idle
+    self.max_importance = max_importance
+    self.cluster_size = cluster_size
+    self.min_cluster_size = min_cluster_size
+    self.similarity = similarity
+    self.max_workers = max_workers
+
+    self.executor = ThreadPoolExecutor(max_workers=1,
+                                       thread_name_prefix="consolidation")
+    self.lock = threading.Lock()
+    self.pending_future = None
+    # next_node_id from which consolidation is due again after a run that
+    # could not bring the hot set under the cap.
+    self.retry_node_id = 0
+
+
+  def due(self) -> bool:
+    return (len(self.memory_stream.seq_nodes) > self.max_hot_nodes
+            and self.memory_stream.next_node_id >= self.retry_node_id)
+
+
+  def is_candidate(self, node: ConceptNode, time_step: int) -> bool:
+    return (node.node_type == "observation"
+            and time_step - node.created >= self.min_age
+            and time_step - node.last_retrieved >= self.min_idle
+            and node.importance <= self.max_importance)
+
+
+  def plan(self, time_step: int) -> List[List[ConceptNode]]:
+    """
+    Picks the clusters that bring the hot set down to its target size.
+
+    Parameters:
+      time_step: int current timestep
+    Returns:
+      List of clusters, each a list of nodes
+    """
+    with self.memory_stream.lock:
+      needed = (len(self.memory_stream.seq_nodes)
+                - int(self.max_hot_nodes * self.target_ratio))
+      candidates = [node for node in self.memory_stream.seq_nodes
+                    if self.is_candidate(node, time_step)]
+      embeddings = {node.content: self.memory_stream.embeddings[node.content]
+                    for node in candidates}
+    return cluster_candidates(candidates, embeddings, needed,
+                              self.cluster_size, self.min_cluster_size,
+                              self.similarity)
+
+
+  def prepare(self, clusters: List[List[ConceptNode]]) -> List[Dict[str, Any]]:
+    """
+    Runs the summary and embedding calls of the clusters without touching
+    the memory stream. Clusters whose summary fails are left out.
+
+    Parameters:
+      clusters: clusters as returned by plan
+    Returns:
+      List of pending summary dictionaries to pass to
+      MemoryStream.consolidate_nodes
+    """
+    if not clusters:
+      return []
+    records = [[node.content for node in cluster] for cluster in clusters]
+    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+      summaries = list(executor.map(generate_memory_summary, records))
+
+    done = [(cluster, summary) for cluster, summary in zip(clusters, summaries)
+            if summary]
+    if not done:
+      return []
+    summary_embeddings = get_text_embeddings(
+      [summary for _, summary in done],
+      dimensions=self.memory_stream.embedding_dimensions)
+
+    pending = []
+    for (cluster, summary), embedding in zip(done, summary_embeddings):
+      pending += [{"content": summary,
+                   "importance": max(node.importance for node in cluster),
+                   "embedding": embedding,
+                   "last_retrieved": {node.node_id: node.last_retrieved
+                                      for node in cluster}}]
+    return pending
+
+
+  def consolidate(self, time_step: int) -> List[ConceptNode]:
+    """
+    Consolidates the hot set down to its target size (as far as the policy
+    allows).
+
+    Parameters:
+      time_step: int current timestep
+    Returns:
+      The new summary ConceptNodes
+    """
+    try:
+      pending = self.prepare(self.plan(time_step))
+      return self.memory_stream.consolidate_nodes(time_step, pending)
+    finally:
+      with self.memory_stream.lock:
+        if len(self.memory_stream.seq_nodes) > self.max_hot_nodes:
+          self.retry_node_id = (self.memory_stream.next_node_id
+                                + self.cluster_size)
+
+
+  def schedule(self, time_step: int) -> Optional[Future]:
+    """
+    Schedules a consolidation in the background if one is due and none is
+    already running.
+
+    Parameters:
+      time_step: int current timestep
+    Returns:
+      The Future of the scheduled consolidation, or None
+    """
+    with self.lock:
+      if self.pending_future is not None or not self.due():
+        return None
+      future = self.executor.submit(self._run, time_step)
+      self.pending_future = future
+    future.add_done_callback(self._discard)
+    return future
+
+
+  def _run(self, time_step: int) -> List[ConceptNode]:
+    try:
+      return self.consolidate(time_step)
+    except Exception as e:
+      # As with background reflections, a failure is reported and carried
+      # by the Future without taking down the simulation.
+      print (f"Background consolidation failed: {type(e).__name__}: {e}")
+      if DEBUG:
+        traceback.print_exc()
+      raise
+
+
+  def _discard(self, future: Future) -> None:
+    with self.lock:
+      if self.pending_future is future:
+        self.pending_future = None
+
+
+  def wait(self, timeout: Optional[float] = None) -> None:
+    """
+    Blocks until the scheduled consolidation, if any, has been committed or
+    has failed.
+    """
+    with self.lock:
+      future = self.pending_future
+    if future is not None:
+      wait_futures([future], timeout)
+
+
+  def shutdown(self, wait: bool = True) -> None:
+    self.executor.shutdown(wait=wait)
+
+
+# ##############################################################################
+# ###                                ARCHIVE                                 ###
+# ##############################################################################
+
+def append_archive(path: str, records: List[Dict[str, Any]]) -> None:
+  """
+  Appends archived node records (see MemoryStream.take_archived) to a JSONL
+  archive, one node per line.
+  """
+  if not records:
+    return
+  create_folder_if_not_there(path)
+  with open(path, "a", encoding="utf-8") as f:
+    f.write("".join(json.dumps(record) + "\n" for record in records))
+
+
+def read_archive(path: str,
+                 node_ids: Optional[List[int]] = None
+                 ) -> Iterator[Dict[str, Any]]:
+  """
+  Iterates over the archived node records of a JSONL archive, optionally
+  only those with the given node ids (e.g., the pointer_id of a summary).
+
+  Parameters:
+    path: the JSONL archive file
+    node_ids: if given, only records of these node ids are returned
+  Returns:
+    Iterator of node dictionaries (with their "embedding" and the
+    "archived" time step), oldest first
+  """
+  if not os.path.exists(path):
+    return
+  wanted = set(node_ids) if node_ids is not None else None
+  with open(path, "r", encoding="utf-8") as f:
+    for line in f:
+      record = json.loads(line)
+      if wanted is None or record["node_id"] in wanted:
+        yield record
+
+
+# ##############################################################################
+# ###                              GPT FUNCTIONS                             ###
+# ##############################################################################
+
+def run_gpt_generate_memory_summary(
+  records: List[str],
+  prompt_version: str = "1",
+  gpt_version: str = "GPT4o",
+  verbose: bool = False) -> Tuple[Optional[str], List[Any]]:
+
+  def create_prompt_input(records):
+    records_str = ""
+    for count, r in enumerate(records):
+      records_str += f"Item {str(count+1)}:\n"
+      records_str += f"{r}\n"
+    return [records_str]
+
+  def _get_fail_safe():
+    return None
+
+  prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/memory_stream/consolidation/consolidation_v1.txt"
+
+  prompt_input = create_prompt_input(records)
+  fail_safe = _get_fail_safe()
+
+  output, prompt, prompt_input, fail_safe = chat_safe_generate(
+    prompt_input, prompt_lib_file, gpt_version, 1, fail_safe,
+    verbose=verbose, output_schema=MEMORY_SUMMARY_SCHEMA)
+
+  return output, [output, prompt, prompt_input, fail_safe]
+
+
+def generate_memory_summary(records: List[str]) -> Optional[str]:
+  """Summarize a cluster of related records into one observation."""
+  return run_gpt_generate_memory_summary(records, "1", LLM_VERS)[0]
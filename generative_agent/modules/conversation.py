@@ -0,0 +1,147 @@
+import json
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from simulation_engine.settings import *
+from simulation_engine.global_methods import *
+from generative_agent.modules.interaction import utterance_agent_desc
+from generative_agent.modules.dialogue_buffer import DialogueBuffer
+
+
+# ##############################################################################
+# ###                               DIALOGUE                                 ###
+# ##############################################################################
+
+class Dialogue:
+  def __init__(self,
+               dialogue_id: str,
+               agents: List['GenerativeAgent'],
+               context: str = "",
+               max_turns: int = 20,
+               curr_dialogue: Optional[List[List[str]]] = None,
+               summarize: bool = True):
+    # The agents take turns in the order they are listed.
+    self.dialogue_id = dialogue_id
+    self.agents = agents
+    self.context = context
+    self.max_turns = max_turns
+    self.curr_dialogue = DialogueBuffer(curr_dialogue, summarize)
+    self.end_reason = None
+    # The exception that ended the dialogue, if end_reason is "error".
+    self.error = None
+
+
+# ##############################################################################
+# ###                          CONVERSATION ENGINE                           ###
+# ##############################################################################
+
+def default_is_terminal(dialogue: Dialogue, response: Optional[str]) -> bool:
+  """Ends a dialogue when the utterance failed or an agent says goodbye."""
+  if not response:
+    return True
+  return response.strip().lower().rstrip(".!").endswith("bye")
+
+
+class ConversationEngine:
+  """
+  Runs many agent-to-agent dialogues in parallel.
+
+  Each dialogue runs on its own worker and feeds its curr_dialogue to
+  GenerativeAgent.utterance one turn at a time. While the current speaker's
+  LLM call is in flight, the next speaker's memory retrieval is already
+  running on a separate pool. That retrieval is anchored on the dialogue
+  without the in-flight utterance, trading one turn of anchor freshness for
+  latency (set prefetch=False to disable). Every turn is appended to
+  <transcript_dir>/<dialogue_id>.jsonl as soon as it is generated.
+  """
+  def __init__(self,
+               transcript_dir: Optional[str] = None,
+               max_workers: int = 16,
+               prefetch: bool = True,
+               is_terminal: Callable[[Dialogue, Optional[str]], bool] = None):
+    self.transcript_dir = transcript_dir
+    self.max_workers = max_workers
+    self.prefetch = prefetch
+    self.is_terminal = is_terminal or default_is_terminal
+
+
+  def run(self, dialogues: List[Dialogue]) -> Dict[str, DialogueBuffer]:
+    """
+    Runs the dialogues to completion.
+
+    Parameters:
+      dialogues: the list of Dialogue to run
+    Returns:
+      Dictionary mapping each dialogue_id to its final curr_dialogue. A
+      dialogue that raised keeps the turns generated before the error; its
+      end_reason is "error" and the exception is in Dialogue.error.
+    """
+    if self.transcript_dir:
+      create_folder_if_not_there(f"{self.transcript_dir}/")
+
+    with ThreadPoolExecutor(max_workers=self.max_workers) as dialogue_pool, \
+         ThreadPoolExecutor(max_workers=self.max_workers) as retrieval_pool:
+      futures = [(d, dialogue_pool.submit(self._run_dialogue, d, retrieval_pool))
+                 for d in dialogues]
+      results = dict()
+      for dialogue, future in futures:
+        try:
+          results[dialogue.dialogue_id] = future.result()
+        except Exception as e:
+          # One failed dialogue must not discard the others.
+          print (f"Dialogue {dialogue.dialogue_id} failed: "
+                 f"{type(e).__name__}: {e}")
+          dialogue.end_reason = "error"
+          dialogue.error = e
+          results[dialogue.dialogue_id] = dialogue.curr_dialogue
+      return results
+
+
+  def _run_dialogue(self,
+                    dialogue: Dialogue,
+                    retrieval_pool: ThreadPoolExecutor) -> DialogueBuffer:
+    transcript = None
+    if self.transcript_dir:
+      path = os.path.join(self.transcript_dir, f"{dialogue.dialogue_id}.jsonl")
+      transcript = open(path, "a", encoding="utf-8")
+
+    try:
+      desc_future = None
+      dialogue.end_reason = "max_turns"
+      for turn in range(dialogue.max_turns):
+        speaker = dialogue.agents[turn % len(dialogue.agents)]
+        listener = dialogue.agents[(turn + 1) % len(dialogue.agents)]
+
+        agent_desc = desc_future.result() if desc_future else None
+        desc_future = None
+        if self.prefetch and turn + 1 < dialogue.max_turns:
+          anchor = dialogue.curr_dialogue.anchor(listener.scratch.get_fullname())
+          desc_future = retrieval_pool.submit(
+            utterance_agent_desc, listener, anchor)
+
+        start = time.perf_counter()
+        response = speaker.utterance(dialogue.curr_dialogue,
+                                     dialogue.context, agent_desc)
+        latency = time.perf_counter() - start
+
+        if response:
+          speaker_name = speaker.scratch.get_fullname()
+          dialogue.curr_dialogue.append(speaker_name, response)
+          if transcript:
+            transcript.write(json.dumps({"turn": turn,
+                                         "speaker": speaker_name,
+                                         "utterance": response,
+                                         "latency": round(latency, 3)}) + "\n")
+            transcript.flush()
+
+        if self.is_terminal(dialogue, response):
+          dialogue.end_reason = "terminated" if response else "failed"
+          break
+    finally:
+      if transcript:
+        transcript.close()
+
+    return dialogue.curr_dialogue
@@ -0,0 +1,193 @@
+from typing import List, Tuple, Dict, Any, Optional, Iterator
+
+from simulation_engine.settings import *
+from simulation_engine.gpt_structure import *
+from simulation_engine.llm_json_parser import *
+
+
+# The retrieval anchor covers at most the last DIALOGUE_ANCHOR_TURNS turns
+# and DIALOGUE_ANCHOR_TOKEN_BUDGET (estimated) tokens.
+DIALOGUE_ANCHOR_TURNS = 6
+DIALOGUE_ANCHOR_TOKEN_BUDGET = 400
+
+# With summarization on, at most DIALOGUE_PROMPT_TURNS turns are kept
+# verbatim in the prompt. Older turns are folded into a rolling summary,
+# DIALOGUE_SUMMARIZE_EVERY turns at a time.
+DIALOGUE_PROMPT_TURNS = 20
+DIALOGUE_SUMMARIZE_EVERY = 10
+
+
+# ##############################################################################
+# ###                            DIALOGUE BUFFER                             ###
+# ##############################################################################
+
+class DialogueBuffer:
+  """
+  An append-only dialogue of the form
+    [["Agent 1", "Content..."],
+     ["Agent 2", "Content..."], ... ]
+  that renders each turn once when it is appended. The retrieval anchor is a
+  bounded window over the most recent turns, and (if summarize is on) turns
+  that fall out of the prompt window are folded into a rolling summary, so
+  the per-turn embedding and prompt cost stays flat over long conversations.
+
+  It iterates and indexes like the list of rows, so it can be passed
+  wherever a curr_dialogue list is expected.
+  """
+  def __init__(self,
+               curr_dialogue: Optional[List[List[str]]] = None,
+               summarize: bool = True,
+               anchor_turns: int = DIALOGUE_ANCHOR_TURNS,
+               anchor_token_budget: int = DIALOGUE_ANCHOR_TOKEN_BUDGET,
+               prompt_turns: int = DIALOGUE_PROMPT_TURNS,
+               summarize_every: int = DIALOGUE_SUMMARIZE_EVERY):
+    self.summarize = summarize
+    self.anchor_turns = anchor_turns
+    self.anchor_token_budget = anchor_token_budget
+    self.prompt_turns = prompt_turns
+    self.summarize_every = summarize_every
+
+    self.rows = []
+    self.lines = []
+    self.line_tokens = []
+
+    # The rolling summary covers rows[:summarized_count].
+    self.summary = ""
+    self.summarized_count = 0
+
+    for row in curr_dialogue or []:
+      self._append_row(row[0], row[1])
+    self._maybe_summarize()
+
+
+  def __len__(self) -> int:
+    return len(self.rows)
+
+
+  def __iter__(self) -> Iterator[List[str]]:
+    return iter(self.rows)
+
+
+  def __getitem__(self, index):
+    return self.rows[index]
+
+
+  def _append_row(self, speaker: str, content: str) -> None:
+    line = f"[{speaker}]: {content}\n"
+    self.rows += [[speaker, content]]
+    self.lines += [line]
+    self.line_tokens += [estimate_token_count(line)]
+
+
+  def append(self, speaker: str, content: str) -> None:
+    """
+    Appends a turn to the dialogue.
+
+    Parameters:
+      speaker: the full name of the speaker
+      content: the str utterance
+    Returns:
+      None
+    """
+    self._append_row(speaker, content)
+    self._maybe_summarize()
+
+
+  def _maybe_summarize(self) -> None:
+    """
+    Folds every turn but the last prompt_turns into the rolling summary
+    once summarize_every turns have fallen out of the prompt window. If the
+    summary call fails, the turns stay verbatim and we try again next turn.
+    """
+    if not self.summarize:
+      return
+    fold_end = len(self.rows) - self.prompt_turns
+    if fold_end - self.summarized_count < self.summarize_every:
+      return
+
+    summary = generate_dialogue_summary(
+      self.summary, "".join(self.lines[self.summarized_count:fold_end]))
+    if summary:
+      self.summary = summary
+      self.summarized_count = fold_end
+
+
+  def _window(self, start: int, max_turns: int, token_budget: int) -> str:
+    """Joins the most recent turns after start within the turn and token
+    budgets (the last turn is always included)."""
+    end = len(self.lines)
+    index, tokens = end, 0
+    while index > start and end - index < max_turns:
+      tokens += self.line_tokens[index - 1]
+      if tokens > token_budget and index < end:
+        break
+      index -= 1
+    return "".join(self.lines[index:end])
+
+
+  def anchor(self, speaker: str) -> str:
+    """
+    The retrieval anchor for speaker's next turn: the last anchor_turns
+    turns (within anchor_token_budget), followed by the turn to fill in.
+    """
+    return (self._window(0, self.anchor_turns, self.anchor_token_budget)
+            + f"[{speaker}]: [Fill in]\n")
+
+
+  def to_str(self, speaker: str) -> str:
+    """
+    The dialogue as it goes into the utterance prompt: the rolling summary
+    of older turns, the turns after it, and the turn to fill in.
+    """
+    str_dialogue = ""
+    if self.summary:
+      str_dialogue += f"[Summary of the earlier conversation]: {self.summary}\n"
+    str_dialogue += "".join(self.lines[self.summarized_count:])
+    str_dialogue += f"[{speaker}]: [Fill in]\n"
+    return str_dialogue
+
+
+def as_dialogue_buffer(curr_dialogue) -> DialogueBuffer:
+  """
+  Returns curr_dialogue if it already is a DialogueBuffer. A plain list is
+  wrapped without summarization, so its prompt stays unchanged while the
+  retrieval anchor is still bounded.
+  """
+  if isinstance(curr_dialogue, DialogueBuffer):
+    return curr_dialogue
+  return DialogueBuffer(curr_dialogue, summarize=False)
+
+
+# ##############################################################################
+# ###                              GPT FUNCTIONS                             ###
+# ##############################################################################
+
+def run_gpt_generate_dialogue_summary(
+  summary: str,
+  str_turns: str,
+  prompt_version: str = "1",
+  gpt_version: str = "GPT4o",
+  verbose: bool = False) -> Tuple[str, List[Any]]:
+
+  def create_prompt_input(summary, str_turns):
+    return [summary if summary else "(none yet)", str_turns]
+
+  def _get_fail_safe():
+    return None
+
+  prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/interaction/dialogue_summary/dialogue_summary_v1.txt"
+
+  prompt_input = create_prompt_input(summary, str_turns)
+  fail_safe = _get_fail_safe()
+
+  output, prompt, prompt_input, fail_safe = chat_safe_generate(
+    prompt_input, prompt_lib_file, gpt_version, 1, fail_safe,
+    verbose=verbose, output_schema=DIALOGUE_SUMMARY_SCHEMA)
+
+  return output, [output, prompt, prompt_input, fail_safe]
+
+
+def generate_dialogue_summary(summary: str, str_turns: str) -> Optional[str]:
+  """Fold str_turns into the rolling dialogue summary."""
+  return run_gpt_generate_dialogue_summary(summary, str_turns, "1",
+                                           LLM_VERS)[0]
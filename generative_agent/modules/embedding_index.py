@@ -0,0 +1,555 @@
+import atexit
+import heapq
+import io
+import json
+import multiprocessing
+import threading
+import weakref
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+# ##############################################################################
+# ###                            EMBEDDING INDEX                             ###
+# ##############################################################################
+
+# Storage types of the embedding index and of embeddings.npz. float16 halves
+# and int8 (with one float32 scale per vector) quarters the size of the
+# index and of the file. The memory stream keeps its full embeddings for
+# rescoring, so total memory use does not shrink; only the on-disk size
+# does. Note that on CPUs numpy upcasts float16 slowly, so a float16 index
+# scores slower than a float32 one, while int8 is faster than float16.
+EMBEDDING_DTYPES = ("float32", "float16", "int8")
+
+# Quantized scores are computed on blocks of this many rows at a time, so the
+# float32 upcast never materializes the whole matrix.
+QUANTIZED_BLOCK_ROWS = 8192
+
+
+def quantize(rows: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+  """
+  Quantizes float32 rows to dtype. For int8, each row is scaled by its own
+  max(|x|) / 127, returned as the per-row scales (None otherwise).
+  """
+  if dtype == "float32":
+    return rows.astype(np.float32), None
+  if dtype == "float16":
+    return rows.astype(np.float16), None
+  if dtype == "int8":
+    scales = np.abs(rows).max(axis=1, initial=0) / 127
+    scales = np.where(scales == 0, 1, scales).astype(np.float32)
+    return np.round(rows / scales[:, None]).astype(np.int8), scales
+  raise ValueError(f"Unknown embedding dtype {dtype!r}; "
+                   f"expected one of {EMBEDDING_DTYPES}.")
+
+
+def dequantize(q: np.ndarray, scales: Optional[np.ndarray]) -> np.ndarray:
+  rows = q.astype(np.float32)
+  return rows * scales[:, None] if scales is not None else rows
+
+
+class EmbeddingIndex:
+  """
+  Node-aligned matrix of L2-normalized embeddings, so that the cosine
+  relevance of every node to a focal point is one matrix-vector product.
+  Rows are appended as nodes are added (memory streams are append-only), so
+  syncing after a new memory costs one row.
+
+  With dtype "float16" or "int8" the matrix is stored quantized, and with
+  prefix_dim only the first prefix_dim dimensions of each embedding are
+  kept (renormalized; text-embedding-3 vectors stay meaningful when
+  truncated). In both cases dot() returns approximate relevance, which
+  MemoryStream uses to shortlist candidates before rescoring them on the
+  full embeddings.
+  """
+  def __init__(self, dtype: str = "float32", prefix_dim: Optional[int] = None):
+    quantize(np.zeros((1, 1), np.float32), dtype)
+    self.dtype = dtype
+    self.prefix_dim = prefix_dim
+    self.matrix = None
+    self.scales = None
+    self.count = 0
+    self.node_ids = []
+    self.row_of = dict()
+
+
+  @property
+  def quantized(self) -> bool:
+    return self.dtype != "float32"
+
+
+  @property
+  def approximate(self) -> bool:
+    """Whether dot() only approximates the cosine of the full embeddings."""
+    return self.quantized or self.prefix_dim is not None
+
+
+  def prepare_query(self, query: np.ndarray) -> np.ndarray:
+    """Truncates and renormalizes a normalized full query to prefix_dim."""
+    if self.prefix_dim is None:
+      return query
+    return normalize_query(query[:self.prefix_dim])
+
+
+  def sync(self,
+           seq_nodes: List[Any],
+           embeddings: Dict[str, List[float]]) -> None:
+    """
+    Appends the rows of the nodes in seq_nodes that are not indexed yet. If
+    seq_nodes no longer starts with the indexed nodes, rebuilds the index.
+    """
+    if (self.count > len(seq_nodes)
+        or (self.count and seq_nodes[self.count - 1].node_id != self.node_ids[-1])):
+      self.__init__(self.dtype, self.prefix_dim)
+    new_nodes = seq_nodes[self.count:]
+    if not new_nodes:
+      return
+
+    rows, scales = quantize(normalize_rows(
+      [embeddings[n.content][:self.prefix_dim] for n in new_nodes]), self.dtype)
+
+    if self.matrix is None:
+      capacity = max(len(rows), 64)
+      self.matrix = np.empty((capacity, rows.shape[1]), rows.dtype)
+      self.scales = np.empty(capacity, np.float32) if scales is not None else None
+    elif self.count + len(rows) > len(self.matrix):
+      capacity = max(2 * len(self.matrix), self.count + len(rows))
+      grown = np.empty((capacity, self.matrix.shape[1]), rows.dtype)
+      grown[:self.count] = self.matrix[:self.count]
+      self.matrix = grown
+      if self.scales is not None:
+        grown_scales = np.empty(capacity, np.float32)
+        grown_scales[:self.count] = self.scales[:self.count]
+        self.scales = grown_scales
+    self.matrix[self.count:self.count + len(rows)] = rows
+    if scales is not None:
+      self.scales[self.count:self.count + len(rows)] = scales
+
+    for n in new_nodes:
+      self.row_of[n.node_id] = self.count
+      self.node_ids += [n.node_id]
+      self.count += 1
+
+
+  def rows(self) -> np.ndarray:
+    """The stored rows (quantized if dtype is not float32)."""
+    if self.matrix is None:
+      return np.empty((0, 0), dtype=np.float32)
+    return self.matrix[:self.count]
+
+
+  def dense_rows(self) -> np.ndarray:
+    """The rows as float32 (dequantized if needed)."""
+    if not self.quantized:
+      return self.rows()
+    return dequantize(self.rows(), None if self.scales is None
+                      else self.scales[:self.count])
+
+
+  def dot(self, query: np.ndarray) -> np.ndarray:
+    """
+    Dot product of every row with a normalized query: the exact cosine for
+    float32, an approximation for the quantized dtypes.
+    """
+    if not self.quantized:
+      return self.rows() @ query
+    out = np.empty(self.count, dtype=np.float32)
+    for start in range(0, self.count, QUANTIZED_BLOCK_ROWS):
+      end = min(start + QUANTIZED_BLOCK_ROWS, self.count)
+      out[start:end] = self.matrix[start:end].astype(np.float32) @ query
+      if self.scales is not None:
+        out[start:end] *= self.scales[start:end]
+    return out
+
+
+def normalize_rows(rows: List[List[float]]) -> np.ndarray:
+  rows = np.asarray(rows, dtype=np.float32)
+  norms = np.linalg.norm(rows, axis=1, keepdims=True)
+  return rows / np.where(norms == 0, 1, norms)
+
+
+def encode_embeddings(embeddings: Dict[str, List[float]],
+                      dtype: str,
+                      dimensions: Optional[int] = None) -> bytes:
+  """
+  Encodes a content -> embedding dictionary as a compressed .npz holding the
+  contents (as one JSON string), the quantized vectors and, for int8, the
+  per-vector scales. float16 keeps about three significant digits; int8
+  is lossy (see load_embeddings). An empty dictionary is stored as zero
+  rows of the given dimensions.
+  """
+  contents = list(embeddings.keys())
+  if contents:
+    vectors = np.asarray([embeddings[c] for c in contents], dtype=np.float32)
+  else:
+    vectors = np.empty((0, dimensions or 0), dtype=np.float32)
+  q, scales = quantize(vectors, dtype)
+  arrays = {"contents": np.array(json.dumps(contents)), "vectors": q}
+  if scales is not None:
+    arrays["scales"] = scales
+  buffer = io.BytesIO()
+  np.savez_compressed(buffer, **arrays)
+  return buffer.getvalue()
+
+
+def save_embeddings(path: str,
+                    embeddings: Dict[str, List[float]],
+                    dtype: str,
+                    dimensions: Optional[int] = None) -> None:
+  """Saves embeddings as an .npz (see encode_embeddings)."""
+  data = encode_embeddings(embeddings, dtype, dimensions)
+  with open(path, "wb") as f:
+    f.write(data)
+
+
+def load_embeddings(path: str) -> Dict[str, List[float]]:
+  """
+  Loads an .npz written by save_embeddings, dequantized to floats. int8
+  storage is lossy: the vectors only approximate the saved ones.
+  """
+  with np.load(path) as data:
+    contents = json.loads(str(data["contents"]))
+    vectors = dequantize(data["vectors"],
+                         data["scales"] if "scales" in data else None)
+  return {content: vector.tolist() for content, vector in zip(contents, vectors)}
+
+
+def normalize_query(embedding: List[float]) -> np.ndarray:
+  q = np.asarray(embedding, dtype=np.float32)
+  norm = np.linalg.norm(q)
+  return q / norm if norm else q
+
+
+def normalize_array(x: np.ndarray, mask: np.ndarray) -> np.ndarray:
+  """
+  Min-max normalizes x to [0, 1] over the entries selected by mask (as
+  normalize_dict_floats does); entries outside mask are left unchanged.
+  """
+  out = x.copy()
+  if not mask.any():
+    return out
+  lo, hi = x[mask].min(), x[mask].max()
+  out[mask] = 0.5 if hi == lo else (x[mask] - lo) / (hi - lo)
+  return out
+
+
+def combine_scores(recency: np.ndarray,
+                   importance: np.ndarray,
+                   relevance: np.ndarray,
+                   hp: List[float]) -> np.ndarray:
+  """Weighted retrieval score; nodes outside the filter carry NaN and end
+  up at -inf."""
+  score = hp[0] * recency + hp[1] * relevance + hp[2] * importance
+  return np.where(np.isnan(score), -np.inf, score)
+
+
+def top_k_rows(score: np.ndarray, k: int) -> List[int]:
+  """Row indices of the k highest finite scores, highest first."""
+  k = min(k, int(np.isfinite(score).sum()))
+  if k <= 0:
+    return []
+  top = np.argpartition(-score, k - 1)[:k]
+  return [int(i) for i in top[np.argsort(-score[top], kind="stable")]]
+
+
+# ##############################################################################
+# ###                           SHARDED RETRIEVAL                            ###
+# ##############################################################################
+
+# Shared memory blocks attached by this (worker) process, by name.
+_attached = dict()
+
+
+def _attach(spec: Tuple[str, Tuple[int, ...], str]) -> np.ndarray:
+  name, shape, dtype = spec
+  if name not in _attached:
+    block = shared_memory.SharedMemory(name=name)
+    _attached[name] = (block, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+  return _attached[name][1]
+
+
+def _release_stale(live_names: List[str]) -> None:
+  for name in list(_attached):
+    if name not in live_names:
+      _attached.pop(name)[0].close()
+
+
+def _shard_relevance(specs: Dict[str, Tuple],
+                     query: np.ndarray,
+                     start: int,
+                     end: int) -> Tuple[float, float]:
+  """
+  Phase 1: writes the cosine relevance of rows [start, end) into the shared
+  relevance array and returns its (min, max) over the filtered rows.
+  """
+  _release_stale([spec[0] for spec in specs.values()])
+  matrix, recency, relevance = (_attach(specs[key]) for key in
+                                ("matrix", "recency", "relevance"))
+  relevance[start:end] = matrix[start:end] @ query
+  mask = ~np.isnan(recency[start:end])
+  if not mask.any():
+    return np.inf, -np.inf
+  shard = relevance[start:end][mask]
+  return float(shard.min()), float(shard.max())
+
+
+def _shard_top_k(specs: Dict[str, Tuple],
+                 start: int,
+                 end: int,
+                 rel_range: Tuple[float, float],
+                 hp: List[float],
+                 k: int) -> List[Tuple[float, int, float]]:
+  """
+  Phase 2: scores rows [start, end) with the globally normalized relevance
+  and returns the shard's top k as (score, row, normalized relevance).
+  """
+  recency, importance, relevance = (_attach(specs[key])[start:end] for key in
+                                    ("recency", "importance", "relevance"))
+  lo, hi = rel_range
+  rel = np.full_like(relevance, 0.5) if hi == lo else (relevance - lo) / (hi - lo)
+  score = combine_scores(recency, importance, rel, hp)
+  return [(float(score[i]), start + i, float(rel[i]))
+          for i in top_k_rows(score, k)]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# Live scorers, whose shared memory is released at exit.
+_scorers = weakref.WeakSet()
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+  """
+  Returns the shared worker pool. Workers are started from a fork server
+  (or spawned where there is none) rather than forked from this process:
+  forking while another thread holds a lock can deadlock the worker.
+  """
+  global _pool
+  with _pool_lock:
+    if _pool is None or _pool._max_workers != workers:
+      if _pool is not None:
+        _pool.shutdown()
+      method = ("forkserver" if "forkserver" in multiprocessing.get_all_start_methods()
+                else "spawn")
+      _pool = ProcessPoolExecutor(max_workers=workers,
+                                  mp_context=multiprocessing.get_context(method))
+    return _pool
+
+
+@atexit.register
+def _shutdown_sharded_retrieval() -> None:
+  for scorer in list(_scorers):
+    scorer.close()
+  with _pool_lock:
+    if _pool is not None:
+      _pool.shutdown()
+
+
+class ShardedScorer:
+  """
+  Scores one memory stream across worker processes. The embedding matrix
+  and the per-query recency, importance and relevance columns live in
+  shared memory; each worker scores a contiguous shard of rows and returns
+  its partial top-k, which are merged into the global top n_count.
+
+  Relevance is min-max normalized over all filtered nodes, so scoring runs
+  in two phases: the shards first report their relevance range, then rank
+  their rows with the global range.
+  """
+  def __init__(self, workers: int):
+    self.workers = workers
+    self.lock = threading.Lock()
+    self.blocks = dict()
+    self.synced_count = 0
+    self.synced_matrix = None
+    _scorers.add(self)
+
+
+  def _block(self, key: str, shape: Tuple[int, ...]) -> np.ndarray:
+    """Returns the shared array for key, reallocating it if it is too small."""
+    block, array = self.blocks.get(key, (None, None))
+    if array is None or array.shape[0] < shape[0] or array.shape[1:] != shape[1:]:
+      if block is not None:
+        block.close()
+        block.unlink()
+      capacity = (max(shape[0], 2 * (array.shape[0] if array is not None else 0)),) + shape[1:]
+      size = int(np.prod(capacity)) * np.dtype(np.float32).itemsize
+      block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+      array = np.ndarray(capacity, dtype=np.float32, buffer=block.buf)
+      self.blocks[key] = (block, array)
+      if key == "matrix":
+        self.synced_count = 0
+    return array
+
+
+  def _spec(self, key: str) -> Tuple[str, Tuple[int, ...], str]:
+    block, array = self.blocks[key]
+    return (block.name, array.shape, "float32")
+
+
+  def score(self,
+            index: EmbeddingIndex,
+            query: np.ndarray,
+            recency: np.ndarray,
+            importance: np.ndarray,
+            hp: List[float],
+            n_count: int) -> List[Tuple[float, int, float]]:
+    """
+    Returns the top n_count (score, row, normalized relevance) over the
+    index. recency and importance are normalized per-row columns, with NaN
+    for rows outside the retrieval filter.
+    """
+    with self.lock:
+      n = index.count
+      matrix = self._block("matrix", (n, index.matrix.shape[1]))
+      if self.synced_matrix is not index.matrix or self.synced_count > n:
+        self.synced_count = 0
+      matrix[self.synced_count:n] = index.matrix[self.synced_count:n]
+      self.synced_count, self.synced_matrix = n, index.matrix
+
+      self._block("recency", (n,))[:n] = recency
+      self._block("importance", (n,))[:n] = importance
+      self._block("relevance", (n,))
+      specs = {key: self._spec(key) for key in self.blocks}
+
+      pool = _get_pool(self.workers)
+      step = -(-n // self.workers)
+      shards = [(start, min(start + step, n)) for start in range(0, n, step)]
+
+      ranges = list(pool.map(_shard_relevance, [specs] * len(shards),
+                             [query] * len(shards), *zip(*shards)))
+      rel_range = (min(r[0] for r in ranges), max(r[1] for r in ranges))
+      partials = pool.map(_shard_top_k, [specs] * len(shards), *zip(*shards),
+                          [rel_range] * len(shards), [hp] * len(shards),
+                          [n_count] * len(shards))
+      # Ties go to the earlier node, as in the in-process ranking.
+      return heapq.nlargest(n_count, (hit for partial in partials
+                                      for hit in partial),
+                            key=lambda hit: (hit[0], -hit[1]))
+
+
+  def close(self) -> None:
+    for block, _ in self.blocks.values():
+      block.close()
+      block.unlink()
+    self.blocks = dict()
+
+
+# ##############################################################################
+# ###                               BENCHMARKS                               ###
+# ##############################################################################
+
+def _synthetic_embeddings(node_count: int, dim: int, seed: int = 0) -> np.ndarray:
+  """Clustered unit vectors, closer to real text embeddings than pure noise."""
+  rng = np.random.default_rng(seed)
+  centers = rng.standard_normal((max(node_count // 50, 1), dim))
+  rows = (centers[rng.integers(0, len(centers), node_count)]
+          + 0.5 * rng.standard_normal((node_count, dim)))
+  return normalize_rows(rows)
+
+
+class _BenchmarkNode:
+  def __init__(self, node_id):
+    self.node_id, self.content = node_id, str(node_id)
+
+
+def _measure_recall(index: EmbeddingIndex,
+                    rows: np.ndarray,
+                    queries: np.ndarray,
+                    k: int,
+                    shortlist: int) -> Dict[str, float]:
+  """
+  Syncs index on rows and measures its recall@k against exact cosine, alone
+  and after rescoring a shortlist on the full rows, with the per-query
+  scoring time and index size.
+  """
+  import time
+
+  nodes = [_BenchmarkNode(i) for i in range(len(rows))]
+  index.sync(nodes, {n.content: rows[n.node_id] for n in nodes})
+  exact = [set(top_k_rows(rows @ q, k)) for q in queries]
+
+  recall = rescored = 0
+  start = time.perf_counter()
+  for q, truth in zip(queries, exact):
+    approx = index.dot(index.prepare_query(q))
+    recall += len(truth & set(top_k_rows(approx, k))) / k
+    candidates = top_k_rows(approx, shortlist)
+    best = top_k_rows(rows[candidates] @ q, k)
+    rescored += len(truth & {candidates[i] for i in best}) / k
+  elapsed = time.perf_counter() - start
+  size = index.rows().nbytes + (index.scales[:index.count].nbytes
+                                if index.scales is not None else 0)
+  return {"recall": recall / len(queries),
+          "rescored_recall": rescored / len(queries),
+          "ms_per_query": elapsed / len(queries) * 1e3,
+          "mb": size / 1e6}
+
+
+def _print_recall(name: str, result: Dict[str, float], k: int) -> None:
+  print (f"{name}: recall@{k} {result['recall']:.3f}, "
+         f"rescored {result['rescored_recall']:.3f}, "
+         f"{result['ms_per_query']:.2f} ms/query, {result['mb']:.1f} MB")
+
+
+def benchmark_quantized_recall(node_count: int = 20000,
+                               dim: int = 1536,
+                               query_count: int = 50,
+                               k: int = 10,
+                               shortlist: int = 50) -> Dict[str, Dict[str, float]]:
+  """
+  Measures recall@k of the quantized index against exact cosine, both for
+  the quantized scores alone and after rescoring a shortlist of the given
+  size at full precision, with the per-query scoring time and index size.
+
+  Returns:
+    Dictionary mapping each dtype to its recall, rescored recall, ms/query
+    and MB.
+  """
+  rows = _synthetic_embeddings(node_count, dim)
+  queries = _synthetic_embeddings(query_count, dim, seed=1)
+  results = dict()
+  for dtype in EMBEDDING_DTYPES:
+    results[dtype] = _measure_recall(EmbeddingIndex(dtype), rows, queries,
+                                     k, shortlist)
+    _print_recall(dtype, results[dtype], k)
+  return results
+
+
+def benchmark_coarse_to_fine(node_count: int = 20000,
+                             dim: int = 1536,
+                             query_count: int = 50,
+                             k: int = 10,
+                             shortlist: int = 50,
+                             prefix_dims: Tuple[int, ...] = (128, 256, 512)
+                             ) -> Dict[int, Dict[str, float]]:
+  """
+  Measures recall@k of coarse indexes over the first prefix_dim dimensions
+  of each embedding against exact cosine, alone and after rescoring a
+  shortlist on the full embeddings. The synthetic embeddings spread their
+  information evenly over the dimensions; text-embedding-3 embeddings are
+  trained to front-load it, so their coarse recall is higher.
+
+  Returns:
+    Dictionary mapping each prefix_dim (and dim, for the full index) to its
+    recall, rescored recall, ms/query and MB.
+  """
+  rows = _synthetic_embeddings(node_count, dim)
+  queries = _synthetic_embeddings(query_count, dim, seed=1)
+  results = dict()
+  for prefix_dim in list(prefix_dims) + [dim]:
+    index = EmbeddingIndex(prefix_dim=prefix_dim if prefix_dim < dim else None)
+    results[prefix_dim] = _measure_recall(index, rows, queries, k, shortlist)
+    _print_recall(f"{prefix_dim}-d", results[prefix_dim], k)
+  return results
+
+
+if __name__ == '__main__':
+  benchmark_quantized_recall()
+  benchmark_coarse_to_fine()
@@ -1,8 +1,9 @@
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Optional, Union
 from simulation_engine.settings import * 
 from simulation_engine.global_methods import *
 from simulation_engine.gpt_structure import *
 from simulation_engine.llm_json_parser import *
+from generative_agent.modules.dialogue_buffer import *
 
 
 def _utterance_agent_desc(agent: 'GenerativeAgent', anchor: str) -> str: 
@@ -74,9 +75,6 @@ def run_gpt_generate_utterance(
     context: str) -> List[str]:
     return [agent_desc, context, str_dialogue]
 
-  def _func_clean_up(gpt_response: str, prompt: str = "") -> str:
-    return extract_first_json_dict(gpt_response)["utterance"]
-
   def _get_fail_safe() -> None:
     return None
 
@@ -93,21 +91,32 @@ def run_gpt_generate_utterance(
   # Generate the utterance using the chat_safe_generate function
   output, prompt, prompt_input, fail_safe = chat_safe_generate(
     prompt_input, prompt_lib_file, gpt_version, 1, fail_safe, 
-    _func_clean_up, verbose)
+    verbose=verbose, output_schema=UTTERANCE_SCHEMA)
 
   return output, [output, prompt, prompt_input, fail_safe]
 
 
+def utterance_agent_desc(agent: 'GenerativeAgent', anchor: str) -> str:
+  """
+  Run the retrieval half of utterance() on its own, so that a caller can 
+  compute it ahead of time and pass it back in as agent_desc. 
+  """
+  return _utterance_agent_desc(agent, anchor)
+
+
 def utterance(agent: 'GenerativeAgent', 
-              curr_dialogue: List[List[str]], 
-              context: str) -> str:
+              curr_dialogue: Union[List[List[str]], DialogueBuffer], 
+              context: str,
+              agent_desc: Optional[str] = None) -> str:
   """Generate an utterance for the agent based on the current dialogue and 
-     context."""
-  str_dialogue = "".join(f"[{row[0]}]: {row[1]}\n" for row in curr_dialogue)
-  str_dialogue += f"[{agent.scratch.get_fullname()}]: [Fill in]\n"
-
-  anchor = str_dialogue
-  agent_desc = _utterance_agent_desc(agent, anchor)
+     context. agent_desc can be passed in if it was prefetched. Pass a 
+     DialogueBuffer to keep the prompt bounded over long conversations."""
+  buffer = as_dialogue_buffer(curr_dialogue)
+  str_dialogue = buffer.to_str(agent.scratch.get_fullname())
+
+  if agent_desc is None: 
+    anchor = buffer.anchor(agent.scratch.get_fullname())
+    agent_desc = _utterance_agent_desc(agent, anchor)
   return run_gpt_generate_utterance(
            agent_desc, str_dialogue, context, "1", LLM_VERS)[0]
 
@@ -1,14 +1,68 @@
-from typing import List, Dict, Any, Tuple, Union, Optional
+from typing import List, Dict, Any, Set, Tuple, Union, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import random
 import string
-
-from numpy import dot
-from numpy.linalg import norm
+import threading
 
 from simulation_engine.settings import * 
 from simulation_engine.global_methods import *
 from simulation_engine.gpt_structure import *
 from simulation_engine.llm_json_parser import *
+from generative_agent.modules.retrieval_log import get_retrieval_log
+
+
+# Importance scoring: estimated record tokens per batched prompt, max records
+# per batch, and the number of batches scored concurrently. 
+IMPORTANCE_BATCH_TOKEN_BUDGET = 1500
+IMPORTANCE_BATCH_MAX_ITEMS = 25
+IMPORTANCE_MAX_WORKERS = 4
+
+# Number of (focal point, filter, hp, n_count) retrieval results cached per 
+# memory stream. 
+RETRIEVAL_CACHE_SIZE = 256
+
+# Retrievals over at least SHARDED_RETRIEVAL_MIN_NODES nodes are scored on 
+# the embedding index across SHARDED_RETRIEVAL_WORKERS processes; smaller ones
+# are scored in-process, where the pool round trip would cost more than it 
+# saves. 
+SHARDED_RETRIEVAL_MIN_NODES = 50000
+SHARDED_RETRIEVAL_WORKERS = 4
+
+# With an approximate embedding index (quantized, or over a coarse prefix of
+# each embedding), retrieval shortlists the top 
+# max(n_count * SHORTLIST_FACTOR, SHORTLIST_MIN) nodes on the approximate 
+# scores and rescores them on the full embeddings. 
+SHORTLIST_FACTOR = 4
+SHORTLIST_MIN = 50
+
+# Ingest-time deduplication (see MemoryStream.ingest), opt-in through 
+# population.json: "merge" folds a duplicate observation into the existing 
+# node, "skip" drops it, and None (the default) adds it as a new node. An 
+# observation is a near-duplicate if the cosine similarity of its embedding 
+# to an existing observation is at least DEDUP_SIMILARITY. A merge raises 
+# the importance of the existing node by DEDUP_IMPORTANCE_BUMP (up to 
+# DEDUP_MAX_IMPORTANCE). Streams with fewer than DEDUP_INDEX_MIN_NODES nodes
+# and no embedding index yet are scanned directly rather than indexed. 
+DEDUP_MODE = None
+DEDUP_SIMILARITY = 0.95
+DEDUP_IMPORTANCE_BUMP = 5
+DEDUP_MAX_IMPORTANCE = 100
+DEDUP_CANDIDATES = 5
+DEDUP_INDEX_MIN_NODES = 1000
+
+# LRU cache of importance scores keyed by content hash, holding at most 
+# IMPORTANCE_CACHE_SIZE scores. Shared across agents, since the score only 
+# depends on the content of the record. 
+IMPORTANCE_CACHE_SIZE = 10000
+_importance_cache = OrderedDict()
+_importance_cache_lock = threading.Lock()
+
+
+def content_hash(content: str) -> str:
+  """Returns the sha256 hex digest of a str memory content."""
+  return hashlib.sha256(content.encode("utf-8")).hexdigest()
 
 
 def cos_sim(a: List[float], b: List[float]) -> float:
@@ -30,6 +84,9 @@ def cos_sim(a: List[float], b: List[float]) -> float:
     >>> b = [0.2, 0.2, 0.5]
     >>> cos_sim(a, b)
   """
+  from numpy import dot
+  from numpy.linalg import norm
+
   return dot(a, b)/(norm(a)*norm(b))
 
 
@@ -136,6 +193,67 @@ class ConceptNode:
     return curr_package
 
 
+# ##############################################################################
+# ###                            RETRIEVAL CACHE                             ###
+# ##############################################################################
+
+class RetrievalCache: 
+  """
+  LRU cache of retrieval results, keyed by (focal point, filter, hp, 
+  n_count, memory stream version). Keeps hit/miss counts for monitoring. 
+  """
+  def __init__(self, max_size: int = RETRIEVAL_CACHE_SIZE): 
+    self.max_size = max_size
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.invalidations = 0
+
+
+  def get(self, key: Tuple) -> Optional[List[ConceptNode]]: 
+    with self.lock: 
+      if key in self.entries: 
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return list(self.entries[key])
+      self.misses += 1
+      return None
+
+
+  def put(self, key: Tuple, nodes: List[ConceptNode]) -> None: 
+    if self.max_size <= 0: 
+      return
+    with self.lock: 
+      self.entries[key] = list(nodes)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_size: 
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+
+  def clear(self) -> None: 
+    with self.lock: 
+      if self.entries: 
+        self.invalidations += 1
+      self.entries.clear()
+
+
+  def stats(self) -> Dict[str, float]: 
+    """
+    Returns the cache counters and the hit rate over all lookups so far.
+    """
+    with self.lock: 
+      lookups = self.hits + self.misses
+      return {"size": len(self.entries), 
+              "hits": self.hits, 
+              "misses": self.misses, 
+              "evictions": self.evictions, 
+              "invalidations": self.invalidations, 
+              "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
 # ##############################################################################
 # ###                             MEMORY STREAM                              ###
 # ##############################################################################
@@ -154,6 +272,57 @@ class MemoryStream:
 
     self.embeddings = embeddings
 
+    # Node ids are never reused, including the ids of archived nodes. The 
+    # newest node is never archived without adding a newer summary node, so 
+    # the highest id is always in the hot set. 
+    self.next_node_id = max(self.id_to_node, default=-1) + 1
+    # Nodes taken out of the hot set by consolidate_nodes, as packaged node 
+    # dictionaries with their embedding, until they are written to the 
+    # archive (see take_archived). 
+    self.pending_archive = []
+    # Ids of the nodes changed in place (e.g., their last_retrieved) since 
+    # the last save (see take_mutated). 
+    self.mutated_node_ids = set()
+
+    # Node id of each content hash, for exact-duplicate detection at ingest. 
+    self.node_by_hash = {content_hash(node.content): node.node_id 
+                         for node in self.seq_nodes}
+    self.dedup = DEDUP_MODE
+    self.dedup_similarity = DEDUP_SIMILARITY
+    self.dedup_counts = {"exact": 0, "near": 0}
+
+    # Guards seq_nodes, id_to_node and embeddings so that nodes committed by 
+    # a background reflection never interleave with another writer or with a
+    # retrieval that is snapshotting the nodes. 
+    self.lock = threading.RLock()
+
+    # Incremented whenever the nodes change in a way that affects retrieval.
+    self.version = 0
+    self.retrieval_cache = RetrievalCache()
+
+    # Node-aligned embedding matrix for vectorized relevance scoring, and 
+    # the process-pool scorer for very large streams (both built lazily). 
+    self.index = None
+    self.sharded_scorer = None
+    self.shard_min_nodes = SHARDED_RETRIEVAL_MIN_NODES
+    self.shard_workers = SHARDED_RETRIEVAL_WORKERS
+    # Storage type of the embedding index: "float32", "float16" or "int8". 
+    # A quantized index is an extra, smaller copy that is faster to scan; 
+    # candidates are rescored on self.embeddings, so it does not reduce 
+    # memory use. 
+    self.embedding_dtype = "float32"
+    # Dimensions requested for new embeddings (None for the model's full 
+    # size), and, for coarse-to-fine retrieval, the prefix of each embedding
+    # kept in the index (None to index full embeddings). 
+    self.embedding_dimensions = None
+    self.coarse_dim = None
+
+
+  def embedding_sizes(self) -> Set[int]: 
+    """The distinct sizes of the stored embeddings (empty if there are none)."""
+    with self.lock: 
+      return {len(embedding) for embedding in self.embeddings.values()}
+
 
   def count_observations(self) -> int:
     """
@@ -172,11 +341,46 @@ class MemoryStream:
     return count
 
 
+  def filter_nodes(self, curr_filter: str = "all") -> Tuple[List[ConceptNode], int]:
+    """
+    Snapshots the nodes of the desired node type. curr_filter can be one of 
+    the three elements: 'all', 'reflection', 'observation' 
+
+    Returns: 
+      (the filtered nodes, the memory stream version they were taken at)
+    """
+    curr_nodes = []
+    with self.lock: 
+      if curr_filter == "all": 
+        curr_nodes = list(self.seq_nodes)
+      else: 
+        for curr_node in self.seq_nodes: 
+          if curr_node.node_type == curr_filter: 
+            curr_nodes += [curr_node]
+      return curr_nodes, self.version
+
+
+  def mark_retrieved(self, 
+                     retrieved: Dict[str, List[ConceptNode]], 
+                     time_step: int) -> None: 
+    """
+    Updates the last retrieved time_step of the retrieved nodes. This 
+    changes future recency scores, so it invalidates the retrieval cache. 
+    """
+    with self.lock: 
+      for master_nodes in retrieved.values(): 
+        for n in master_nodes: 
+          n.last_retrieved = time_step
+          self.mutated_node_ids.add(n.node_id)
+      self._bump_version()
+
+
   def retrieve(self, focal_points: List[str], time_step: int, 
        n_count: int = 10,  curr_filter: str = "all", 
        hp: List[float] = [0.5, 3, 0.5], stateless: bool = True, 
        verbose: bool = False, 
-       record_json: Optional[str] = None) -> Dict[str, List[ConceptNode]]:
+       record_json: Optional[str] = None, 
+       audit_log: Optional[str] = None) -> Dict[str, List[ConceptNode]]:
     """
     Retrieve relevant nodes from the memory stream based on given focal points.
 
@@ -190,7 +394,7 @@ class MemoryStream:
        a. Calculate recency, importance, and relevance scores for each node
        b. Combine these scores to get a master score for each node
        c. Select the top n_count nodes based on their master scores
-    3. Optionally record the results to a JSON file
+    3. Optionally record the results to a JSON file and/or a JSONL audit log
     4. Return the retrieved nodes for each focal point
 
     :param focal_points: List of strings to focus the memory retrieval on
@@ -203,46 +407,68 @@ class MemoryStream:
     :param stateless: If False, update the last_retrieved time of returned 
       nodes
     :param verbose: If True, print detailed scoring information
-    :param record_json: Optional file path to record retrieval results
+    :param record_json: Optional JSON file path to record retrieval results 
+      (a dictionary mapping each focal point to the retrieved contents)
+    :param audit_log: Optional JSONL file path; one record per focal point 
+      (focal point, time step, node ids and score breakdowns) is appended 
+      through a buffered RetrievalAuditLog
     :return: Dictionary mapping each focal point to a list of retrieved 
       ConceptNodes
     """
-    curr_nodes = []
-
-    # Filtering for the desired node type. curr_filter can be one of the three
-    # elements: 'all', 'reflection', 'observation' 
-    if curr_filter == "all": 
-      curr_nodes = self.seq_nodes
-    else: 
-      for curr_node in self.seq_nodes: 
-        if curr_node.node_type == curr_filter: 
-          curr_nodes += [curr_node]
+    # A background consolidation can remove nodes and their embeddings 
+    # while we score, so scoring reads from this snapshot. 
+    with self.lock: 
+      curr_nodes, version = self.filter_nodes(curr_filter)
+      id_to_node = {node.node_id: node for node in curr_nodes}
+      embeddings = None
+      if not self._use_index(curr_nodes): 
+        embeddings = {node.content: self.embeddings[node.content] 
+                      for node in curr_nodes}
 
     # <retrieved> is the main dictionary that we are returning
     retrieved = dict() 
+    # <scores> maps each focal point to the score breakdown of its nodes 
+    # (None for cache hits), for the audit log. 
+    scores = dict()
     for focal_pt in focal_points: 
+      # Identical queries against an unchanged memory stream return the 
+      # same nodes, so they are served from the retrieval cache. 
+      cache_key = self.cache_key(focal_pt, curr_filter, hp, n_count, version)
+      master_nodes = self.retrieval_cache.get(cache_key)
+      if master_nodes is not None: 
+        retrieved[focal_pt] = master_nodes
+        scores[focal_pt] = None
+        continue
+
       # Calculating the component dictionaries and normalizing them.
       x = extract_recency(curr_nodes)
       recency_out = normalize_dict_floats(x, 0, 1)
       x = extract_importance(curr_nodes)
       importance_out = normalize_dict_floats(x, 0, 1)  
-      x = extract_relevance(curr_nodes, self.embeddings, focal_pt)
-      relevance_out = normalize_dict_floats(x, 0, 1)
+      recency_w = hp[0]
+      relevance_w = hp[1]
+      importance_w = hp[2]
+
+      if embeddings is None: 
+        # Relevance and the final scores are computed on the embedding 
+        # index; only the top n_count nodes come back. 
+        relevance_out, master_out = self._score_with_index(
+          curr_nodes, recency_out, importance_out, focal_pt, hp, n_count)
+      else: 
+        x = extract_relevance(curr_nodes, embeddings, focal_pt)
+        relevance_out = normalize_dict_floats(x, 0, 1)
       
-      # Computing the final scores that combines the component values. 
-      master_out = dict()
-      for key in recency_out.keys(): 
-        recency_w = hp[0]
-        relevance_w = hp[1]
-        importance_w = hp[2]
-        master_out[key] = (recency_w * recency_out[key]
-                         + relevance_w * relevance_out[key] 
-                         + importance_w * importance_out[key])
+        # Computing the final scores that combines the component values. 
+        master_out = dict()
+        for key in recency_out.keys(): 
+          master_out[key] = (recency_w * recency_out[key]
+                           + relevance_w * relevance_out[key] 
+                           + importance_w * importance_out[key])
 
       if verbose: 
         master_out = top_highest_x_values(master_out, len(master_out.keys()))
         for key, val in master_out.items(): 
-          print (self.id_to_node[key].content, val)
+          print (id_to_node[key].content, val)
           print (recency_w*recency_out[key]*1, 
                  relevance_w*relevance_out[key]*1, 
                  importance_w*importance_out[key]*1)
@@ -252,15 +478,21 @@ class MemoryStream:
       # the highest x values, we want to translate the node.id into nodes 
       # and return the list of nodes.
       master_out = top_highest_x_values(master_out, n_count)
-      master_nodes = [self.id_to_node[key] for key in list(master_out.keys())]
-
-      # We do not want to update the last retrieved time_step for these nodes
-      # if we are in a stateless mode. 
-      if not stateless: 
-        for n in master_nodes: 
-          n.retrieved_time_step = time_step
-        
+      master_nodes = [id_to_node[key] for key in list(master_out.keys())]
+      self.retrieval_cache.put(cache_key, master_nodes)
       retrieved[focal_pt] = master_nodes
+      if audit_log: 
+        scores[focal_pt] = {key: {"score": float(master_out[key]), 
+                                  "recency": float(recency_out[key]), 
+                                  "importance": float(importance_out[key]), 
+                                  "relevance": float(relevance_out[key])} 
+                            for key in master_out}
+
+    # We do not want to update the last retrieved time_step for these nodes
+    # if we are in a stateless mode. Updating them changes future recency 
+    # scores, so it invalidates the retrieval cache. 
+    if not stateless: 
+      self.mark_retrieved(retrieved, time_step)
     
     if record_json: 
       new_ret = dict()
@@ -268,15 +500,199 @@ class MemoryStream:
         new_ret[key] = [i.content for i in val]
       append_to_json(record_json, new_ret)
 
+    if audit_log: 
+      log = get_retrieval_log(audit_log)
+      for focal_pt, master_nodes in retrieved.items(): 
+        log.record({"focal_point": focal_pt, 
+                    "time_step": time_step, 
+                    "filter": curr_filter, 
+                    "hp": list(hp), 
+                    "n_count": n_count, 
+                    "cached": scores[focal_pt] is None, 
+                    "nodes": [dict({"node_id": n.node_id, 
+                                    "content": n.content}, 
+                                   **(scores[focal_pt] or {}).get(n.node_id, {})) 
+                              for n in master_nodes]})
+
     return retrieved 
 
 
+  def cache_key(self, 
+                focal_pt: str, 
+                curr_filter: str, 
+                hp: List[float], 
+                n_count: int, 
+                version: int) -> Tuple: 
+    """
+    Retrieval cache key. The scoring mode is part of the key, since 
+    quantized or coarse indexes can rank nodes differently. 
+    """
+    return (focal_pt, curr_filter, tuple(hp), n_count, version, 
+            self.embedding_dtype, self.coarse_dim)
+
+
+  def _use_index(self, curr_nodes: List[ConceptNode]) -> bool: 
+    """
+    Whether this retrieval is scored on the embedding index. Shortened 
+    embeddings always are, since extract_relevance embeds the focal point 
+    at the model's full size. 
+    """
+    return (len(curr_nodes) >= self.shard_min_nodes 
+            or self.embedding_dtype != "float32" or self.coarse_dim is not None
+            or self.embedding_dimensions is not None)
+
+
+  def sync_index(self) -> Any: 
+    """Returns the embedding index, after appending any new nodes to it."""
+    from generative_agent.modules.embedding_index import EmbeddingIndex
+
+    with self.lock: 
+      if (self.index is None or self.index.dtype != self.embedding_dtype 
+          or self.index.prefix_dim != self.coarse_dim): 
+        self.index = EmbeddingIndex(self.embedding_dtype, self.coarse_dim)
+      self.index.sync(self.seq_nodes, self.embeddings)
+      return self.index
+
+
+  def _index_columns(self, 
+                     curr_nodes: List[ConceptNode], 
+                     recency_out: Dict[int, float], 
+                     importance_out: Dict[int, float]) -> Tuple[Any, Any, Any]:
+    """
+    Syncs the embedding index with the memory stream and lays out the 
+    normalized recency and importance scores as per-row columns, with NaN 
+    for the rows outside curr_nodes. Nodes of curr_nodes that were removed 
+    from the memory stream since it was snapshotted are left out. 
+
+    Returns: 
+      (index, recency column, importance column)
+    """
+    import numpy as np
+
+    with self.lock: 
+      index = self.sync_index()
+      curr_nodes = [node for node in curr_nodes if node.node_id in index.row_of]
+      recency = np.full(index.count, np.nan, dtype=np.float32)
+      importance = np.full(index.count, np.nan, dtype=np.float32)
+      rows = [index.row_of[node.node_id] for node in curr_nodes]
+      recency[rows] = [recency_out[node.node_id] for node in curr_nodes]
+      importance[rows] = [importance_out[node.node_id] for node in curr_nodes]
+    return index, recency, importance
+
+
+  def _score_with_index(self, 
+                        curr_nodes: List[ConceptNode], 
+                        recency_out: Dict[int, float], 
+                        importance_out: Dict[int, float], 
+                        focal_pt: str, 
+                        hp: List[float], 
+                        n_count: int
+                        ) -> Tuple[Dict[int, float], Dict[int, float]]:
+    """
+    Scores curr_nodes against focal_pt with one matrix-vector product over 
+    the embedding index (sharded across processes for large streams), 
+    combining the normalized relevance with the given normalized recency 
+    and importance. 
+
+    Parameters:
+      curr_nodes: the (filtered) nodes to score
+      recency_out: normalized recency score of each node id
+      importance_out: normalized importance score of each node id
+      focal_pt: the str focal point
+      hp: [recency_weight, relevance_weight, importance_weight]
+      n_count: the number of nodes to return
+    Returns: 
+      (relevance_out, master_out) for the top n_count node ids
+    """
+    import numpy as np
+    from generative_agent.modules.embedding_index import (
+      ShardedScorer, normalize_query, normalize_array, combine_scores, 
+      top_k_rows)
+
+    query = normalize_query(
+      get_text_embedding(focal_pt, dimensions=self.embedding_dimensions))
+
+    # Scoring holds the lock, so that a concurrent write (e.g., a background
+    # consolidation) cannot change the index, or the embeddings it is 
+    # rescored on, halfway through. 
+    with self.lock: 
+      index, recency, importance = self._index_columns(
+        curr_nodes, recency_out, importance_out)
+      if index.approximate: 
+        approx = index.dot(index.prepare_query(query))
+        hits = self._score_two_stage(index, approx, query, recency, 
+                                     importance, hp, n_count)
+      elif self.shard_workers > 1 and index.count >= self.shard_min_nodes: 
+        if self.sharded_scorer is None: 
+          self.sharded_scorer = ShardedScorer(self.shard_workers)
+        hits = self.sharded_scorer.score(index, query, recency, importance, 
+                                         hp, n_count)
+      else: 
+        relevance = normalize_array(index.rows() @ query, ~np.isnan(recency))
+        score = combine_scores(recency, importance, relevance, hp)
+        hits = [(score[row], row, relevance[row]) 
+                for row in top_k_rows(score, n_count)]
+
+      relevance_out = {index.node_ids[row]: float(rel) for _, row, rel in hits}
+      master_out = {index.node_ids[row]: float(s) for s, row, _ in hits}
+    return relevance_out, master_out
+
+
+  def _score_two_stage(self, 
+                       approx_index: Any, 
+                       approx: Any, 
+                       query: Any, 
+                       recency: Any, 
+                       importance: Any, 
+                       hp: List[float], 
+                       n_count: int) -> List[Tuple[float, int, float]]:
+    """
+    Shortlists candidates on approx, the dot products of an approximate 
+    index (quantized, or over truncated embeddings) with the query, then 
+    rescores the shortlist with the full embeddings against the full query 
+    (after an int8 reload, these are the dequantized vectors, so rescoring 
+    only removes the prefix and per-query rounding error). Relevance is normalized with the exact range over the 
+    shortlist and the node with the lowest approximate score, which stands 
+    in for the range over all filtered nodes. The caller holds the lock, 
+    with approx_index in sync with the memory stream. 
+
+    Returns: 
+      The top n_count (score, row, normalized relevance), highest first
+    """
+    import numpy as np
+    from generative_agent.modules.embedding_index import (
+      normalize_rows, combine_scores, top_k_rows)
+
+    mask = ~np.isnan(recency)
+    if not mask.any(): 
+      return []
+    def normalize(x, lo, hi): 
+      return np.full_like(x, 0.5) if hi == lo else (x - lo) / (hi - lo)
+
+    shortlist = top_k_rows(
+      combine_scores(recency, importance, 
+                     normalize(approx, float(approx[mask].min()), 
+                               float(approx[mask].max())), hp), 
+      max(n_count * SHORTLIST_FACTOR, SHORTLIST_MIN))
+    lowest = int(np.flatnonzero(mask)[np.argmin(approx[mask])])
+    with self.lock: 
+      exact = normalize_rows(
+        [self.embeddings[self.id_to_node[approx_index.node_ids[row]].content] 
+         for row in shortlist + [lowest]]) @ query
+    relevance = normalize(exact[:-1], float(exact.min()), float(exact.max()))
+    score = combine_scores(recency[shortlist], importance[shortlist], 
+                           relevance, hp)
+    return [(float(score[i]), shortlist[i], float(relevance[i])) 
+            for i in top_k_rows(score, n_count)]
+
+
   def _add_node(self, 
                 time_step: int, 
                 node_type: str, 
                 content: str, 
                 importance: float, 
-                pointer_id: Optional[int]):
+                pointer_id: Optional[int],
+                embedding: Optional[List[float]] = None) -> ConceptNode:
     """
     Adding a new node to the memory stream. 
 
@@ -286,35 +702,153 @@ class MemoryStream:
       content: the str content of the memory record
       importance: int score of the importance score
       pointer_id: the str of the parent node 
+      embedding: the embedding of content, if it was already computed
     Returns: 
-      retrieved: A dictionary whose keys are a focal_pt query str, and whose
-        values are a list of nodes that are retrieved for that query str. 
+      The new ConceptNode
+    """
+    if embedding is None: 
+      embedding = get_text_embedding(content, 
+                                     dimensions=self.embedding_dimensions)
+
+    with self.lock: 
+      node_dict = dict()
+      node_dict["node_id"] = self.next_node_id
+      node_dict["node_type"] = node_type
+      node_dict["content"] = content
+      node_dict["importance"] = importance
+      node_dict["created"] = time_step
+      node_dict["last_retrieved"] = time_step
+      node_dict["pointer_id"] = pointer_id
+      new_node = ConceptNode(node_dict)
+
+      self.seq_nodes += [new_node]
+      self.id_to_node[new_node.node_id] = new_node
+      self.node_by_hash[content_hash(content)] = new_node.node_id
+      self.next_node_id += 1
+      self.embeddings[content] = embedding
+      self._bump_version()
+    return new_node
+
+
+  def _bump_version(self) -> None: 
     """
-    node_dict = dict()
-    node_dict["node_id"] = len(self.seq_nodes)
-    node_dict["node_type"] = node_type
-    node_dict["content"] = content
-    node_dict["importance"] = importance
-    node_dict["created"] = time_step
-    node_dict["last_retrieved"] = time_step
-    node_dict["pointer_id"] = pointer_id
-    new_node = ConceptNode(node_dict)
+    Marks the memory stream as changed. Cached retrievals are keyed by the 
+    version they were computed at, so they all become stale. 
+    """
+    with self.lock: 
+      self.version += 1
+      self.retrieval_cache.clear()
+
 
-    self.seq_nodes += [new_node]
-    self.id_to_node[new_node.node_id] = new_node
-    self.embeddings[content] = get_text_embedding(content)
+  def remember(self, content: str, time_step: int = 0) -> ConceptNode:
+    return self.ingest(content, time_step)[0]
 
 
-  def remember(self, content: str, time_step: int = 0):
+  def ingest(self, 
+             content: str, 
+             time_step: int = 0) -> Tuple[ConceptNode, bool]: 
+    """
+    Adds a new observation, unless (with dedup on) it duplicates an existing
+    observation. Exact duplicates are found by content hash before any API 
+    call; near-duplicates by the cosine similarity of the new embedding to 
+    the embedding index, before the importance call. A duplicate is either 
+    merged into the existing node (dedup "merge": its recency is refreshed 
+    and its importance raised) or dropped (dedup "skip"). 
+
+    Parameters:
+      content: the str content of the observation
+      time_step: Current time_step 
+    Returns: 
+      (the new node, or the existing node it duplicates; whether it is new)
+    """
+    embedding = None
+    if self.dedup: 
+      with self.lock: 
+        node_id = self.node_by_hash.get(content_hash(content))
+        duplicate = self.id_to_node.get(node_id)
+      if duplicate is not None and duplicate.node_type == "observation": 
+        return self._merge_duplicate(duplicate, time_step, "exact"), False
+
+      embedding = get_text_embedding(content, 
+                                     dimensions=self.embedding_dimensions)
+      duplicate = self._find_near_duplicate(embedding)
+      if duplicate is not None: 
+        return self._merge_duplicate(duplicate, time_step, "near"), False
+
     score = generate_importance_score([content])[0]
-    self._add_node(time_step, "observation", content, score, None)
+    return self._add_node(time_step, "observation", content, score, None, 
+                          embedding), True
 
 
-  def reflect(self, 
-              anchor: str, 
-              reflection_count: int = 5, 
-              retrieval_count: int = 10, 
-              time_step: int = 0):
+  def _find_near_duplicate(self, 
+                           embedding: List[float]) -> Optional[ConceptNode]: 
+    """
+    Returns the observation most similar to embedding if their cosine 
+    similarity is at least dedup_similarity. On large streams, the best 
+    DEDUP_CANDIDATES rows of the embedding index are checked on their full 
+    embeddings, since the index may be approximate; small streams are 
+    compared with every observation. 
+    """
+    from generative_agent.modules.embedding_index import (
+      normalize_query, normalize_rows, top_k_rows)
+
+    with self.lock: 
+      if not self.seq_nodes: 
+        return None
+      query = normalize_query(embedding)
+      if self.index is None and len(self.seq_nodes) < DEDUP_INDEX_MIN_NODES: 
+        candidates = self.seq_nodes
+      else: 
+        index = self.sync_index()
+        rows = top_k_rows(index.dot(index.prepare_query(query)), 
+                          DEDUP_CANDIDATES)
+        candidates = [self.id_to_node[index.node_ids[row]] for row in rows]
+      candidates = [node for node in candidates 
+                    if node.node_type == "observation"]
+      if not candidates: 
+        return None
+      sims = normalize_rows([self.embeddings[node.content] 
+                             for node in candidates]) @ query
+    best = int(sims.argmax())
+    if sims[best] < self.dedup_similarity: 
+      return None
+    return candidates[best]
+
+
+  def _merge_duplicate(self, 
+                       node: ConceptNode, 
+                       time_step: int, 
+                       kind: str) -> ConceptNode: 
+    """Folds a duplicate observation into node (see ingest)."""
+    with self.lock: 
+      self.dedup_counts[kind] += 1
+      if self.dedup == "merge": 
+        node.last_retrieved = max(node.last_retrieved, time_step)
+        node.importance = min(node.importance + DEDUP_IMPORTANCE_BUMP, 
+                              max(node.importance, DEDUP_MAX_IMPORTANCE))
+        # Like mark_retrieved, so an inherited node is rewritten on save. 
+        self.mutated_node_ids.add(node.node_id)
+        self._bump_version()
+    return node
+
+
+  def prepare_reflection(self, 
+                         anchor: str, 
+                         reflection_count: int = 5, 
+                         retrieval_count: int = 10, 
+                         time_step: int = 0) -> List[Dict[str, Any]]:
+    """
+    Runs every LLM and embedding call of a reflection without touching the 
+    memory stream, so it can run off the conversational path. 
+
+    Parameters:
+      anchor: str reflection anchor
+      reflection_count: the number of reflections to generate
+      retrieval_count: the number of records to reflect on
+      time_step: int entering timestep
+    Returns: 
+      List of pending node dictionaries to pass to commit_nodes
+    """
     records = self.retrieve([anchor], 
                             time_step, 
                             retrieval_count, 
@@ -323,9 +857,124 @@ class MemoryStream:
     reflections = generate_reflection(records, anchor, reflection_count)
     scores = generate_importance_score(reflections)
 
+    pending = []
     for count, reflection in enumerate(reflections): 
-      self._add_node(time_step, "reflection", reflections[count], 
-                     scores[count], record_ids)
+      pending += [{"node_type": "reflection", 
+                   "content": reflection, 
+                   "importance": scores[count], 
+                   "pointer_id": record_ids, 
+                   "embedding": get_text_embedding(
+                     reflection, dimensions=self.embedding_dimensions)}]
+    return pending
+
+
+  def commit_nodes(self, 
+                   time_step: int, 
+                   pending: List[Dict[str, Any]]) -> List[ConceptNode]:
+    """
+    Adds prepared nodes to the memory stream in a single critical section, 
+    so readers see either none or all of them. 
+
+    Parameters:
+      time_step: int entering timestep
+      pending: node dictionaries as returned by prepare_reflection
+    Returns: 
+      The new ConceptNodes
+    """
+    with self.lock: 
+      return [self._add_node(time_step, p["node_type"], p["content"], 
+                             p["importance"], p["pointer_id"], 
+                             p["embedding"]) 
+              for p in pending]
+
+
+  def reflect(self, 
+              anchor: str, 
+              reflection_count: int = 5, 
+              retrieval_count: int = 10, 
+              time_step: int = 0) -> List[ConceptNode]:
+    pending = self.prepare_reflection(anchor, reflection_count, 
+                                      retrieval_count, time_step)
+    return self.commit_nodes(time_step, pending)
+
+
+  def consolidate_nodes(self, 
+                        time_step: int, 
+                        pending: List[Dict[str, Any]]) -> List[ConceptNode]:
+    """
+    Replaces groups of nodes by summary nodes in a single critical section. 
+    The replaced nodes leave the hot set (seq_nodes, id_to_node and their 
+    embeddings) and are queued for the archive. A group is skipped if any 
+    of its nodes is gone or was retrieved since the summary was prepared. 
+
+    Each summary is an observation whose pointer_id lists the ids of the 
+    nodes it replaces. It keeps their latest last_retrieved time_step, so 
+    consolidation does not make old memories look recent. 
+
+    Parameters:
+      time_step: int entering timestep
+      pending: dictionaries with the summary "content", "importance" and 
+        "embedding", and "last_retrieved", mapping each node id of the 
+        group to its last_retrieved time_step when it was summarized
+    Returns: 
+      The new summary ConceptNodes
+    """
+    summaries = []
+    with self.lock: 
+      groups = []
+      for p in pending: 
+        group = [self.id_to_node.get(node_id) 
+                 for node_id in p["last_retrieved"]]
+        if all(node is not None 
+               and node.last_retrieved == p["last_retrieved"][node.node_id]
+               for node in group): 
+          groups += [(p, group)]
+
+      removed_ids = {node.node_id for _, group in groups for node in group}
+      self.seq_nodes = [node for node in self.seq_nodes 
+                        if node.node_id not in removed_ids]
+      remaining_contents = {node.content for node in self.seq_nodes}
+      for p, group in groups: 
+        for node in group: 
+          del self.id_to_node[node.node_id]
+          key = content_hash(node.content)
+          if self.node_by_hash.get(key) == node.node_id: 
+            del self.node_by_hash[key]
+          self.pending_archive += [
+            dict(node.package(), 
+                 embedding=self.embeddings.get(node.content), 
+                 archived=time_step)]
+          if node.content not in remaining_contents: 
+            self.embeddings.pop(node.content, None)
+
+        summary = self._add_node(time_step, "observation", p["content"], 
+                                 p["importance"], 
+                                 [node.node_id for node in group], 
+                                 p["embedding"])
+        summary.last_retrieved = max(node.last_retrieved for node in group)
+        remaining_contents.add(summary.content)
+        summaries += [summary]
+
+      if summaries: 
+        # Rows were removed from the middle of the stream; the index is 
+        # rebuilt on the next retrieval. 
+        self.index = None
+        self._bump_version()
+    return summaries
+
+
+  def take_mutated(self) -> set: 
+    """Returns and clears the ids of the nodes changed since the last call."""
+    with self.lock: 
+      mutated, self.mutated_node_ids = self.mutated_node_ids, set()
+      return mutated
+
+
+  def take_archived(self) -> List[Dict[str, Any]]: 
+    """Returns and clears the nodes queued for the archive, oldest first."""
+    with self.lock: 
+      archived, self.pending_archive = self.pending_archive, []
+      return archived
 
 
 # ##############################################################################
@@ -468,10 +1117,6 @@ def run_gpt_generate_importance(
       records_str += f"{r}\n"
     return [records_str]
 
-  def _func_clean_up(gpt_response, prompt=""): 
-    gpt_response = extract_first_json_dict(gpt_response)
-    return list(gpt_response.values())
-
   def _get_fail_safe():
     return 25
 
@@ -483,16 +1128,93 @@ def run_gpt_generate_importance(
   prompt_input = create_prompt_input(records) 
   fail_safe = _get_fail_safe() 
 
-  output, prompt, prompt_input, fail_safe = chat_safe_generate(
-    prompt_input, prompt_lib_file, gpt_version, 1, fail_safe, 
-    _func_clean_up, verbose)
+  # Items whose score is missing or out of range are re-requested on their 
+  # own. Items that fail every attempt come back as None so that the caller 
+  # can apply the fail-safe score without caching it. 
+  output, prompt, prompt_input, _ = chat_safe_generate(
+    prompt_input, prompt_lib_file, gpt_version, 3, None, 
+    verbose=verbose, output_schema=IMPORTANCE_SCORE_SCHEMA, 
+    items=records, func_create_prompt_input=create_prompt_input)
 
   return output, [output, prompt, prompt_input, fail_safe]
 
 
+def batch_by_token_budget(records: List[str], 
+                          token_budget: int = IMPORTANCE_BATCH_TOKEN_BUDGET,
+                          max_items: int = IMPORTANCE_BATCH_MAX_ITEMS
+                          ) -> List[List[str]]: 
+  """
+  Splits records into consecutive batches whose estimated token count stays 
+  within token_budget (a single oversized record gets a batch of its own). 
+
+  Parameters:
+    records: the list of str records
+    token_budget: the max estimated tokens of records per batch
+    max_items: the max number of records per batch
+  Returns: 
+    List of batches
+  """
+  batches = []
+  curr_batch, curr_tokens = [], 0
+  for record in records: 
+    tokens = estimate_token_count(record)
+    if curr_batch and (curr_tokens + tokens > token_budget 
+                       or len(curr_batch) >= max_items): 
+      batches += [curr_batch]
+      curr_batch, curr_tokens = [], 0
+    curr_batch += [record]
+    curr_tokens += tokens
+  if curr_batch: 
+    batches += [curr_batch]
+  return batches
+
+
 def generate_importance_score(records: List[str]) -> List[float]:
-  """Generate importance scores for given records."""
-  return run_gpt_generate_importance(records, "1", LLM_VERS)[0]
+  """
+  Generate importance scores for given records. 
+
+  Scores are cached by content hash (the IMPORTANCE_CACHE_SIZE most recently 
+  used), so re-ingesting an identical memory does not cost an LLM call. The uncached records are split into batches by
+  token budget and the batches are scored concurrently. Records that could
+  not be scored get the fail-safe score, which is not cached.
+  """
+  keys = [content_hash(record) for record in records]
+  with _importance_cache_lock: 
+    known = {key: _importance_cache[key] for key in keys 
+             if key in _importance_cache}
+    for key in known: 
+      _importance_cache.move_to_end(key)
+  pending = {key: record for key, record in zip(keys, records) 
+             if key not in known}
+
+  fail_safe = 25
+  if pending: 
+    batches = batch_by_token_budget(list(pending.values()))
+    workers = min(IMPORTANCE_MAX_WORKERS, len(batches))
+    if workers > 1: 
+      with ThreadPoolExecutor(max_workers=workers) as executor: 
+        outputs = list(executor.map(
+          lambda batch: run_gpt_generate_importance(batch, "1", LLM_VERS), 
+          batches))
+    else: 
+      outputs = [run_gpt_generate_importance(batch, "1", LLM_VERS) 
+                 for batch in batches]
+
+    scored = dict()
+    for batch, (output, meta) in zip(batches, outputs): 
+      fail_safe = meta[-1]
+      for record, score in zip(batch, output): 
+        if score is not None: 
+          scored[content_hash(record)] = score
+    known.update(scored)
+    with _importance_cache_lock: 
+      _importance_cache.update(scored)
+      for key in scored: 
+        _importance_cache.move_to_end(key)
+      while len(_importance_cache) > IMPORTANCE_CACHE_SIZE: 
+        _importance_cache.popitem(last=False)
+
+  return [known.get(key, fail_safe) for key in keys]
 
 
 def run_gpt_generate_reflection(
@@ -510,9 +1232,6 @@ def run_gpt_generate_reflection(
       records_str += f"{r}\n"
     return [records_str, reflection_count, anchor]
 
-  def _func_clean_up(gpt_response, prompt=""): 
-    return extract_first_json_dict(gpt_response)["reflection"]
-
   def _get_fail_safe():
     return []
 
@@ -526,7 +1245,7 @@ def run_gpt_generate_reflection(
 
   output, prompt, prompt_input, fail_safe = chat_safe_generate(
     prompt_input, prompt_lib_file, gpt_version, 1, fail_safe, 
-    _func_clean_up, verbose)
+    verbose=verbose, output_schema=REFLECTION_SCHEMA)
 
   return output, [output, prompt, prompt_input, fail_safe]
 
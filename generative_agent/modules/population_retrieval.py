@@ -0,0 +1,177 @@
+from typing import Dict, List
+
+import numpy as np
+
+from simulation_engine.gpt_structure import get_text_embedding
+from generative_agent.modules.memory_stream import (
+  MemoryStream, ConceptNode, extract_recency, extract_importance,
+  normalize_dict_floats)
+from generative_agent.modules.embedding_index import (
+  normalize_query, combine_scores, top_k_rows)
+
+
+# ##############################################################################
+# ###                      POPULATION-LEVEL RETRIEVAL                        ###
+# ##############################################################################
+
+class PopulationIndex:
+  """
+  Retrieval over the memory streams of a whole population at once. When
+  every agent answers the same questions, each distinct focal point is
+  embedded once and scored against all agents' embeddings in one matrix
+  product over the stacked population matrix; each agent's relevance,
+  recency and importance are still normalized over its own nodes, so every
+  agent gets the same top-k as its own MemoryStream.retrieve would return.
+
+  The stacked matrix is kept between calls and only rebuilt when a memory
+  stream gained nodes. If the indexes are approximate (quantized, or over a
+  coarse prefix of the embeddings), each agent's shortlist is rescored on
+  its full embeddings, as in MemoryStream.retrieve.
+  """
+  def __init__(self, memory_streams: List[MemoryStream]):
+    self.memory_streams = list(memory_streams)
+    self.matrix = None
+    self.offsets = []
+    self.indexes = []
+    self.signature = None
+
+
+  def _sync(self) -> None:
+    for memory_stream in self.memory_streams:
+      memory_stream.sync_index()
+
+    signature = tuple((id(ms.index.matrix), ms.index.count)
+                      for ms in self.memory_streams)
+    if signature == self.signature:
+      return
+
+    blocks = [ms.index.dense_rows() for ms in self.memory_streams
+              if ms.index.count]
+    if (len({block.shape[1] for block in blocks}) > 1
+        or len({ms.index.prefix_dim for ms in self.memory_streams}) > 1):
+      raise ValueError("All memory streams of a population must use the "
+                       "same embedding dimension.")
+    self.matrix = (np.concatenate(blocks) if blocks
+                   else np.empty((0, 0), dtype=np.float32))
+    self.offsets = list(np.cumsum([0] + [ms.index.count
+                                         for ms in self.memory_streams]))
+    self.indexes = [ms.index for ms in self.memory_streams]
+    self.signature = signature
+
+
+  def retrieve(self,
+               focal_points: List[str],
+               time_step: int,
+               n_count: int = 10,
+               curr_filter: str = "all",
+               hp: List[float] = [0.5, 3, 0.5],
+               stateless: bool = True
+               ) -> List[Dict[str, List[ConceptNode]]]:
+    """
+    Retrieve the most relevant nodes of every agent for each focal point.
+
+    Parameters:
+      focal_points: List of strings to focus the memory retrieval on
+      time_step: Current time step in the simulation
+      n_count: Number of nodes to retrieve per agent and focal point
+      curr_filter: Filter for node types ('all', 'reflection', or
+        'observation')
+      hp: Hyperparameters [recency_weight, relevance_weight,
+        importance_weight]
+      stateless: If False, update the last_retrieved time of returned nodes
+    Returns:
+      For each memory stream (in order), a dictionary mapping each focal
+      point to its list of retrieved ConceptNodes. The results are also put
+      in each memory stream's retrieval cache.
+    """
+    self._sync()
+    distinct = list(dict.fromkeys(focal_points))
+    if not distinct or not len(self.matrix):
+      return [{focal_pt: [] for focal_pt in focal_points}
+              for _ in self.memory_streams]
+
+    dimensions = self.memory_streams[0].embedding_dimensions
+    queries = np.stack([
+      normalize_query(get_text_embedding(focal_pt, dimensions=dimensions))
+      for focal_pt in distinct])
+    # (focal points x all nodes of the population) cosine relevance. The
+    # indexes of a population share their prefix_dim (see _sync).
+    first_index = self.memory_streams[0].index
+    approx_queries = np.stack([first_index.prepare_query(query)
+                               for query in queries])
+    relevance_all = approx_queries @ self.matrix.T
+
+    results = []
+    for a, memory_stream in enumerate(self.memory_streams):
+      curr_nodes, version = memory_stream.filter_nodes(curr_filter)
+      retrieved = {focal_pt: [] for focal_pt in distinct}
+      cacheable = True
+      if curr_nodes:
+        recency_out = normalize_dict_floats(extract_recency(curr_nodes), 0, 1)
+        importance_out = normalize_dict_floats(
+          extract_importance(curr_nodes), 0, 1)
+        own = False
+        # As in MemoryStream.retrieve, the index is scored and its rows are
+        # mapped back to nodes under the lock, so a concurrent write cannot
+        # remove them halfway through.
+        with memory_stream.lock:
+          index, recency, importance = memory_stream._index_columns(
+            curr_nodes, recency_out, importance_out)
+
+          start, end = self.offsets[a], self.offsets[a + 1]
+          relevance = relevance_all[:, start:end]
+          mask = ~np.isnan(recency)
+          if index is not self.indexes[a] or index.count != end - start:
+            own = True
+          elif mask.any() and index.approximate:
+            for f, focal_pt in enumerate(distinct):
+              hits = memory_stream._score_two_stage(
+                index, relevance[f], queries[f], recency, importance, hp,
+                n_count)
+              retrieved[focal_pt] = [
+                memory_stream.id_to_node[index.node_ids[row]]
+                for _, row, _ in hits]
+          elif mask.any():
+            lo = relevance[:, mask].min(axis=1, keepdims=True)
+            hi = relevance[:, mask].max(axis=1, keepdims=True)
+            span = np.where(hi == lo, 1, hi - lo)
+            relevance = np.where(hi == lo, 0.5, (relevance - lo) / span)
+            score = combine_scores(recency[None, :], importance[None, :],
+                                   relevance, hp)
+            for f, focal_pt in enumerate(distinct):
+              retrieved[focal_pt] = [
+                memory_stream.id_to_node[index.node_ids[row]]
+                for row in top_k_rows(score[f], n_count)]
+
+        if own:
+          # The memory stream changed since _sync: the stacked matrix no
+          # longer covers all of its nodes, so this agent retrieves on its
+          # own (which also caches under the current version).
+          retrieved.update(memory_stream.retrieve(distinct, time_step,
+                                                  n_count, curr_filter, hp))
+          cacheable = False
+
+      if cacheable:
+        for focal_pt, master_nodes in retrieved.items():
+          memory_stream.retrieval_cache.put(
+            memory_stream.cache_key(focal_pt, curr_filter, hp, n_count,
+                                    version),
+            master_nodes)
+      if not stateless:
+        memory_stream.mark_retrieved(retrieved, time_step)
+      results += [{focal_pt: retrieved[focal_pt]
+                   for focal_pt in focal_points}]
+    return results
+
+
+def retrieve_population(agents: List["GenerativeAgent"],
+                        focal_points: List[str],
+                        time_step: int,
+                        **kwargs) -> List[Dict[str, List[ConceptNode]]]:
+  """
+  One-off population retrieval over the agents' memory streams (see
+  PopulationIndex.retrieve). Keep a PopulationIndex to reuse the stacked
+  matrix across calls.
+  """
+  return PopulationIndex([agent.memory_stream for agent in agents]).retrieve(
+    focal_points, time_step, **kwargs)
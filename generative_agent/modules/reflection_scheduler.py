@@ -0,0 +1,134 @@
+import threading
+import traceback
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+from typing import Callable, List, Optional
+
+from simulation_engine.settings import *
+from generative_agent.modules.memory_stream import ConceptNode, MemoryStream
+
+
+# ##############################################################################
+# ###                          REFLECTION SCHEDULER                          ###
+# ##############################################################################
+
+def default_reflection_anchor(new_nodes: List[ConceptNode]) -> str:
+  """
+  Picks the anchor of a policy-triggered reflection: the content of the most
+  important observation since the last reflection.
+
+  Parameters:
+    new_nodes: the observations added since the last reflection
+  Returns:
+    str anchor
+  """
+  return max(new_nodes, key=lambda node: node.importance).content
+
+
+class ReflectionScheduler:
+  """
+  Triggers reflections by policy and runs them on a background worker pool.
+
+  Every observation passed to observe() adds its importance to a running
+  total; once the total since the last reflection reaches
+  importance_threshold, a reflection is scheduled. The retrieval, LLM and
+  embedding calls run on the worker (MemoryStream.prepare_reflection) and the
+  resulting nodes are committed in one step (MemoryStream.commit_nodes), so
+  the caller's utterance latency never includes reflection cost.
+  """
+  def __init__(self,
+               memory_stream: MemoryStream,
+               importance_threshold: float = 150,
+               reflection_count: int = 5,
+               retrieval_count: int = 10,
+               max_workers: int = 1,
+               anchor_func: Callable[[List[ConceptNode]], str] = None):
+    self.memory_stream = memory_stream
+    self.importance_threshold = importance_threshold
+    self.reflection_count = reflection_count
+    self.retrieval_count = retrieval_count
+    self.anchor_func = anchor_func or default_reflection_anchor
+
+    self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                       thread_name_prefix="reflection")
+    self.lock = threading.Lock()
+    self.pending_futures = set()
+    self.accumulated_importance = 0
+    self.new_nodes = []
+
+
+  def observe(self, node: ConceptNode, time_step: int = 0) -> Optional[Future]:
+    """
+    Records a new observation and schedules a reflection if the policy
+    threshold is reached.
+
+    Parameters:
+      node: the observation node that was just added
+      time_step: int entering timestep
+    Returns:
+      The Future of the scheduled reflection, or None
+    """
+    with self.lock:
+      self.accumulated_importance += node.importance
+      self.new_nodes += [node]
+      if self.accumulated_importance < self.importance_threshold:
+        return None
+      new_nodes = self.new_nodes
+      self.accumulated_importance = 0
+      self.new_nodes = []
+
+    return self.schedule(self.anchor_func(new_nodes), time_step)
+
+
+  def schedule(self, anchor: str, time_step: int = 0) -> Future:
+    """
+    Schedules a reflection on anchor in the background.
+
+    Parameters:
+      anchor: str reflection anchor
+      time_step: int entering timestep
+    Returns:
+      Future that resolves to the list of committed reflection nodes, or
+      carries the exception of a failed reflection
+    """
+    future = self.executor.submit(self._run, anchor, time_step)
+    with self.lock:
+      self.pending_futures.add(future)
+    future.add_done_callback(self._discard)
+    return future
+
+
+  def _run(self, anchor: str, time_step: int) -> List[ConceptNode]:
+    try:
+      pending = self.memory_stream.prepare_reflection(
+        anchor, self.reflection_count, self.retrieval_count, time_step)
+      return self.memory_stream.commit_nodes(time_step, pending)
+    except Exception as e:
+      # A failed background reflection must not take down the simulation,
+      # but it is reported, and the Future carries the exception.
+      print (f"Background reflection on {anchor!r} failed: "
+             f"{type(e).__name__}: {e}")
+      if DEBUG:
+        traceback.print_exc()
+      raise
+
+
+  def _discard(self, future: Future) -> None:
+    with self.lock:
+      self.pending_futures.discard(future)
+
+
+  def wait(self, timeout: Optional[float] = None) -> None:
+    """
+    Blocks until every scheduled reflection has been committed or has
+    failed (failures are reported when they happen; their Futures carry
+    the exception).
+    """
+    with self.lock:
+      futures = list(self.pending_futures)
+    wait_futures(futures, timeout)
+
+
+  def shutdown(self, wait: bool = True) -> None:
+    self.executor.shutdown(wait=wait)
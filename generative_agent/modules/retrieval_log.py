@@ -0,0 +1,162 @@
+import atexit
+import json
+import os
+import threading
+import time
+
+from typing import Any, Dict, Iterator, List, Optional
+
+from simulation_engine.global_methods import create_folder_if_not_there
+
+
+# A log is written out once it buffers RETRIEVAL_LOG_FLUSH_RECORDS records,
+# or once RETRIEVAL_LOG_FLUSH_INTERVAL seconds passed since its last flush.
+RETRIEVAL_LOG_FLUSH_RECORDS = 256
+RETRIEVAL_LOG_FLUSH_INTERVAL = 5.0
+
+
+# ##############################################################################
+# ###                          RETRIEVAL AUDIT LOG                           ###
+# ##############################################################################
+
+class RetrievalAuditLog:
+  """
+  Append-only JSONL log of retrievals, one record per line. Records are
+  buffered in memory and appended to the file in batches, so the cost of
+  logging does not grow with the size of the log, and earlier records are
+  never rewritten.
+
+  With background=True, a daemon thread also flushes the buffer every
+  flush_interval seconds, so records reach the file even when retrievals
+  stop. Buffered records are flushed at interpreter exit.
+  """
+  def __init__(self,
+               path: str,
+               flush_records: int = RETRIEVAL_LOG_FLUSH_RECORDS,
+               flush_interval: float = RETRIEVAL_LOG_FLUSH_INTERVAL,
+               background: bool = False):
+    self.path = path
+    self.flush_records = flush_records
+    self.flush_interval = flush_interval
+    self.buffer = []
+    self.last_flush = time.monotonic()
+    self.lock = threading.Lock()
+    self.closed = threading.Event()
+
+    create_folder_if_not_there(path)
+    self.writer = None
+    if background:
+      self.writer = threading.Thread(target=self._run_writer, daemon=True)
+      self.writer.start()
+
+
+  def record(self, entry: Dict[str, Any]) -> None:
+    """
+    Buffers one record, flushing if the size or interval threshold is met.
+
+    Parameters:
+      entry: a JSON-serializable dict
+    Returns:
+      None
+    """
+    line = json.dumps(entry) + "\n"
+    with self.lock:
+      self.buffer += [line]
+      due = (len(self.buffer) >= self.flush_records
+             or time.monotonic() - self.last_flush >= self.flush_interval)
+    if due:
+      self.flush()
+
+
+  def flush(self) -> None:
+    with self.lock:
+      lines, self.buffer = self.buffer, []
+      self.last_flush = time.monotonic()
+      if lines:
+        # Written under the lock so that batches never interleave.
+        with open(self.path, "a", encoding="utf-8") as f:
+          f.write("".join(lines))
+
+
+  def _run_writer(self) -> None:
+    while not self.closed.wait(self.flush_interval):
+      self.flush()
+
+
+  def close(self) -> None:
+    self.closed.set()
+    if self.writer:
+      self.writer.join()
+    self.flush()
+
+
+_logs = dict()
+_logs_lock = threading.Lock()
+
+
+def get_retrieval_log(path: str, background: bool = False) -> RetrievalAuditLog:
+  """
+  Returns the shared RetrievalAuditLog for path, so that every memory
+  stream recording to the same file shares one buffer.
+  """
+  path = os.path.abspath(path)
+  with _logs_lock:
+    if path not in _logs:
+      _logs[path] = RetrievalAuditLog(path, background=background)
+    return _logs[path]
+
+
+@atexit.register
+def flush_retrieval_logs() -> None:
+  with _logs_lock:
+    logs = list(_logs.values())
+  for log in logs:
+    log.flush()
+
+
+# ##############################################################################
+# ###                                 READER                                 ###
+# ##############################################################################
+
+def read_retrieval_log(path: str,
+                       focal_point: Optional[str] = None
+                       ) -> Iterator[Dict[str, Any]]:
+  """
+  Iterates over the records of a retrieval audit log, optionally only those
+  for one focal point. A truncated last line (e.g., from a crash mid-write)
+  is skipped.
+
+  Parameters:
+    path: the JSONL log file
+    focal_point: if given, only records for this focal point are returned
+  Returns:
+    Iterator of record dicts, oldest first
+  """
+  with open(path, "r", encoding="utf-8") as f:
+    for line in f:
+      try:
+        entry = json.loads(line)
+      except json.JSONDecodeError:
+        continue
+      if focal_point is None or entry["focal_point"] == focal_point:
+        yield entry
+
+
+def retrieval_frequency(path: str) -> List[Dict[str, Any]]:
+  """
+  Counts how often each node was retrieved across a log.
+
+  Parameters:
+    path: the JSONL log file
+  Returns:
+    List of {"node_id", "content", "count"} dicts, most retrieved first
+  """
+  counts = dict()
+  for entry in read_retrieval_log(path):
+    for node in entry["nodes"]:
+      if node["node_id"] not in counts:
+        counts[node["node_id"]] = {"node_id": node["node_id"],
+                                   "content": node["content"],
+                                   "count": 0}
+      counts[node["node_id"]]["count"] += 1
+  return sorted(counts.values(), key=lambda x: x["count"], reverse=True)
@@ -3,6 +3,8 @@ from simulation_engine.global_methods import *
 
 from agent_bank.navigator import *
 from generative_agent.generative_agent import * 
+from generative_agent.modules.conversation import *
+from generative_agent.modules.dialogue_buffer import *
 
 from cs222_assignment_1.memories.jasmine_carter_memories import *
 from cs222_assignment_1.memories.matthew_jacobs_memories import *
@@ -19,20 +21,20 @@ def chat_session(generative_agent, stateless=False):
   user_name = input("And what is your name: ")
   print ("")
 
-  curr_convo = []
+  curr_convo = DialogueBuffer()
 
   while True: 
-    if stateless: curr_convo = []
+    if stateless: curr_convo = DialogueBuffer()
 
     user_input = input("You: ").strip()
-    curr_convo += [[user_name, user_input]]
+    curr_convo.append(user_name, user_input)
 
     if user_input.lower() == "bye":
       print(generative_agent.utterance(curr_convo)) 
       break
 
     response = generative_agent.utterance(curr_convo)  
-    curr_convo += [[generative_agent.scratch.get_fullname(), response]]
+    curr_convo.append(generative_agent.scratch.get_fullname(), response)
     print(f"{generative_agent.scratch.get_fullname()}: {response}")
 
 
@@ -58,6 +60,17 @@ def ask_agent_to_reflect():
   curr_agent.reflect("Reflect on your goal in life")
 
 
+def agents_converse(): 
+  jasmine = GenerativeAgent("SyntheticCS222", "jasmine_carter")
+  matthew = GenerativeAgent("SyntheticCS222", "matthew_jacobs")
+  dialogues = [Dialogue(f"jasmine_matthew_{i}", [jasmine, matthew], 
+                        "Two neighbors meet at a community meeting.", 10) 
+               for i in range(4)]
+  engine = ConversationEngine("cs222_assignment_1/report/conversations")
+  for dialogue_id, curr_dialogue in engine.run(dialogues).items(): 
+    print (dialogue_id, len(curr_dialogue))
+
+
 def main(): 
   build_agent()
   interview_agent()
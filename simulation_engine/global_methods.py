@@ -7,14 +7,16 @@ import datetime as dt
 import pathlib
 import os
 import sys
-import numpy
 import math
 import shutil, errno
 import base64
+import io
+import subprocess
 
-from PyPDF2 import PdfReader
 from os import listdir
 
+from simulation_engine.llm_json_parser import extract_first_json_dict
+
 
 def create_folder_if_not_there(curr_path): 
   """
@@ -211,6 +213,8 @@ def std(list_of_val):
   RETURNS: 
     The std of the values
   """
+  import numpy
+
   try: 
     list_of_val = [float(i) for i in list_of_val if not math.isnan(i)]
     std = numpy.std(list_of_val)
@@ -242,41 +246,6 @@ def generate_alphanumeric_string(length):
   return result
 
 
-def extract_first_json_dict(input_str):
-  try:
-    # Replace curly quotes with standard double quotes
-    input_str = (input_str.replace("“", "\"")
-                          .replace("”", "\"")
-                          .replace("‘", "'")
-                          .replace("’", "'"))
-    
-    # Find the first occurrence of '{' in the input_str
-    start_index = input_str.index('{')
-    
-    # Initialize a count to keep track of open and close braces
-    count = 1
-    end_index = start_index + 1
-    
-    # Loop to find the closing '}' for the first JSON dictionary
-    while count > 0 and end_index < len(input_str):
-        if input_str[end_index] == '{':
-            count += 1
-        elif input_str[end_index] == '}':
-            count -= 1
-        end_index += 1
-    
-    # Extract the JSON substring
-    json_str = input_str[start_index:end_index]
-    
-    # Parse the JSON string into a Python dictionary
-    json_dict = json.loads(json_str)
-    
-    return json_dict
-  except ValueError:
-    # Handle the case where the JSON parsing fails
-    return None
-
-
 def read_file_to_string(file_path):
   try:
     with open(file_path, 'r', encoding='utf-8') as file:
@@ -381,6 +350,8 @@ def append_to_json(record_json, new_ret):
         json.dump(existing_data, json_file, indent=4)
 
 def extract_text_from_pdf(pdf_content):
+  from PyPDF2 import PdfReader
+
   pdf_file = io.BytesIO(base64.b64decode(pdf_content))
   pdf_reader = PdfReader(pdf_file)
   text = ""
@@ -389,8 +360,46 @@ def extract_text_from_pdf(pdf_content):
   return text
 
 
+# Target for the cold import of the agent module (with the heavy SDKs 
+# deferred, only the standard library is loaded).
+IMPORT_TIME_TARGET_MS = 100
+
+
+def benchmark_import_time(module="generative_agent.generative_agent", 
+                          repeat=5): 
+  """
+  Measures the cold import time of module, each time in a fresh interpreter 
+  (so nothing is already in sys.modules), and lists the heavy dependencies 
+  that were loaded by the import. 
+
+  ARGS:
+    module: the dotted module name to import
+    repeat: number of fresh interpreters to time
+  RETURNS: 
+    The median import time in milliseconds.
+  """
+  heavy = ["openai", "PyPDF2", "numpy", "PIL"]
+  code = ("import sys, time; t = time.perf_counter(); "
+          f"import {module}; "
+          "print((time.perf_counter() - t) * 1000); "
+          f"print(','.join(m for m in {heavy!r} if m in sys.modules))")
+  timings = []
+  for _ in range(repeat): 
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, 
+                         text=True, check=True).stdout.splitlines()
+    timings += [float(out[0])]
+  loaded = out[1] if len(out) > 1 and out[1] else "none"
+
+  median = sorted(timings)[len(timings) // 2]
+  status = "ok" if median <= IMPORT_TIME_TARGET_MS else "over target"
+  print (f"import {module}: {median:.1f} ms median over {repeat} runs "
+         f"(target {IMPORT_TIME_TARGET_MS} ms, {status}); "
+         f"heavy modules loaded: {loaded}")
+  return median
+
+
 if __name__ == '__main__':
-  pass
+  benchmark_import_time()
 
 
 
@@ -1,14 +1,33 @@
-import openai
+import atexit
 import time
 import base64
+import hashlib
 import io
-import PyPDF2
 import os
-from typing import List, Union
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from simulation_engine.settings import *
+from simulation_engine.llm_json_parser import OutputSchema
 
-openai.api_key = OPENAI_API_KEY
+# The OpenAI SDK is imported (and a single client created) on the first 
+# request rather than at import time, so importing the engine stays cheap. 
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+
+def get_openai_client():
+  """Returns the shared OpenAI client, importing the SDK on first use."""
+  global _openai_client
+  if _openai_client is None: 
+    with _openai_client_lock: 
+      if _openai_client is None: 
+        import openai
+        openai.api_key = OPENAI_API_KEY
+        _openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
+  return _openai_client
 
 
 # ============================================================================
@@ -29,6 +48,11 @@ def print_run_prompts(prompt_input: Union[str, List[str]],
   print ("\n\n\n")
 
 
+def estimate_token_count(text: str) -> int:
+  """Rough token count of text (~4 characters per token for English)."""
+  return len(text) // 4 + 1
+
+
 def generate_prompt(prompt_input: Union[str, List[str]], 
                     prompt_lib_file: str) -> str:
   """Generate a prompt by replacing placeholders in a template file with 
@@ -50,13 +74,8 @@ def generate_prompt(prompt_input: Union[str, List[str]],
 
 
 def extract_text_from_pdf_file(file_path: str) -> str:
-  """Extract text content from a PDF file."""
-  if not os.path.exists(file_path):
-    raise FileNotFoundError(f"The file {file_path} does not exist.")
-
-  with open(file_path, 'rb') as file:
-    pdf_reader = PyPDF2.PdfReader(file)
-    return "".join(page.extract_text() for page in pdf_reader.pages)
+  """Extract text content from a PDF file (cached, see extract_pdf_pages)."""
+  return "".join(extract_pdf_pages(file_path))
 
 
 # ============================================================================
@@ -69,7 +88,7 @@ def gpt_request(prompt: str,
   """Make a request to OpenAI's GPT model."""
   if model == "o1-preview": 
     try:
-      client = openai.OpenAI(api_key=OPENAI_API_KEY)
+      client = get_openai_client()
       response = client.chat.completions.create(
         model=model,
         messages=[{"role": "user", "content": prompt}]
@@ -79,7 +98,7 @@ def gpt_request(prompt: str,
       return f"GENERATION ERROR: {str(e)}"
 
   try:
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
+    client = get_openai_client()
     response = client.chat.completions.create(
       model=model,
       messages=[{"role": "user", "content": prompt}],
@@ -97,7 +116,7 @@ def gpt_request_messages(messages: List[dict],
   """Make a request to OpenAI's GPT model."""
   if model == "o1-preview": 
     try:
-      client = openai.OpenAI(api_key=OPENAI_API_KEY)
+      client = get_openai_client()
       response = client.chat.completions.create(
         model=model,
         messages=messages
@@ -107,7 +126,7 @@ def gpt_request_messages(messages: List[dict],
       return f"GENERATION ERROR: {str(e)}"
 
   try:
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
+    client = get_openai_client()
     response = client.chat.completions.create(
       model=model,
       messages=messages,
@@ -122,7 +141,7 @@ def gpt_request_messages(messages: List[dict],
 def gpt4_vision(messages: List[dict], max_tokens: int = 1500) -> str:
   """Make a request to OpenAI's GPT-4 Vision model."""
   try:
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
+    client = get_openai_client()
     response = client.chat.completions.create(
       model="gpt-4o",
       messages=messages,
@@ -134,6 +153,62 @@ def gpt4_vision(messages: List[dict], max_tokens: int = 1500) -> str:
     return f"GENERATION ERROR: {str(e)}"
 
 
+def schema_safe_generate(prompt_input: Union[str, List[str]], 
+                         prompt_lib_file: str,
+                         output_schema: OutputSchema,
+                         gpt_version: str = "gpt-4o", 
+                         repeat: int = 1,
+                         fail_safe: Any = "error",
+                         max_tokens: int = 1500,
+                         items: Optional[List[Any]] = None,
+                         func_create_prompt_input: callable = None) -> tuple:
+  """
+  Generate a response and validate it against output_schema, retrying up to
+  `repeat` times. For batched schemas, `items` are the per-item inputs and 
+  func_create_prompt_input(items) builds the prompt input for a subset of 
+  them; each retry re-requests only the items that failed validation, and 
+  items that still fail after the last attempt get fail_safe. 
+
+  Returns (output, prompt) where prompt is the first prompt sent.
+  """
+  if items is None: 
+    prompt = generate_prompt(prompt_input, prompt_lib_file)
+    for i in range(repeat):
+      response = gpt_request(prompt, gpt_version, max_tokens)
+      result = output_schema.parse(response)
+      if result.ok: 
+        return output_schema.collect(result.values), prompt
+      if response.startswith("GENERATION ERROR"): 
+        time.sleep(2**i)
+    return fail_safe, prompt
+
+  values = [fail_safe] * len(items)
+  pending = list(range(len(items)))
+  prompt = None
+  for i in range(repeat):
+    curr_input = func_create_prompt_input([items[j] for j in pending])
+    curr_prompt = generate_prompt(curr_input, prompt_lib_file)
+    if prompt is None: 
+      prompt = curr_prompt
+
+    response = gpt_request(curr_prompt, gpt_version, max_tokens)
+    result = output_schema.parse(response, len(pending))
+    for sub_index, j in enumerate(pending): 
+      if sub_index not in result.errors: 
+        values[j] = result.values[sub_index]
+    pending = [j for sub_index, j in enumerate(pending) 
+               if sub_index in result.errors]
+    if not pending: 
+      break
+    if DEBUG: 
+      print (f"Re-requesting {len(pending)} item(s): "
+             f"{list(result.errors.values())}")
+    if response.startswith("GENERATION ERROR"): 
+      time.sleep(2**i)
+
+  return output_schema.collect(values), prompt
+
+
 def chat_safe_generate(prompt_input: Union[str, List[str]], 
                        prompt_lib_file: str,
                        gpt_version: str = "gpt-4o", 
@@ -143,29 +218,52 @@ def chat_safe_generate(prompt_input: Union[str, List[str]],
                        verbose: bool = False,
                        max_tokens: int = 1500,
                        file_attachment: str = None,
-                       file_type: str = None) -> tuple:
-  """Generate a response using GPT models with error handling & retries."""
+                       file_type: str = None,
+                       pdf_token_budget: Optional[int] = None,
+                       output_schema: OutputSchema = None,
+                       items: Optional[List[Any]] = None,
+                       func_create_prompt_input: callable = None) -> tuple:
+  """
+  Generate a response using GPT models with error handling & retries. If 
+  output_schema is given, the response is validated against it instead of 
+  being passed to func_clean_up (see schema_safe_generate). For a PDF 
+  attachment, pdf_token_budget limits the attached text to the chunks most 
+  relevant to the prompt (see select_pdf_chunks); by default the whole 
+  document is attached. 
+  """
+  if output_schema is not None and not file_attachment: 
+    response, prompt = schema_safe_generate(
+      prompt_input, prompt_lib_file, output_schema, gpt_version, repeat, 
+      fail_safe, max_tokens, items, func_create_prompt_input)
+    if verbose or DEBUG:
+      print_run_prompts(prompt_input, prompt, response)
+    return response, prompt, prompt_input, fail_safe
+
   if file_attachment and file_type:
     prompt = generate_prompt(prompt_input, prompt_lib_file)
     messages = [{"role": "user", "content": prompt}]
 
     if file_type.lower() == 'image':
-      with open(file_attachment, "rb") as image_file:
-        base64_image = base64.b64encode(image_file.read()).decode('utf-8')
       messages.append({
         "role": "user",
         "content": [
             {"type": "text", "text": "Please refer to the attached image."},
             {"type": "image_url", "image_url": 
-              {"url": f"data:image/jpeg;base64,{base64_image}"}}
+              {"url": encode_image_attachment(file_attachment)}}
         ]
       })
       response = gpt4_vision(messages, max_tokens)
 
     elif file_type.lower() == 'pdf':
-      pdf_text = extract_text_from_pdf_file(file_attachment)
-      pdf = f"PDF attachment in text-form:\n{pdf_text}\n\n"
       instruction = generate_prompt(prompt_input, prompt_lib_file)
+      if pdf_token_budget: 
+        # Only the excerpts most relevant to the task, within the budget. 
+        pdf_text = "\n...\n".join(
+          select_pdf_chunks(file_attachment, instruction, pdf_token_budget))
+        pdf = f"PDF attachment in text-form (relevant excerpts):\n{pdf_text}\n\n"
+      else: 
+        pdf_text = extract_text_from_pdf_file(file_attachment)
+        pdf = f"PDF attachment in text-form:\n{pdf_text}\n\n"
       prompt = f"{pdf}"
       prompt += f"<End of the PDF attachment>\n=\nTask description:\n{instruction}"
       response = gpt_request(prompt, gpt_version, max_tokens)
@@ -194,21 +292,267 @@ def chat_safe_generate(prompt_input: Union[str, List[str]],
 # ============================================================================
 
 def get_text_embedding(text: str, 
-                       model: str = "text-embedding-3-small") -> List[float]:
-  """Generate an embedding for the given text using OpenAI's API."""
+                       model: str = "text-embedding-3-small", 
+                       dimensions: Optional[int] = None) -> List[float]:
+  """Generate an embedding for the given text using OpenAI's API. The 
+     text-embedding-3 models can return shortened embeddings of the given 
+     dimensions (by default, the full 1536)."""
   if not isinstance(text, str) or not text.strip():
     raise ValueError("Input text must be a non-empty string.")
 
   text = text.replace("\n", " ").strip()
-  response = openai.embeddings.create(
-    input=[text], model=model).data[0].embedding
+  kwargs = {"dimensions": dimensions} if dimensions else {}
+  response = get_openai_client().embeddings.create(
+    input=[text], model=model, **kwargs).data[0].embedding
   return response
 
 
+def get_text_embeddings(texts: List[str], 
+                        model: str = "text-embedding-3-small", 
+                        batch_size: int = 256, 
+                        dimensions: Optional[int] = None) -> List[List[float]]:
+  """Generate embeddings for a list of texts, batch_size texts per request."""
+  texts = [text.replace("\n", " ").strip() or " " for text in texts]
+  kwargs = {"dimensions": dimensions} if dimensions else {}
+  embeddings = []
+  for start in range(0, len(texts), batch_size): 
+    response = get_openai_client().embeddings.create(
+      input=texts[start:start + batch_size], model=model, **kwargs)
+    embeddings += [d.embedding for d in response.data]
+  return embeddings
 
 
+# ============================================================================
+# ######################## [SECTION 4: ATTACHMENTS] ##########################
+# ============================================================================
 
+# Extracted PDF pages (and chunk embeddings) are cached per process, keyed by 
+# the sha256 of the file, for up to ATTACHMENT_CACHE_SIZE documents. 
+ATTACHMENT_CACHE_SIZE = 32
+# PDFs with at least this many pages are extracted on a process pool. 
+PDF_PARALLEL_MIN_PAGES = 32
+PDF_MAX_WORKERS = 4
+# Target size of the chunks that select_pdf_chunks chooses from. 
+PDF_CHUNK_TOKENS = 300
+
+# Images are downsized to what the vision model actually looks at: within 
+# IMAGE_MAX_SIDE pixels on the long side and IMAGE_SHORT_SIDE on the short 
+# side. 
+IMAGE_MAX_SIDE = 2048
+IMAGE_SHORT_SIDE = 768
+IMAGE_JPEG_QUALITY = 85
+
+_pdf_pages_cache = OrderedDict()
+_pdf_chunks_cache = OrderedDict()
+
+# Shared pool for PDF extraction, started on first use. Workers are spawned
+# rather than forked: forking while another thread (a reflection worker, a 
+# conversation pool, a log writer) holds a lock can deadlock the child. 
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor: 
+  global _pdf_pool
+  if _pdf_pool is None: 
+    with _pdf_pool_lock: 
+      if _pdf_pool is None: 
+        import multiprocessing
+        _pdf_pool = ProcessPoolExecutor(
+          max_workers=PDF_MAX_WORKERS, 
+          mp_context=multiprocessing.get_context("spawn"))
+        atexit.register(_pdf_pool.shutdown)
+  return _pdf_pool
+_image_cache = OrderedDict()
+_attachment_cache_lock = threading.Lock()
+
+
+def _cache_get(cache: OrderedDict, key: Any) -> Any: 
+  with _attachment_cache_lock: 
+    if key in cache: 
+      cache.move_to_end(key)
+      return cache[key]
+  return None
+
+
+def _cache_put(cache: OrderedDict, key: Any, value: Any) -> None: 
+  with _attachment_cache_lock: 
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > ATTACHMENT_CACHE_SIZE: 
+      cache.popitem(last=False)
+
+
+def file_sha256(file_path: str) -> str:
+  h = hashlib.sha256()
+  with open(file_path, "rb") as f: 
+    for block in iter(lambda: f.read(1 << 20), b""): 
+      h.update(block)
+  return h.hexdigest()
+
+
+def _extract_pdf_page_range(data: bytes, start: int, end: int) -> List[str]:
+  import PyPDF2
+
+  pdf_reader = PyPDF2.PdfReader(io.BytesIO(data))
+  return [pdf_reader.pages[i].extract_text() for i in range(start, end)]
+
+
+def extract_pdf_pages(file_path: str) -> List[str]:
+  """
+  Extract the text of each page of a PDF file. Results are cached by the 
+  file's hash, so an unchanged file is parsed once per process. Large files 
+  are split into page ranges that are extracted in parallel. 
+  """
+  if not os.path.exists(file_path):
+    raise FileNotFoundError(f"The file {file_path} does not exist.")
 
+  digest = file_sha256(file_path)
+  pages = _cache_get(_pdf_pages_cache, digest)
+  if pages is not None: 
+    return pages
 
+  import PyPDF2
 
-
+  with open(file_path, 'rb') as file:
+    data = file.read()
+  page_count = len(PyPDF2.PdfReader(io.BytesIO(data)).pages)
+
+  if page_count < PDF_PARALLEL_MIN_PAGES: 
+    pages = _extract_pdf_page_range(data, 0, page_count)
+  else: 
+    step = -(-page_count // PDF_MAX_WORKERS)
+    ranges = [(start, min(start + step, page_count)) 
+              for start in range(0, page_count, step)]
+    pool = _get_pdf_pool()
+    futures = [pool.submit(_extract_pdf_page_range, data, start, end) 
+               for start, end in ranges]
+    pages = [page for future in futures for page in future.result()]
+
+  _cache_put(_pdf_pages_cache, digest, pages)
+  return pages
+
+
+def chunk_pages(pages: List[str], 
+                chunk_tokens: int = PDF_CHUNK_TOKENS) -> List[str]:
+  """
+  Split page texts into chunks of about chunk_tokens (estimated) tokens, 
+  breaking at line boundaries. Chunks do not span pages. 
+  """
+  chunks = []
+  for page in pages: 
+    curr, curr_tokens = [], 0
+    for line in page.splitlines(): 
+      line_tokens = estimate_token_count(line)
+      if curr and curr_tokens + line_tokens > chunk_tokens: 
+        chunks += ["\n".join(curr)]
+        curr, curr_tokens = [], 0
+      curr += [line]
+      curr_tokens += line_tokens
+    if curr and "".join(curr).strip(): 
+      chunks += ["\n".join(curr)]
+  return chunks
+
+
+def select_pdf_chunks(file_path: str, 
+                      query: str, 
+                      token_budget: int, 
+                      chunk_tokens: int = PDF_CHUNK_TOKENS) -> List[str]:
+  """
+  Select the chunks of a PDF most similar to query (by embedding cosine 
+  similarity) that fit in token_budget, returned in document order. Chunk 
+  embeddings are cached with the file's pages. 
+  """
+  import numpy
+
+  key = (file_sha256(file_path), chunk_tokens)
+  cached = _cache_get(_pdf_chunks_cache, key)
+  if cached is None: 
+    chunks = chunk_pages(extract_pdf_pages(file_path), chunk_tokens)
+    embeddings = numpy.array(get_text_embeddings(chunks)) if chunks else None
+    cached = (chunks, embeddings)
+    _cache_put(_pdf_chunks_cache, key, cached)
+  chunks, embeddings = cached
+  if not chunks: 
+    return []
+
+  q = numpy.array(get_text_embedding(query))
+  scores = (embeddings @ q) / (numpy.linalg.norm(embeddings, axis=1) 
+                               * numpy.linalg.norm(q))
+
+  selected, used = [], 0
+  for i in numpy.argsort(-scores): 
+    chunk_tokens_i = estimate_token_count(chunks[i])
+    if used + chunk_tokens_i > token_budget: 
+      continue
+    selected += [int(i)]
+    used += chunk_tokens_i
+  return [chunks[i] for i in sorted(selected)]
+
+
+def detect_image_mime(data: bytes) -> Optional[str]:
+  """Detect the MIME type of image bytes from their magic number."""
+  if data.startswith(b"\xff\xd8\xff"): 
+    return "image/jpeg"
+  if data.startswith(b"\x89PNG\r\n\x1a\n"): 
+    return "image/png"
+  if data[:6] in (b"GIF87a", b"GIF89a"): 
+    return "image/gif"
+  if data[:4] == b"RIFF" and data[8:12] == b"WEBP": 
+    return "image/webp"
+  return None
+
+
+def _preprocess_image(data: bytes, 
+                      max_side: int, 
+                      short_side: int) -> Tuple[bytes, str]:
+  """
+  Downsize image bytes to fit max_side x max_side with the short side at 
+  most short_side, and re-encode them (JPEG, or PNG if the image has 
+  transparency). Images that need no resizing and are already in a format 
+  the model accepts are returned unchanged. The EXIF orientation (e.g., of 
+  phone photos) is applied to the pixels, since re-encoding drops it. 
+  """
+  from PIL import Image, ImageOps
+
+  mime = detect_image_mime(data)
+  with Image.open(io.BytesIO(data)) as image: 
+    rotated = image.getexif().get(0x0112, 1) != 1
+    if rotated: 
+      image = ImageOps.exif_transpose(image)
+    width, height = image.size
+    scale = min(1.0, max_side / max(width, height), short_side / min(width, height))
+    if scale == 1.0 and mime is not None and not rotated: 
+      return data, mime
+
+    if scale < 1.0: 
+      image = image.resize((max(1, round(width * scale)), 
+                            max(1, round(height * scale))), 
+                           Image.LANCZOS)
+    out = io.BytesIO()
+    if image.mode in ("RGBA", "LA") or "transparency" in image.info: 
+      image.save(out, format="PNG", optimize=True)
+      return out.getvalue(), "image/png"
+    image.convert("RGB").save(out, format="JPEG", 
+                              quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return out.getvalue(), "image/jpeg"
+
+
+def encode_image_attachment(file_path: str, 
+                            max_side: int = IMAGE_MAX_SIDE, 
+                            short_side: int = IMAGE_SHORT_SIDE) -> str:
+  """
+  Return the image at file_path as a base64 data URL with its real MIME 
+  type, downsized and re-encoded for the vision model. Results are cached 
+  by the file's hash and the target size. 
+  """
+  key = (file_sha256(file_path), max_side, short_side)
+  url = _cache_get(_image_cache, key)
+  if url is not None: 
+    return url
+
+  with open(file_path, "rb") as image_file: 
+    data, mime = _preprocess_image(image_file.read(), max_side, short_side)
+  url = f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}"
+  _cache_put(_image_cache, key, url)
+  return url
@@ -1,63 +1,392 @@
 import json
 import re
 
+from abc import ABC, abstractmethod
+
+
+# Curly quotes that LLMs like to emit in place of JSON string delimiters. 
+# Translated in one pass with str.translate, and only on the repair path.
+_QUOTE_TABLE = str.maketrans({"\u201c": "\"", "\u201d": "\"", 
+                              "\u2018": "'", "\u2019": "'"})
+
+# A JSON string literal (with escapes) or a structural brace. Scanning with 
+# this pattern lets the regex engine skip over everything else in C.
+_SCAN_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[{}]', re.DOTALL)
+
+# A JSON string literal, or a trailing comma before a closing bracket.
+_TRAILING_COMMA = re.compile(r'("(?:[^"\\]|\\.)*")|,\s*([}\]])', re.DOTALL)
+
+_DECODER = json.JSONDecoder()
+
+
+def _scan_first_json_span(input_str, start_index):
+  """
+  Finds the end of the JSON object that begins at start_index in a single 
+  pass. Braces that appear inside quoted strings (including escaped quotes) 
+  are ignored. 
+
+  Parameters:
+    input_str: the str that contains the JSON object
+    start_index: the index of the opening '{' 
+  Returns: 
+    (end_index, depth) where end_index is one past the matching '}' and depth
+    is the number of braces that were still open when the input ran out (0 if 
+    the object is complete). 
+  """
+  depth = 0
+  end_index = len(input_str)
+  for match in _SCAN_TOKEN.finditer(input_str, start_index):
+    token = match.group()
+    if token == "{":
+      depth += 1
+    elif token == "}":
+      depth -= 1
+      if depth == 0:
+        return match.end(), 0
+  return end_index, depth
+
+
+def _repair_json_str(json_str, open_depth=0):
+  """
+  Applies the cheap fixes that cover most malformed LLM JSON: curly quotes, 
+  trailing commas, and objects that were cut off before their closing braces.
+  """
+  json_str = json_str.translate(_QUOTE_TABLE)
+  json_str = _TRAILING_COMMA.sub(
+    lambda m: m.group(1) if m.group(1) is not None else m.group(2), json_str)
+  if open_depth > 0: 
+    json_str = json_str.rstrip().rstrip(",") + "}" * open_depth
+  return json_str
+
 
 def extract_first_json_dict(input_str):
+  """
+  Extracts the first JSON dictionary in an LLM response. Surrounding prose 
+  and ```json code fences are ignored. 
+
+  The well-formed case is decoded directly from the first '{' with 
+  json.JSONDecoder.raw_decode, without copying the input. Only if that fails 
+  do we locate the object with a string-aware scan and repair it (curly 
+  quotes, trailing commas, missing closing braces). 
+
+  Parameters:
+    input_str: the raw LLM response
+  Returns: 
+    The parsed dictionary, or None if no JSON dictionary could be recovered.
+  """
+  start_index = input_str.find("{")
+  if start_index == -1: 
+    return None
+
+  # Fast path: the response contains valid JSON starting at the first brace.
+  try:
+    json_dict, _ = _DECODER.raw_decode(input_str, start_index)
+    if isinstance(json_dict, dict): 
+      return json_dict
+  except ValueError:
+    pass
+
+  # Repair path. Curly quotes are translated first so that the scan sees 
+  # the same string boundaries that json.loads will. 
+  input_str = input_str.translate(_QUOTE_TABLE)
+  end_index, open_depth = _scan_first_json_span(input_str, start_index)
+  json_str = _repair_json_str(input_str[start_index:end_index], open_depth)
   try:
-    # Replace curly quotes with standard double quotes
-    input_str = (input_str.replace("“", "\"")
-                          .replace("”", "\"")
-                          .replace("‘", "'")
-                          .replace("’", "'"))
-    
-    # Find the first occurrence of '{' in the input_str
-    start_index = input_str.index('{')
-    
-    # Initialize a count to keep track of open and close braces
-    count = 1
-    end_index = start_index + 1
-    
-    # Loop to find the closing '}' for the first JSON dictionary
-    while count > 0 and end_index < len(input_str):
-        if input_str[end_index] == '{':
-            count += 1
-        elif input_str[end_index] == '}':
-            count -= 1
-        end_index += 1
-    
-    # Extract the JSON substring
-    json_str = input_str[start_index:end_index]
-    
-    # Parse the JSON string into a Python dictionary
     json_dict = json.loads(json_str)
-    
-    return json_dict
   except ValueError:
     # Handle the case where the JSON parsing fails
     return None
+  return json_dict if isinstance(json_dict, dict) else None
+
 
+def _extract_survey_answers(input_str, schema, reasoning_pattern, 
+                            response_pattern): 
+  """
+  Shared body of the categorical and numerical survey extractors. Answers 
+  are read from the parsed JSON so escaped quotes and reordered keys are 
+  handled; items that fail validation are kept as None so the returned lists
+  stay aligned with the question numbers. The old regexes are only used when
+  no JSON dictionary can be recovered at all. 
+  """
+  json_dict = extract_first_json_dict(input_str)
+  if not json_dict: 
+    reasonings = re.findall(reasoning_pattern, input_str)
+    responses = re.findall(response_pattern, input_str)
+    return responses, reasonings
+
+  result = schema.validate(json_dict, len(json_dict))
+  responses, reasonings = [], []
+  for index, item in enumerate(result.raw): 
+    if index in result.errors: 
+      responses += [None]
+    else: 
+      responses += [str(item[schema.value_key])]
+    reasoning = item.get("Reasoning") if isinstance(item, dict) else None
+    reasonings += [reasoning if isinstance(reasoning, str) else None]
+  return responses, reasonings
 
 
 def extract_first_json_dict_categorical(input_str): 
   reasoning_pattern = r'"Reasoning":\s*"([^"]+)"'
   response_pattern = r'"Response":\s*"([^"]+)"'
+  return _extract_survey_answers(input_str, CATEGORICAL_ANSWER_SCHEMA,
+                                 reasoning_pattern, response_pattern)
 
-  reasonings = re.findall(reasoning_pattern, input_str)
-  responses = re.findall(response_pattern, input_str)
 
-  return responses, reasonings
+def extract_first_json_dict_numerical(input_str): 
+  reasoning_pattern = r'"Reasoning":\s*"([^"]+)"'
+  response_pattern = r'"Response":\s*(\d+\.?\d*)'
+  return _extract_survey_answers(input_str, NUMERICAL_ANSWER_SCHEMA,
+                                 reasoning_pattern, response_pattern)
 
 
-def extract_first_json_dict_numerical(input_str): 
-  reasoning_pattern = re.compile(r'"Reasoning":\s*"([^"]+)"')
-  response_pattern = re.compile(r'"Response":\s*(\d+\.?\d*)')
+# ##############################################################################
+# ###                       STRUCTURED OUTPUT SCHEMAS                        ###
+# ##############################################################################
 
-  reasonings = reasoning_pattern.findall(input_str)
-  responses = response_pattern.findall(input_str)
-  return responses, reasonings
+class SchemaResult: 
+  def __init__(self, values, errors, raw=None): 
+    # One validated value per expected item (None where validation failed).
+    self.values = values
+    # Maps the index of each failed item to a short description of the error.
+    self.errors = errors
+    # The unvalidated entries, aligned with values. 
+    self.raw = raw if raw is not None else [None] * len(values)
+
+
+  @property
+  def failed(self): 
+    return sorted(self.errors)
+
+
+  @property
+  def ok(self): 
+    return not self.errors
+
+
+def _coerce_value(value, value_type, value_range=None, options=None): 
+  """
+  Coerces a single JSON value to value_type and checks it against the 
+  optional numeric range or set of allowed options. 
+
+  Parameters:
+    value: the raw JSON value
+    value_type: one of str, int, float
+    value_range: optional (min, max) tuple for numeric values
+    options: optional collection of allowed string values
+  Returns: 
+    (coerced value, None) on success, or (None, error str) on failure.
+  """
+  if value is None or isinstance(value, (bool, dict, list)): 
+    return None, f"expected {value_type.__name__}, got {value!r}"
+
+  if value_type is str: 
+    if not isinstance(value, str) or not value.strip(): 
+      return None, f"expected a non-empty string, got {value!r}"
+    value = value.strip()
+    if options is not None and value not in options: 
+      return None, f"{value!r} is not one of the allowed options"
+    return value, None
+
+  try: 
+    value = float(value)
+  except (TypeError, ValueError): 
+    return None, f"expected a number, got {value!r}"
+  if value != value: 
+    return None, "expected a number, got NaN"
+  if value_range and not value_range[0] <= value <= value_range[1]: 
+    return None, f"{value} is outside of {value_range}"
+  if value_type is int: 
+    value = int(round(value))
+  return value, None
+
+
+class OutputSchema(ABC): 
+  """
+  Declarative description of the JSON a prompt is expected to return. 
+  Subclasses implement validate(); batched schemas validate one value per 
+  input item so that chat_safe_generate can re-request only the items that 
+  failed. 
+  """
+  batched = False
+
+
+  @abstractmethod
+  def validate(self, json_dict, item_count=1): 
+    """
+    Validates an extracted JSON dictionary.
+
+    Parameters:
+      json_dict: the JSON dictionary extracted from the response
+      item_count: the number of items the response should contain
+    Returns: 
+      SchemaResult
+    """
+
+
+  def parse(self, gpt_response, item_count=1): 
+    """
+    Extracts the first JSON dictionary from gpt_response and validates it.
+
+    Parameters:
+      gpt_response: the raw LLM response
+      item_count: the number of items the response should contain
+    Returns: 
+      SchemaResult
+    """
+    json_dict = None
+    if isinstance(gpt_response, str): 
+      json_dict = extract_first_json_dict(gpt_response)
+    if json_dict is None: 
+      return SchemaResult([None] * item_count, 
+        {i: "no JSON dictionary found" for i in range(item_count)})
+    return self.validate(json_dict, item_count)
+
+
+  def collect(self, values): 
+    """Turns the per-item values into the output returned to the caller."""
+    return values
+
+
+class FieldSchema(OutputSchema): 
+  """A single required field, e.g. {"utterance": "..."}."""
+  def __init__(self, key, value_type=str, value_range=None, options=None): 
+    self.key = key
+    self.value_type = value_type
+    self.value_range = value_range
+    self.options = options
+
+
+  def validate(self, json_dict, item_count=1): 
+    if self.key not in json_dict: 
+      return SchemaResult([None], {0: f"missing key {self.key!r}"})
+    raw = json_dict[self.key]
+    value, error = _coerce_value(raw, self.value_type, 
+                                 self.value_range, self.options)
+    return SchemaResult([value], {0: error} if error else {}, [raw])
+
+
+  def collect(self, values): 
+    return values[0]
+
+
+class ListFieldSchema(OutputSchema): 
+  """
+  A field holding a list, e.g. {"reflection": ["...", "..."]}. Invalid 
+  entries are dropped; the result only fails if no valid entry remains. 
+  """
+  def __init__(self, key, value_type=str): 
+    self.key = key
+    self.value_type = value_type
+
+
+  def validate(self, json_dict, item_count=1): 
+    raw = json_dict.get(self.key)
+    if not isinstance(raw, list): 
+      return SchemaResult([None], {0: f"expected a list under {self.key!r}"})
+    values = []
+    for entry in raw: 
+      value, error = _coerce_value(entry, self.value_type)
+      if not error: 
+        values += [value]
+    if not values: 
+      return SchemaResult([None], {0: f"no valid entries under {self.key!r}"})
+    return SchemaResult(values, {}, raw)
+
+
+class ItemSchema(OutputSchema): 
+  """
+  One value per numbered input item, e.g. {"Item 1": 80, "Item 2": 35} or 
+  {"1": {"Reasoning": "...", "Response": "..."}, ...}. Items are matched by 
+  the number in their key, so reordered keys are fine; keys without a number
+  fall back to their position. If value_key is set, each item is a 
+  dictionary and the value is read from that key. 
+  """
+  batched = True
+
+  def __init__(self, value_type, value_key=None, value_range=None, 
+               options=None): 
+    self.value_type = value_type
+    self.value_key = value_key
+    self.value_range = value_range
+    self.options = options
+
+
+  def validate(self, json_dict, item_count=1): 
+    raw = [None] * item_count
+    for position, (key, entry) in enumerate(json_dict.items()): 
+      number = re.search(r"\d+", str(key))
+      index = int(number.group()) - 1 if number else position
+      if 0 <= index < item_count and raw[index] is None: 
+        raw[index] = entry
+
+    values = [None] * item_count
+    errors = dict()
+    for index, entry in enumerate(raw): 
+      if entry is None: 
+        errors[index] = f"missing item {index + 1}"
+        continue
+      if self.value_key is not None: 
+        if not isinstance(entry, dict) or self.value_key not in entry: 
+          errors[index] = f"item {index + 1} has no {self.value_key!r}"
+          continue
+        entry = entry[self.value_key]
+      value, error = _coerce_value(entry, self.value_type, 
+                                   self.value_range, self.options)
+      if error: 
+        errors[index] = f"item {index + 1}: {error}"
+      else: 
+        values[index] = value
+    return SchemaResult(values, errors, raw)
+
+
+# Expected outputs of the prompts in simulation_engine/prompt_template.
+IMPORTANCE_SCORE_SCHEMA = ItemSchema(int, value_range=(0, 100))
+REFLECTION_SCHEMA = ListFieldSchema("reflection", str)
+UTTERANCE_SCHEMA = FieldSchema("utterance", str)
+DIALOGUE_SUMMARY_SCHEMA = FieldSchema("summary", str)
+MEMORY_SUMMARY_SCHEMA = FieldSchema("summary", str)
+CATEGORICAL_ANSWER_SCHEMA = ItemSchema(str, value_key="Response")
+NUMERICAL_ANSWER_SCHEMA = ItemSchema(float, value_key="Response")
   
 
+def benchmark_extract_first_json_dict(item_count=500, repeat=20):
+  """
+  Measures extract_first_json_dict throughput on a large batched response 
+  (the shape returned by the batch importance prompt), both for well-formed 
+  JSON and for a response that needs repair (curly quotes, trailing commas). 
+
+  Parameters:
+    item_count: number of items in the synthetic batched response
+    repeat: number of timed parses per case
+  Returns: 
+    Dictionary mapping each case to its throughput in MB/s.
+  """
+  import time
+
+  items = ",\n".join(
+    f'  "Item {i+1}": {{"Reasoning": "Brace {{ and quote \\" in text {i}.", '
+    f'"Response": {i % 100}}}' for i in range(item_count))
+  valid = f"Here are the scores:\n```json\n{{\n{items}\n}}\n```\n"
+  broken = valid.replace('"Response"', "\u201cResponse\u201d").replace(
+    "\n}\n```", ",\n}\n```")
+
+  results = dict()
+  for case, input_str in [("valid", valid), ("repair", broken)]: 
+    assert len(extract_first_json_dict(input_str)) == item_count
+    start = time.perf_counter()
+    for _ in range(repeat): 
+      extract_first_json_dict(input_str)
+    elapsed = time.perf_counter() - start
+    results[case] = len(input_str) * repeat / elapsed / 1e6
+    print (f"{case}: {len(input_str)/1e3:.1f} KB response, "
+           f"{elapsed/repeat*1e3:.2f} ms/parse, {results[case]:.1f} MB/s")
+  return results
+
+
 if __name__ == '__main__':
+  benchmark_extract_first_json_dict()
+
   input_str = """```json
 {
   "1": {
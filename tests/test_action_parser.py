@@ -0,0 +1,25 @@
+import unittest
+
+from cs222_assignment_1_bonus.action_parser import parse_action
+
+
+class ParseActionTest(unittest.TestCase):
+    def test_whole_quantities(self):
+        self.assertEqual(parse_action("I will add 250g of all-purpose flour."),
+                         "add 250 flour")
+        self.assertEqual(parse_action("Let me add 2.0 cups of milk."),
+                         "add 2 milk")
+
+    def test_decimal_quantities_go_to_llm(self):
+        self.assertIsNone(parse_action("I will add 0.5 teaspoon of salt."))
+        self.assertIsNone(parse_action("Let me add 1.5 cups of flour."))
+
+    def test_fractions_and_vague_measures_go_to_llm(self):
+        self.assertIsNone(parse_action("I will add 1/2 cup of sugar."))
+        self.assertIsNone(parse_action("Add half a cup of milk."))
+        self.assertIsNone(parse_action("Add a pinch of salt."))
+        self.assertIsNone(parse_action("Add a couple of eggs."))
+
+
+if __name__ == "__main__":
+    unittest.main()
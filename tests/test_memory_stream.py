@@ -0,0 +1,91 @@
+import hashlib
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import generative_agent.modules.memory_stream as memory_stream
+from generative_agent.modules.memory_stream import MemoryStream
+
+
+DIM = 32
+
+
+def fake_embedding(text, dimensions=None, **kwargs):
+  seed = int(hashlib.md5(text.encode()).hexdigest()[:8], 16)
+  return np.random.default_rng(seed).standard_normal(DIM).tolist()
+
+
+def fake_relevance(seq_nodes, embeddings, focal_pt):
+  query = np.asarray(memory_stream.get_text_embedding(focal_pt))
+  query /= np.linalg.norm(query)
+  return {node.node_id: float(np.dot(embeddings[node.content], query)
+                              / np.linalg.norm(embeddings[node.content]))
+          for node in seq_nodes}
+
+
+def make_memory_stream(n):
+  nodes = [{"node_id": i, "node_type": "observation", "content": f"obs {i}",
+            "importance": i % 10, "created": 0, "last_retrieved": i,
+            "pointer_id": None} for i in range(n)]
+  embeddings = {node["content"]: fake_embedding(node["content"])
+                for node in nodes}
+  return MemoryStream(nodes, embeddings)
+
+
+class ConsolidateDuringRetrievalTest(unittest.TestCase):
+  """
+  A background consolidation can commit while a retrieval is scoring; the
+  retrieval must neither fail nor return the nodes it removed.
+  """
+  def retrieve_while_consolidating(self, embedding_dtype):
+    ms = make_memory_stream(60)
+    ms.embedding_dtype = embedding_dtype
+    group = ms.seq_nodes[:4]
+    pending = [{"content": "summary", "importance": 1,
+                "embedding": fake_embedding("summary"),
+                "last_retrieved": {n.node_id: n.last_retrieved
+                                   for n in group}}]
+    committed = []
+
+    # Embedding the focal point is the retrieval's first step after it has
+    # snapshotted the nodes, so the consolidation commits right then.
+    def embedding(text, dimensions=None, **kwargs):
+      if text == "query" and not committed:
+        committed.extend(ms.consolidate_nodes(100, pending))
+      return fake_embedding(text)
+
+    with mock.patch.object(memory_stream, "get_text_embedding", embedding), \
+         mock.patch.object(memory_stream, "extract_recency",
+                           lambda nodes: {n.node_id: n.last_retrieved
+                                          for n in nodes}), \
+         mock.patch.object(memory_stream, "extract_importance",
+                           lambda nodes: {n.node_id: n.importance
+                                          for n in nodes}), \
+         mock.patch.object(memory_stream, "extract_relevance",
+                           fake_relevance):
+      retrieved = ms.retrieve(["query"], 100, n_count=60)["query"]
+
+    self.assertEqual(len(committed), 1)
+    removed = {n.node_id for n in group}
+    if embedding_dtype != "float32":
+      # Index scoring runs under the lock after the commit: removed nodes
+      # are skipped.
+      self.assertFalse(removed & {n.node_id for n in retrieved})
+    self.assertTrue(retrieved)
+
+
+  def test_plain(self):
+    self.retrieve_while_consolidating("float32")
+
+
+  def test_float16_index(self):
+    self.retrieve_while_consolidating("float16")
+
+
+  def test_int8_index(self):
+    self.retrieve_while_consolidating("int8")
+
+
+if __name__ == "__main__":
+  unittest.main()